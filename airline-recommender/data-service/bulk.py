@@ -0,0 +1,137 @@
+"""Bulk catalog upserts through `COPY` into a staging table.
+
+A batch is either a JSON array of objects or a CSV stream whose header row
+names the fields. It is copied into a temporary staging table (all text,
+plus its position in the batch) and merged into the catalog table with a
+single `INSERT ... SELECT ... ON CONFLICT DO UPDATE`, all in one
+transaction. When a key appears more than once in a batch, its last row
+wins. Casting to the table's column types happens in the merge, so a bad
+value rejects the whole batch and nothing is written.
+"""
+import csv
+import io
+import json
+import tempfile
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import psycopg2
+from fastapi import HTTPException, Request
+
+# (field name in the payload, table column, SQL type)
+Field = Tuple[str, str, str]
+
+
+async def read_batch(request: Request, fields: Sequence[Field]) -> Tuple[object, str, List[str]]:
+    """Spool a request body for COPY; returns (spool, COPY format, field names in column order)."""
+    known = [name for name, _, _ in fields]
+    spool = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    if "csv" in request.headers.get("content-type", ""):
+        async for chunk in request.stream():
+            spool.write(chunk)
+        spool.seek(0)
+        header = next(csv.reader([spool.readline().decode("utf-8-sig")]), [])
+        spool.seek(0)
+        names = [name.strip() for name in header]
+        unknown = sorted(set(names) - set(known))
+        missing = [name for name in known if name not in names]
+        if unknown or missing:
+            raise HTTPException(
+                status_code=400,
+                detail=f"CSV header must name exactly these fields: {', '.join(known)}",
+            )
+        return spool, "csv", names
+
+    try:
+        rows = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON array of objects or text/csv")
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise HTTPException(status_code=400, detail="Body must be a JSON array of objects or text/csv")
+
+    text = io.TextIOWrapper(spool, encoding="utf-8", newline="", write_through=True)
+    for row in rows:
+        text.write("\t".join(_copy_text(row.get(name)) for name in known) + "\n")
+    text.detach()
+    spool.seek(0)
+    return spool, "text", known
+
+
+def upsert(
+    connect: Callable,
+    table: str,
+    key: str,
+    fields: Sequence[Field],
+    spool,
+    fmt: str,
+    names: Sequence[str],
+) -> Dict[str, object]:
+    """Merge a spooled batch into `table`; returns per-batch counts and timings (ms)."""
+    columns = {name: (column, sql_type) for name, column, sql_type in fields}
+    staging = f"{table}_staging"
+    staged_columns = ", ".join(columns[name][0] for name in names)
+    all_columns = [column for _, column, _ in fields]
+    casts = ", ".join(f"{column}::{sql_type}" for _, column, sql_type in fields)
+    key_type = next(sql_type for _, column, sql_type in fields if column == key)
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in all_columns if column != key)
+    options = "FORMAT csv, HEADER" if fmt == "csv" else "FORMAT text"
+
+    started = time.perf_counter()
+    conn = connect()
+    try:
+        conn.autocommit = False
+        with conn.cursor() as cur:
+            cur.execute(
+                f"CREATE TEMP TABLE {staging} (seq BIGSERIAL, "
+                + ", ".join(f"{column} TEXT" for column in all_columns)
+                + ") ON COMMIT DROP"
+            )
+            cur.copy_expert(f"COPY {staging} ({staged_columns}) FROM STDIN WITH ({options})", spool)
+            cur.execute(f"SELECT COUNT(*) FROM {staging}")
+            received = cur.fetchone()[0]
+            copied = time.perf_counter()
+
+            cur.execute(
+                f"""
+                WITH merged AS (
+                    INSERT INTO {table} ({", ".join(all_columns)})
+                    SELECT {casts} FROM (
+                        SELECT DISTINCT ON ({key}::{key_type}) *
+                        FROM {staging}
+                        ORDER BY {key}::{key_type}, seq DESC
+                    ) latest
+                    ON CONFLICT ({key}) DO UPDATE SET {updates}
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM merged
+                """
+            )
+            inserted, updated = cur.fetchone()
+        conn.commit()
+    except (psycopg2.DataError, psycopg2.IntegrityError) as exc:
+        conn.rollback()
+        raise HTTPException(status_code=400, detail=f"Batch rejected: {exc.pgerror or exc}".strip())
+    finally:
+        conn.close()
+        spool.close()
+
+    finished = time.perf_counter()
+    return {
+        "received": received,
+        "inserted": inserted,
+        "updated": updated,
+        # Rows whose key appeared again later in the batch.
+        "superseded": received - inserted - updated,
+        "timing": {
+            "copyMs": round((copied - started) * 1000, 1),
+            "mergeMs": round((finished - copied) * 1000, 1),
+            "totalMs": round((finished - started) * 1000, 1),
+        },
+    }
+
+
+def _copy_text(value) -> str:
+    """One field in COPY's text format (`\\N` is NULL)."""
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
@@ -1,15 +1,27 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 import os
 import random
 import string
+import threading
 import time
+from typing import Optional
 from datetime import datetime, timedelta, timezone
 from uuid import uuid4
 
 import psycopg2
 from psycopg2.extras import RealDictCursor, execute_values
 
+import tracing
+from bulk import read_batch, upsert
+from catalog_cache import NOT_FOUND, CatalogCache, version_sql
+from changes import change_feed, changes_sql, head
+from export import export
+from partitions import maintain, partitioned_sql
+from pools import Database
+from tracing import Tracer
+
 app = FastAPI()
 
 app.add_middleware(
@@ -22,19 +34,100 @@ app.add_middleware(
 
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Optional read replicas (comma-separated URLs) for the bulk exports and the
+# interaction listing; see pools.py.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "10"))
+DATABASE_REPLICA_POOL_SIZE = int(os.getenv("DATABASE_REPLICA_POOL_SIZE", "10"))
+# A replica that fails is left out for this long.
+REPLICA_EJECT_SECONDS = float(os.getenv("REPLICA_EJECT_SECONDS", "30"))
+# Replicas further behind the primary are skipped; unset, replay lag is not checked.
+REPLICA_MAX_LAG_SECONDS = float(os.environ["REPLICA_MAX_LAG_SECONDS"]) if os.getenv("REPLICA_MAX_LAG_SECONDS") else None
+
+# How stale the cached catalog version may get before it is re-read.
+CATALOG_VERSION_CHECK_SECONDS = float(os.getenv("CATALOG_VERSION_CHECK_SECONDS", "1"))
+# Catalog change-log entries older than this are pruned at startup.
+CHANGE_RETENTION_DAYS = float(os.getenv("CHANGE_RETENTION_DAYS", "7"))
+# Interactions are partitioned by month (see partitions.py). Partitions are
+# created this many months ahead; with a retention, partitions older than
+# that many months are detached (or dropped with INTERACTION_RETENTION_DROP).
+INTERACTION_PARTITION_MONTHS_AHEAD = int(os.getenv("INTERACTION_PARTITION_MONTHS_AHEAD", "3"))
+INTERACTION_RETENTION_MONTHS = int(os.getenv("INTERACTION_RETENTION_MONTHS", "0"))
+INTERACTION_RETENTION_DROP = os.getenv("INTERACTION_RETENTION_DROP", "false").lower() in ("1", "true", "yes")
+PARTITION_MAINTENANCE_SECONDS = float(os.getenv("PARTITION_MAINTENANCE_SECONDS", "3600"))
+
+# Request tracing (see tracing.py): spans kept in memory, optionally appended to
+# TRACE_EXPORT_PATH as JSONL; GET /traces lists requests slower than TRACE_SLOW_MS.
+TRACE_BUFFER_SPANS = int(os.getenv("TRACE_BUFFER_SPANS", "10000"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "").strip() or None
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "500"))
+
+tracer = Tracer("airline-data-service", TRACE_BUFFER_SPANS, TRACE_EXPORT_PATH)
+tracing.install(app, tracer)
+
+
+# Parsed departure time, kept in sync by a trigger, for indexed
+# departure-window queries (departure_at is NULL when the text is not a
+# timestamp). Same DDL as db/init.sql; idempotent, so it also migrates
+# databases created before the column existed.
+DEPARTURE_INDEX_SQL = """
+CREATE OR REPLACE FUNCTION parse_departure(value TEXT) RETURNS TIMESTAMPTZ AS $$
+BEGIN
+  RETURN value::timestamptz;
+EXCEPTION WHEN others THEN
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+CREATE OR REPLACE FUNCTION set_departure_at() RETURNS trigger AS $$
+BEGIN
+  NEW.departure_at := parse_departure(NEW.departure);
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE flights ADD COLUMN IF NOT EXISTS departure_at TIMESTAMPTZ;
+
+CREATE OR REPLACE TRIGGER flights_departure_at
+  BEFORE INSERT OR UPDATE OF departure ON flights
+  FOR EACH ROW EXECUTE FUNCTION set_departure_at();
+
+UPDATE flights SET departure_at = parse_departure(departure) WHERE departure_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS flights_route_departure_idx
+  ON flights (LOWER(source), LOWER(destination), departure_at);
+"""
+
+
+db = Database(
+    DATABASE_URL,
+    DATABASE_REPLICA_URLS,
+    pool_size=DATABASE_POOL_SIZE,
+    replica_pool_size=DATABASE_REPLICA_POOL_SIZE,
+    eject_seconds=REPLICA_EJECT_SECONDS,
+    max_lag_seconds=REPLICA_MAX_LAG_SECONDS,
+)
+
 
+def _connect():
+    """A pooled primary connection: writes, DDL, catalog reads and the change feed."""
+    return db.write()
 
-def _require_database_url() -> str:
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL is not set")
-    return DATABASE_URL
 
+def _reader(consistent: bool = False):
+    """Connect callable for reads that tolerate replica lag; `consistent` reads the primary."""
+    return lambda: db.read(consistent)
 
-def _connect():
-    # For long-running services, autocommit avoids idle-in-transaction sessions.
-    conn = psycopg2.connect(_require_database_url())
-    conn.autocommit = True
-    return conn
+
+flight_cache = CatalogCache(_connect, "flights", check_interval=CATALOG_VERSION_CHECK_SECONDS)
+
+# Interaction columns besides the id and the partition key `ts`.
+INTERACTION_COLUMNS = [
+    ("user_id", "TEXT NOT NULL"),
+    ("flight_number", "TEXT NOT NULL REFERENCES flights(flight_number) ON DELETE CASCADE"),
+    ("interaction_type", "TEXT NOT NULL"),
+    ("rating", "DOUBLE PRECISION NULL"),
+]
 
 
 def _random_flight_number() -> str:
@@ -88,18 +181,11 @@ def _seed_if_empty():
                 );
                 """
             )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS user_interactions (
-                    id BIGSERIAL PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    flight_number TEXT NOT NULL REFERENCES flights(flight_number) ON DELETE CASCADE,
-                    interaction_type TEXT NOT NULL,
-                    ts TEXT NOT NULL,
-                    rating DOUBLE PRECISION NULL
-                );
-                """
-            )
+            cur.execute(partitioned_sql("user_interactions", INTERACTION_COLUMNS))
+
+            cur.execute(DEPARTURE_INDEX_SQL)
+            cur.execute(version_sql("flights"))
+            cur.execute(changes_sql("flights", "flight_number", CHANGE_RETENTION_DAYS))
 
             cur.execute("SELECT COUNT(*) AS cnt FROM flights;")
             flights_count = cur.fetchone()[0]
@@ -212,6 +298,27 @@ def _seed_if_empty():
                 )
 
 
+def _maintain_partitions():
+    actions = maintain(
+        _connect,
+        "user_interactions",
+        INTERACTION_PARTITION_MONTHS_AHEAD,
+        INTERACTION_RETENTION_MONTHS,
+        INTERACTION_RETENTION_DROP,
+    )
+    for action, partition in actions:
+        print(f"Interaction partition {partition} {action}")
+
+
+def _maintain_partitions_forever():
+    while True:
+        time.sleep(PARTITION_MAINTENANCE_SECONDS)
+        try:
+            _maintain_partitions()
+        except Exception as exc:  # noqa: BLE001
+            print(f"Partition maintenance failed: {exc}")
+
+
 @app.on_event("startup")
 def startup_event():
     last_exc = None
@@ -221,6 +328,8 @@ def startup_event():
                 with conn.cursor() as cur:
                     cur.execute("SELECT 1;")
             _seed_if_empty()
+            _maintain_partitions()
+            threading.Thread(target=_maintain_partitions_forever, daemon=True).start()
             return
         except Exception as exc:  # noqa: BLE001
             last_exc = exc
@@ -229,48 +338,264 @@ def startup_event():
 
 
 @app.get("/flights")
-async def get_flights(limit: int = 100):
-    with _connect() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT
-                    flight_number AS "flightNumber",
-                    airline,
-                    source,
-                    destination,
-                    departure,
-                    arrival
-                FROM flights
-                ORDER BY flight_number
-                LIMIT %s
-                """,
-                (limit,),
-            )
-            return list(cur.fetchall())
+def get_flights(request: Request, limit: int = 100):
+    def load():
+        with _connect() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    """
+                    SELECT
+                        flight_number AS "flightNumber",
+                        airline,
+                        source,
+                        destination,
+                        departure,
+                        arrival
+                    FROM flights
+                    ORDER BY flight_number
+                    LIMIT %s
+                    """,
+                    (limit,),
+                )
+                return list(cur.fetchall())
+
+    return flight_cache.respond(request, ("flights", limit), load, "No flights found")
+
+
+@app.get("/flights/route/{source}/{destination}")
+def get_flights_by_route(
+    request: Request,
+    source: str,
+    destination: str,
+    depart_after: Optional[str] = None,
+    depart_before: Optional[str] = None,
+):
+    window_sql, window_params = _departure_window(depart_after, depart_before)
+
+    def load():
+        with _connect() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                try:
+                    cur.execute(
+                        f"""
+                        SELECT
+                            flight_number AS "flightNumber",
+                            airline,
+                            source,
+                            destination,
+                            departure,
+                            arrival
+                        FROM flights
+                        WHERE LOWER(source) = LOWER(%s) AND LOWER(destination) = LOWER(%s){window_sql}
+                        ORDER BY departure_at, flight_number
+                        """,
+                        (source, destination, *window_params),
+                    )
+                except psycopg2.DataError:
+                    raise HTTPException(status_code=422, detail="depart_after/depart_before must be timestamps")
+                return list(cur.fetchall()) or NOT_FOUND
+
+    key = ("route", source.lower(), destination.lower(), *window_params)
+    return flight_cache.respond(request, key, load, "No flights found for this route")
+
+
+# Bulk upsert payload fields: (field, column, type), named as /flights returns them.
+FLIGHT_BULK_FIELDS = [
+    ("flightNumber", "flight_number", "text"),
+    ("airline", "airline", "text"),
+    ("source", "source", "text"),
+    ("destination", "destination", "text"),
+    ("departure", "departure", "text"),
+    ("arrival", "arrival", "text"),
+]
+
+
+@app.post("/flights/bulk")
+async def bulk_upsert_flights(request: Request):
+    """Upsert a batch of flights: a JSON array of objects shaped like /flights rows, or text/csv with a header row.
+
+    The batch is applied atomically through COPY into a staging table and
+    one INSERT ... ON CONFLICT; the response reports counts and timings.
+    """
+    spool, fmt, names = await read_batch(request, FLIGHT_BULK_FIELDS)
+    result = await asyncio.to_thread(
+        upsert, _connect, "flights", "flight_number", FLIGHT_BULK_FIELDS, spool, fmt, names
+    )
+    flight_cache.invalidate()
+    print(
+        f"Bulk upsert: {result['received']} flights received, {result['inserted']} inserted, "
+        f"{result['updated']} updated in {result['timing']['totalMs']} ms"
+    )
+    return result
+
+
+def _departure_window(depart_after: Optional[str], depart_before: Optional[str]):
+    """SQL conditions and parameters for an inclusive window on departure_at.
+
+    The conditions range-scan the (source, destination, departure_at) index.
+    """
+    sql, params = "", []
+    if depart_after:
+        sql += " AND departure_at >= %s::timestamptz"
+        params.append(depart_after)
+    if depart_before:
+        sql += " AND departure_at <= %s::timestamptz"
+        params.append(depart_before)
+    return sql, params
+
+
+# Longest `days` window accepted; anything longer is all of the data anyway (and would overflow timedelta).
+MAX_WINDOW_DAYS = 36500
+
+
+def _interaction_window(since: Optional[str], until: Optional[str], days: Optional[float]):
+    """SQL condition and parameters for an inclusive window on interaction ts.
+
+    Only the monthly partitions the bounds overlap are scanned.
+    """
+    conditions, params = [], []
+    if days is not None:
+        conditions.append("ts >= %s")
+        params.append(datetime.now(timezone.utc) - timedelta(days=days))
+    if since:
+        conditions.append("ts >= %s::timestamptz")
+        params.append(since)
+    if until:
+        conditions.append("ts <= %s::timestamptz")
+        params.append(until)
+    return " AND ".join(conditions) or "TRUE", params
 
 
 @app.get("/users")
-async def get_users(limit: int = 100):
-    with _connect() as conn:
+def get_users(
+    limit: int = 100,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    days: Optional[float] = Query(None, gt=0, le=MAX_WINDOW_DAYS),
+    consistent: bool = False,
+):
+    where, params = _interaction_window(since, until, days)
+    with db.read(consistent) as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT
-                    user_id AS "userId",
-                    flight_number AS "flightNumber",
-                    interaction_type AS "interactionType",
-                    ts AS "timestamp",
-                    rating
-                FROM user_interactions
-                ORDER BY id
-                LIMIT %s
-                """,
-                (limit,),
-            )
+            try:
+                cur.execute(
+                    f"""
+                    SELECT
+                        user_id AS "userId",
+                        flight_number AS "flightNumber",
+                        interaction_type AS "interactionType",
+                        ts AS "timestamp",
+                        rating
+                    FROM user_interactions
+                    WHERE {where}
+                    ORDER BY id
+                    LIMIT %s
+                    """,
+                    (*params, limit),
+                )
+            except psycopg2.DataError:
+                raise HTTPException(status_code=422, detail="since/until must be timestamps")
             return list(cur.fetchall())
 
 
+# Bulk exports (see export.py): same columns as the JSON endpoints, with
+# interaction timestamps as epoch seconds.
+USER_EXPORT_COLUMNS = [
+    ("userId", "user_id", "text"),
+    ("flightNumber", "flight_number", "text"),
+    ("interactionType", "interaction_type", "text"),
+    ("timestamp", "EXTRACT(EPOCH FROM ts)", "float8"),
+    ("rating", "rating", "float4"),
+]
+FLIGHT_EXPORT_COLUMNS = [
+    ("flightNumber", "flight_number", "text"),
+    ("airline", "airline", "text"),
+    ("source", "source", "text"),
+    ("destination", "destination", "text"),
+    ("departure", "departure", "text"),
+    ("arrival", "arrival", "text"),
+]
+
+
+# Catalog row as the catalog endpoints return it; change-feed upserts use the same shape.
+FLIGHT_COLUMNS = 'flight_number AS "flightNumber", airline, source, destination, departure, arrival'
+
+
+@app.get("/changes/head")
+def changes_head():
+    """Id of the latest catalog change; subscribe from here after a full catalog load."""
+    return {"id": head(_connect, "flights")}
+
+
+@app.get("/changes")
+async def catalog_changes(request: Request, since: Optional[int] = None):
+    """Server-Sent Events stream of flight upserts and deletes after change `since`.
+
+    Without `since` (or a `Last-Event-ID` header) the stream starts at the current head.
+    """
+    last_event_id = request.headers.get("last-event-id", "")
+    if since is None and last_event_id.isdigit():
+        since = int(last_event_id)
+    return change_feed(_connect, "flights", "flight_number", FLIGHT_COLUMNS, since, listen=db.listen)
+
+
+@app.get("/users/export")
+def export_users(
+    format: str = "csv",
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    days: Optional[float] = Query(None, gt=0, le=MAX_WINDOW_DAYS),
+    consistent: bool = False,
+):
+    """Interactions, as CSV or as a NumPy .npz of typed columns, streamed from COPY.
+
+    `since` / `until` (inclusive timestamps) or `days` (the last n days) limit
+    the export to a time window.
+    """
+    where, params = _interaction_window(since, until, days)
+    try:
+        return export(_reader(consistent), "user_interactions", USER_EXPORT_COLUMNS, format, where, params)
+    except psycopg2.DataError:
+        raise HTTPException(status_code=422, detail="since/until must be timestamps")
+
+
+@app.get("/flights/export")
+def export_flights(format: str = "csv", consistent: bool = False):
+    """Every flight, as CSV or as a NumPy .npz of dictionary-encoded columns."""
+    return export(_reader(consistent), "flights", FLIGHT_EXPORT_COLUMNS, format)
+
+
+@app.get("/codes")
+def get_codes(request: Request):
+    """Every distinct source and destination code, for the gateway's code registry."""
+    def load():
+        with _connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT source FROM flights
+                    UNION
+                    SELECT destination FROM flights
+                    ORDER BY 1
+                    """
+                )
+                return {"codes": [row[0] for row in cur.fetchall() if row[0]]}
+
+    return flight_cache.respond(request, ("codes",), load, "No codes found")
+
+
 @app.get("/health")
 def health():
-    return {"status": "healthy"}
+    return {"status": "healthy", "database": db.status(), "tracing": tracer.stats()}
+
+
+@app.get("/traces")
+def traces(min_ms: float = TRACE_SLOW_MS, limit: int = 20):
+    """Recent requests that took at least `min_ms`, newest first, with their spans."""
+    return {"minMs": min_ms, "traces": tracer.slow_traces(min_ms, max(1, min(limit, 200)))}
+
+
+@app.get("/traces/{trace_id}")
+def trace(trace_id: str):
+    """The spans this service holds for one trace."""
+    return {"traceId": trace_id, "spans": tracer.trace(trace_id)}
@@ -0,0 +1,165 @@
+"""Interaction tables range-partitioned by month on a TIMESTAMPTZ `ts`.
+
+The parent holds no rows itself: each calendar month (UTC) is a partition
+named `{table}_pYYYYMM`, and `{table}_default` catches rows whose month has
+no partition yet. Queries with a bound on `ts` only scan the partitions
+that overlap it, so a 180-day training export reads about seven months,
+not the whole history.
+
+`maintain_partitions` runs at data-service startup and then periodically:
+
+- it creates the partitions from the current month to `months_ahead`
+  months ahead, plus one for every month parked in the default partition
+  (those rows move in);
+- with `keep_months`, partitions that ended before the start of the month
+  `keep_months` months back are detached (left as plain tables, e.g. for
+  archiving) or dropped.
+
+A table created before partitioning (TEXT `ts`) is migrated in place on
+first start: renamed, copied into the partitioned table with `ts` parsed as
+a timestamp (unparseable rows are skipped and reported), then dropped.
+"""
+from typing import Callable, List, Sequence, Tuple
+
+# (column, type and constraints) of the columns besides id and ts.
+ColumnDef = Tuple[str, str]
+
+FUNCTIONS_SQL = """
+CREATE OR REPLACE FUNCTION parse_timestamp(value TEXT) RETURNS TIMESTAMPTZ AS $$
+BEGIN
+  RETURN value::timestamptz;
+EXCEPTION WHEN others THEN
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- Creates the partition of `parent` for the month (UTC) starting at `month`,
+-- moving that month's rows out of the default partition; false if it exists.
+CREATE OR REPLACE FUNCTION create_month_partition(parent TEXT, month DATE) RETURNS BOOLEAN AS $$
+DECLARE
+  first_day DATE := date_trunc('month', month)::date;
+  lower_bound TIMESTAMPTZ := first_day::timestamp AT TIME ZONE 'UTC';
+  upper_bound TIMESTAMPTZ := (first_day + interval '1 month')::timestamp AT TIME ZONE 'UTC';
+  part TEXT := parent || '_p' || to_char(first_day, 'YYYYMM');
+BEGIN
+  IF to_regclass(part) IS NOT NULL THEN
+    RETURN FALSE;
+  END IF;
+  EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS)', part, parent);
+  EXECUTE format(
+    'WITH moved AS (DELETE FROM %I WHERE ts >= %L AND ts < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+    parent || '_default', lower_bound, upper_bound, part
+  );
+  EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', parent, part, lower_bound, upper_bound);
+  RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Creates upcoming and parked-row partitions and applies retention; one row per action taken.
+CREATE OR REPLACE FUNCTION maintain_partitions(parent TEXT, months_ahead INT, keep_months INT, drop_old BOOLEAN)
+RETURNS TABLE (action TEXT, partition_name TEXT) AS $$
+DECLARE
+  this_month DATE := date_trunc('month', now() AT TIME ZONE 'UTC')::date;
+  months DATE[];
+  parked DATE[];
+  month DATE;
+  part TEXT;
+BEGIN
+  -- One maintainer per table at a time (several workers may run this).
+  PERFORM pg_advisory_xact_lock(hashtext('maintain_partitions:' || parent));
+  SELECT array_agg(m::date) INTO months
+  FROM generate_series(this_month::timestamp, this_month + make_interval(months => months_ahead), interval '1 month') m;
+  EXECUTE format(
+    'SELECT array_agg(DISTINCT date_trunc(''month'', ts AT TIME ZONE ''UTC'')::date) FROM %I', parent || '_default'
+  ) INTO parked;
+  FOREACH month IN ARRAY months || COALESCE(parked, '{}')
+  LOOP
+    IF create_month_partition(parent, month) THEN
+      action := 'created';
+      partition_name := parent || '_p' || to_char(month, 'YYYYMM');
+      RETURN NEXT;
+    END IF;
+  END LOOP;
+
+  IF keep_months > 0 THEN
+    FOR part IN
+      SELECT child.relname FROM pg_inherits
+      JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+      WHERE pg_inherits.inhparent = parent::regclass
+        AND child.relname ~ ('^' || parent || '_p[0-9]{6}$')
+        AND to_date(right(child.relname, 6), 'YYYYMM') < this_month - make_interval(months => keep_months)
+      ORDER BY child.relname
+    LOOP
+      IF drop_old THEN
+        EXECUTE format('DROP TABLE %I', part);
+        action := 'dropped';
+      ELSE
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, part);
+        action := 'detached';
+      END IF;
+      partition_name := part;
+      RETURN NEXT;
+    END LOOP;
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def partitioned_sql(table: str, columns: Sequence[ColumnDef]) -> str:
+    """Idempotent DDL for `table` partitioned by month on `ts`; migrates an unpartitioned `table`."""
+    definitions = "".join(f"  {name} {definition},\n" for name, definition in columns)
+    names = ", ".join(name for name, _ in columns)
+    return f"""{FUNCTIONS_SQL}
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('{table}') AND relkind = 'r') THEN
+    ALTER TABLE {table} RENAME TO {table}_unpartitioned;
+  END IF;
+END $$;
+
+CREATE TABLE IF NOT EXISTS {table} (
+  id BIGSERIAL,
+{definitions}  ts TIMESTAMPTZ NOT NULL,
+  PRIMARY KEY (id, ts)
+) PARTITION BY RANGE (ts);
+
+CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;
+
+DO $$
+DECLARE
+  months DATE[];
+  month DATE;
+  skipped BIGINT;
+BEGIN
+  IF to_regclass('{table}_unpartitioned') IS NULL THEN
+    RETURN;
+  END IF;
+  SELECT array_agg(DISTINCT date_trunc('month', parse_timestamp(ts) AT TIME ZONE 'UTC')::date) INTO months
+  FROM {table}_unpartitioned
+  WHERE parse_timestamp(ts) IS NOT NULL;
+  FOREACH month IN ARRAY COALESCE(months, '{{}}')
+  LOOP
+    PERFORM create_month_partition('{table}', month);
+  END LOOP;
+  INSERT INTO {table} (id, {names}, ts)
+  SELECT id, {names}, parse_timestamp(ts) FROM {table}_unpartitioned WHERE parse_timestamp(ts) IS NOT NULL;
+  SELECT COUNT(*) INTO skipped FROM {table}_unpartitioned WHERE parse_timestamp(ts) IS NULL;
+  IF skipped > 0 THEN
+    RAISE WARNING '{table}: % rows with unparseable timestamps were not migrated', skipped;
+  END IF;
+  PERFORM setval(pg_get_serial_sequence('{table}', 'id'), GREATEST((SELECT MAX(id) FROM {table}), 1));
+  DROP TABLE {table}_unpartitioned;
+END $$;
+"""
+
+
+def maintain(connect: Callable, table: str, months_ahead: int, keep_months: int, drop_old: bool) -> List[Tuple[str, str]]:
+    """Run `maintain_partitions` for `table`; the (action, partition) pairs it took."""
+    with connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT action, partition_name FROM maintain_partitions(%s, %s, %s, %s)",
+                (table, months_ahead, keep_months, drop_old),
+            )
+            return [tuple(row) for row in cur.fetchall()]
@@ -0,0 +1,263 @@
+"""Connection pools for the primary and optional read replicas.
+
+Writes, DDL, the catalog caches and the change feed use the primary. Reads
+that tolerate replication lag (the bulk exports and the interaction
+listing) go round-robin to the replicas in `DATABASE_REPLICA_URLS`:
+
+- a replica that fails to connect, or whose connection breaks in use, is
+  ejected for `eject_seconds` and its idle connections are dropped;
+- a replica whose pool is exhausted is skipped for that read rather than
+  waited on;
+- with `max_lag_seconds`, a replica that is further behind the primary is
+  skipped until it catches up (re-checked at most every
+  `lag_check_seconds`);
+- with no healthy replica, reads fall back to the primary.
+
+Read-your-writes is opt-in: `read(consistent=True)` uses the primary.
+
+Connections are in autocommit mode with UTC as the session time zone (naive
+timestamps are read as UTC). Both `with connect() as conn:` and
+`conn = connect(); ...; conn.close()` hand them back to their pool, reset to
+that state.
+"""
+import itertools
+import threading
+import time
+from typing import Callable, List, Optional, Sequence
+
+import psycopg2
+from fastapi import HTTPException
+
+import tracing
+
+# Replay lag of a replica in seconds: 0 when it has replayed all it received or is
+# not replaying at all, NULL while it has not replayed anything yet.
+LAG_SQL = """
+SELECT CASE
+  WHEN NOT pg_is_in_recovery() THEN 0
+  WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+  ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8
+END
+"""
+
+
+def _open(dsn: str):
+    conn = psycopg2.connect(dsn, options="-c TimeZone=UTC")
+    conn.autocommit = True
+    return conn
+
+
+class Pool:
+    """Up to `size` connections to `dsn`; `acquire` blocks up to `timeout` seconds for a free one.
+
+    `try_acquire` waits at most its own `timeout` (by default not at all) and returns None instead.
+    """
+
+    def __init__(self, dsn: str, size: int = 10, timeout: float = 30.0, on_broken: Optional[Callable] = None):
+        self.dsn = dsn
+        self.size = size
+        self.timeout = timeout
+        self.on_broken = on_broken
+        self._idle: List = []
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._in_use = 0
+
+    def acquire(self) -> "PooledConnection":
+        conn = self.try_acquire(self.timeout)
+        if conn is None:
+            raise HTTPException(status_code=503, detail="Database is busy", headers={"Retry-After": "1"})
+        return conn
+
+    def try_acquire(self, timeout: float = 0.0) -> Optional["PooledConnection"]:
+        if not self._slots.acquire(timeout=timeout):
+            return None
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None or conn.closed:
+                conn = _open(self.dsn)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+        return PooledConnection(self, conn)
+
+    def release(self, conn) -> None:
+        try:
+            if not conn.closed:
+                try:
+                    # Drops an open transaction and session settings (isolation, read-only, SET ...).
+                    conn.reset()
+                    conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT", autocommit=True)
+                except psycopg2.Error:
+                    conn.close()
+            if conn.closed:
+                if self.on_broken is not None:
+                    self.on_broken()
+                return
+            with self._lock:
+                self._idle.append(conn)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def clear(self) -> None:
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def in_use(self) -> int:
+        return self._in_use
+
+
+class PooledConnection:
+    """A psycopg2 connection that goes back to its pool on `close()` or at the end of a `with` block."""
+
+    def __init__(self, pool: Pool, conn):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_conn", conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            # psycopg2's own `with conn:` commits or rolls back (and keeps the connection open).
+            if not self._conn.closed:
+                self._conn.__exit__(exc_type, exc, tb)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        conn = self._conn
+        if conn is None:
+            return
+        object.__setattr__(self, "_conn", None)
+        self._pool.release(conn)
+
+
+class Replica:
+    def __init__(self, index: int, dsn: str, size: int, timeout: float, eject_seconds: float):
+        self.index = index
+        self.eject_seconds = eject_seconds
+        self.pool = Pool(dsn, size, timeout, on_broken=self.eject)
+        self.ejected_until = 0.0
+        self.lag: Optional[float] = None
+        self.lag_checked_at = 0.0
+        self.error: Optional[str] = None
+
+    def eject(self, error: str = "connection broke") -> None:
+        self.ejected_until = time.monotonic() + self.eject_seconds
+        self.error = error
+        self.pool.clear()
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+
+class Database:
+    def __init__(
+        self,
+        primary_url: Optional[str],
+        replica_urls: Sequence[str] = (),
+        pool_size: int = 10,
+        replica_pool_size: int = 10,
+        pool_timeout: float = 30.0,
+        eject_seconds: float = 30.0,
+        max_lag_seconds: Optional[float] = None,
+        lag_check_seconds: float = 5.0,
+    ):
+        self.primary_url = primary_url
+        self.primary = Pool(primary_url or "", pool_size, pool_timeout)
+        self.replicas = [
+            Replica(index, url, replica_pool_size, pool_timeout, eject_seconds)
+            for index, url in enumerate(replica_urls)
+        ]
+        self.max_lag_seconds = max_lag_seconds
+        self.lag_check_seconds = lag_check_seconds
+        self._turn = itertools.count()
+
+    def write(self) -> PooledConnection:
+        """A primary connection, for writes and for reads that must see them."""
+        if not self.primary_url:
+            raise RuntimeError("DATABASE_URL is not set")
+        return self.primary.acquire()
+
+    def read(self, consistent: bool = False) -> PooledConnection:
+        """A connection to the next healthy, free replica; the primary when `consistent` or none is usable."""
+        if consistent or not self.replicas:
+            tracing.annotate(database="primary")
+            return self.write()
+        start = next(self._turn)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if not replica.healthy():
+                continue
+            try:
+                # Busy replicas are skipped like unhealthy ones instead of holding the request.
+                conn = replica.pool.try_acquire()
+            except psycopg2.OperationalError as exc:
+                replica.eject(str(exc).strip())
+                continue
+            if conn is None:
+                continue
+            try:
+                lagging = self._lagging(replica, conn)
+            except psycopg2.Error:
+                # A broken connection ejects the replica as it goes back to the pool.
+                lagging = True
+            if lagging:
+                conn.close()
+                continue
+            tracing.annotate(database=f"replica {replica.index}")
+            return conn
+        tracing.annotate(database="primary")
+        return self.write()
+
+    def listen(self):
+        """A dedicated primary connection (not pooled) for LISTEN; replicas do not relay NOTIFY."""
+        if not self.primary_url:
+            raise RuntimeError("DATABASE_URL is not set")
+        return _open(self.primary_url)
+
+    def _lagging(self, replica: Replica, conn: PooledConnection) -> bool:
+        if self.max_lag_seconds is None:
+            return False
+        now = time.monotonic()
+        if now - replica.lag_checked_at >= self.lag_check_seconds:
+            with conn.cursor() as cur:
+                cur.execute(LAG_SQL)
+                lag = cur.fetchone()[0]
+            replica.lag = None if lag is None else float(lag)
+            replica.lag_checked_at = now
+        return replica.lag is None or replica.lag > self.max_lag_seconds
+
+    def status(self) -> dict:
+        """Pool usage and replica health, for /health."""
+        now = time.monotonic()
+        return {
+            "primary": {"inUse": self.primary.in_use(), "size": self.primary.size},
+            "replicas": [
+                {
+                    "index": replica.index,
+                    "healthy": replica.healthy(),
+                    "ejectedForSeconds": round(max(replica.ejected_until - now, 0.0), 1),
+                    "lagSeconds": replica.lag,
+                    "lastError": replica.error,
+                    "inUse": replica.pool.in_use(),
+                    "size": replica.pool.size,
+                }
+                for replica in self.replicas
+            ],
+        }
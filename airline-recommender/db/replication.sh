@@ -0,0 +1,5 @@
+#!/bin/bash
+# Lets the standby of docker-compose.replica.yml stream WAL from this server.
+# Init scripts only run on an empty data volume; on an existing one, append
+# the line to pg_hba.conf by hand and reload.
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -0,0 +1,227 @@
+"""Implicit-feedback ALS over a sparse user x item confidence matrix.
+
+Every interaction counts, not just rated bookings: each one adds its type's
+weight to r_ui, and the model fits preference p_ui = [r_ui > 0] with
+confidence c_ui = 1 + alpha * r_ui (Hu, Koren & Volinsky, 2008). Each
+half-step solves the regularized least-squares systems of all users (or
+items) with a few conjugate-gradient iterations, warm-started from the
+previous factors, run on blocks of rows at once as NumPy/SciPy array
+operations; the dense per-user normal equations are never formed.
+
+Row blocks are independent within a half-step, so they are solved on a
+thread pool: the heavy lifting happens in NumPy/SciPy kernels that release
+the GIL, and the result does not depend on the number of workers.
+
+`fit` can also be warm-started from earlier factors and told to re-solve
+only some users and items (those with new interactions); every other row
+stays fixed, so the work scales with the rows re-solved.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+DEFAULT_WEIGHTS = {"View": 1.0, "Search": 2.0, "Book": 8.0}
+
+
+def parse_weights(spec: Optional[str]) -> Dict[str, float]:
+    """Parse "View=1,Search=2,Book=8"; types left out keep their default weight."""
+    weights = dict(DEFAULT_WEIGHTS)
+    for part in (spec or "").split(","):
+        if not part.strip():
+            continue
+        name, _, value = part.partition("=")
+        weights[name.strip()] = float(value)
+    return weights
+
+
+def interaction_matrix(
+    user_codes: np.ndarray,
+    item_index: np.ndarray,
+    weights: np.ndarray,
+    n_users: int,
+    n_items: int,
+) -> sparse.csr_matrix:
+    """Summed interaction weight r_ui per (user, item); repeated interactions add up.
+
+    `weights` holds each row's interaction-type weight. Rows with a negative
+    user code or item index (unknown ids) or a zero weight are dropped.
+    """
+    keep = (user_codes >= 0) & (item_index >= 0) & (weights > 0)
+    matrix = sparse.coo_matrix(
+        (weights[keep], (user_codes[keep], item_index[keep])),
+        shape=(n_users, n_items),
+        dtype=np.float32,
+    ).tocsr()
+    matrix.sum_duplicates()
+    return matrix
+
+
+class ImplicitALS:
+    def __init__(
+        self,
+        factors: int = 32,
+        regularization: float = 0.05,
+        alpha: float = 2.0,
+        iterations: int = 15,
+        cg_steps: int = 3,
+        block_size: int = 4096,
+        workers: Optional[int] = None,
+        tolerance: float = 1e-4,
+        seed: int = 0,
+    ):
+        self.factors = factors
+        self.regularization = regularization
+        self.alpha = alpha
+        self.iterations = iterations
+        self.cg_steps = cg_steps
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self.tolerance = tolerance
+        self.seed = seed
+        # Objective after each iteration of the last fit().
+        self.loss_history = []
+
+    def fit(
+        self,
+        interactions: sparse.csr_matrix,
+        user_factors: Optional[np.ndarray] = None,
+        item_factors: Optional[np.ndarray] = None,
+        users: Optional[np.ndarray] = None,
+        items: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (user_factors, item_factors) for a matrix of summed interaction weights.
+
+        Given factors are a warm start. With `users`/`items` (row indices) only
+        those rows are re-solved; the objective is then not tracked, since
+        computing it would cost as much as a full iteration.
+        """
+        confidence = interactions.astype(np.float32, copy=True)
+        confidence.data = 1.0 + self.alpha * confidence.data
+        by_user = confidence.tocsr()
+        by_item = confidence.T.tocsr()
+
+        rng = np.random.default_rng(self.seed)
+        n_users, n_items = confidence.shape
+        scale = 0.01
+        if user_factors is None:
+            user_factors = rng.standard_normal((n_users, self.factors)) * scale
+        if item_factors is None:
+            item_factors = rng.standard_normal((n_items, self.factors)) * scale
+        user_factors = np.array(user_factors, dtype=np.float32)
+        item_factors = np.array(item_factors, dtype=np.float32)
+        partial = users is not None or items is not None
+
+        self.loss_history = []
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="als") as pool:
+            for _ in range(self.iterations):
+                self._solve(pool, by_user, item_factors, user_factors, users)
+                self._solve(pool, by_item, user_factors, item_factors, items)
+                if partial:
+                    continue
+                self.loss_history.append(self.loss(by_user, user_factors, item_factors, pool))
+                if self.converged:
+                    break
+        return user_factors, item_factors
+
+    @property
+    def converged(self) -> bool:
+        """True once an iteration improved the objective by less than `tolerance` (relative)."""
+        if len(self.loss_history) < 2:
+            return False
+        previous, current = self.loss_history[-2], self.loss_history[-1]
+        return previous - current <= self.tolerance * abs(previous)
+
+    def loss(
+        self,
+        confidence: sparse.csr_matrix,
+        user_factors: np.ndarray,
+        item_factors: np.ndarray,
+        pool: Optional[ThreadPoolExecutor] = None,
+    ) -> float:
+        """The weighted least-squares objective, without materializing the dense score matrix.
+
+        sum_ui c_ui (p_ui - s_ui)^2 splits into sum over all pairs of s_ui^2
+        (a trace of two small Gram matrices) plus a correction on the nonzeros,
+        summed one block of rows at a time (on `pool`, when given).
+        """
+        count = confidence.shape[0]
+
+        def observed_block(start: int) -> float:
+            block = confidence[start:min(start + self.block_size, count)]
+            rows = start + np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+            scores = np.einsum("ij,ij->i", user_factors[rows], item_factors[block.indices], dtype=np.float64)
+            return float(np.sum(block.data * (1.0 - scores) ** 2 - scores ** 2))
+
+        starts = range(0, count, self.block_size)
+        observed = sum(pool.map(observed_block, starts) if pool is not None else map(observed_block, starts))
+        dense = float(np.sum((user_factors.T @ user_factors) * (item_factors.T @ item_factors), dtype=np.float64))
+        penalty = self.regularization * float(
+            np.sum(np.square(user_factors, dtype=np.float64)) + np.sum(np.square(item_factors, dtype=np.float64))
+        )
+        return dense + observed + penalty
+
+    def _solve(
+        self,
+        pool: ThreadPoolExecutor,
+        confidence: sparse.csr_matrix,
+        fixed: np.ndarray,
+        solved: np.ndarray,
+        rows: Optional[np.ndarray] = None,
+    ) -> None:
+        """Update the `rows` (default: all) of `solved` in place; blocks of rows are solved concurrently."""
+        gram = fixed.T @ fixed + self.regularization * np.eye(self.factors, dtype=np.float32)
+        count = confidence.shape[0] if rows is None else len(rows)
+
+        def solve_block(start: int) -> None:
+            if rows is None:
+                block = slice(start, min(start + self.block_size, count))
+            else:
+                block = rows[start:start + self.block_size]
+            solved[block] = _cg_block(confidence[block], fixed, gram, solved[block], self.cg_steps)
+
+        # list() re-raises the first exception from any block.
+        list(pool.map(solve_block, range(0, count, self.block_size)))
+
+
+def _cg_block(
+    confidence: sparse.csr_matrix,
+    fixed: np.ndarray,
+    gram: np.ndarray,
+    x: np.ndarray,
+    steps: int,
+) -> np.ndarray:
+    """A few batched conjugate-gradient steps on (Y^T C_u Y + lambda I) x_u = Y^T C_u p_u.
+
+    `gram` is Y^T Y + lambda I; the sparse part Y^T (C_u - I) Y is only ever
+    applied to vectors, so each row costs O(nnz_u * factors) per step.
+    """
+    rows = np.repeat(np.arange(confidence.shape[0]), np.diff(confidence.indptr))
+    fixed_nz = fixed[confidence.indices]
+    extra = confidence.data - 1.0
+
+    def apply(v: np.ndarray) -> np.ndarray:
+        weighted = np.einsum("ij,ij->i", fixed_nz, v[rows]) * extra
+        correction = sparse.csr_matrix((weighted, confidence.indices, confidence.indptr), shape=confidence.shape)
+        return v @ gram + correction @ fixed
+
+    x = np.array(x, dtype=np.float32)
+    residual = confidence @ fixed - apply(x)
+    direction = residual.copy()
+    norm = np.einsum("ij,ij->i", residual, residual)
+    for _ in range(steps):
+        active = norm > 1e-10
+        if not active.any():
+            break
+        step_dir = apply(direction)
+        curvature = np.einsum("ij,ij->i", direction, step_dir)
+        step = np.divide(norm, curvature, out=np.zeros_like(norm), where=active & (curvature > 0))
+        x += step[:, None] * direction
+        residual -= step[:, None] * step_dir
+        new_norm = np.einsum("ij,ij->i", residual, residual)
+        beta = np.divide(new_norm, norm, out=np.zeros_like(norm), where=active)
+        direction = residual + beta[:, None] * direction
+        norm = new_norm
+    return x
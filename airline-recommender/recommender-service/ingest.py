@@ -0,0 +1,192 @@
+"""Columnar ingestion of the data-service bulk exports.
+
+The trainers load the catalog and the interaction log from the
+data-service's `/.../export` endpoints, which serve the same columns in two
+formats. Both are decoded into one layout of typed arrays:
+
+- text columns become `{name}.codes` (int32, `MISSING` for null) plus a
+  `{name}.vocab`
+- number columns become `{name}` (NaN for null)
+
+npz (the default) is that layout as sent, already dictionary-encoded by
+Postgres, so loading it is one read of the payload. csv is parsed chunk by
+chunk by pandas' C reader and each chunk is dictionary-encoded as it
+arrives. No per-row dicts, DataFrames or trainsets are built either way,
+and everything downstream (trending, ALS, the SVD booking subset) selects
+rows with boolean masks over these arrays.
+"""
+import io
+from typing import Dict, List, Mapping, NamedTuple, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import requests
+
+import tracing
+from catalog import MISSING, Catalog, StringColumn
+
+CHUNK_ROWS = 100_000
+# Bounds each wait for the next bytes, not the whole export; a stalled data-service fails the load.
+READ_TIMEOUT_SECONDS = 120.0
+
+INTERACTION_NUMBERS = {"timestamp": np.float64, "rating": np.float32}
+
+
+class Interactions(NamedTuple):
+    user_ids: np.ndarray
+    users: np.ndarray
+    item_ids: np.ndarray
+    items: np.ndarray
+    type_names: np.ndarray
+    types: np.ndarray
+    ratings: np.ndarray
+    timestamps: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def item_index(self, catalog: Catalog) -> np.ndarray:
+        """Catalog index per row (`MISSING` for unknown items); one lookup per distinct item."""
+        lookup = np.append(catalog.indices_of(self.item_ids), MISSING)
+        # Code -1 picks the appended MISSING.
+        return lookup[self.items]
+
+    def of_type(self, name: str) -> np.ndarray:
+        match = np.flatnonzero(self.type_names == name)
+        if not len(match):
+            return np.zeros(len(self), dtype=bool)
+        return self.types == match[0]
+
+    def type_weights(self, weights: Mapping[str, float]) -> np.ndarray:
+        """Per-row weight of each interaction's type (0 for types without one)."""
+        lookup = np.array([weights.get(name, 0.0) for name in self.type_names.tolist()] + [0.0], dtype=np.float32)
+        return lookup[self.types]
+
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self)
+
+    def rows(self, mask: np.ndarray) -> "Interactions":
+        """The rows selected by `mask`, over the same vocabularies."""
+        return Interactions(
+            user_ids=self.user_ids,
+            users=self.users[mask],
+            item_ids=self.item_ids,
+            items=self.items[mask],
+            type_names=self.type_names,
+            types=self.types[mask],
+            ratings=self.ratings[mask],
+            timestamps=self.timestamps[mask],
+        )
+
+
+def concat_interactions(parts: Sequence[Interactions]) -> Interactions:
+    """The rows of `parts` in order, recoded over merged vocabularies."""
+
+    def merge(vocabs: List[np.ndarray], codes: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        vocab, inverse = np.unique(np.concatenate(vocabs), return_inverse=True)
+        recoded, start = [], 0
+        for part_vocab, part_codes in zip(vocabs, codes):
+            # Code -1 (null) picks the appended MISSING.
+            lookup = np.append(inverse[start:start + len(part_vocab)], MISSING).astype(np.int32)
+            recoded.append(lookup[part_codes])
+            start += len(part_vocab)
+        return vocab, np.concatenate(recoded)
+
+    user_ids, users = merge([p.user_ids for p in parts], [p.users for p in parts])
+    item_ids, items = merge([p.item_ids for p in parts], [p.items for p in parts])
+    type_names, types = merge([p.type_names for p in parts], [p.types for p in parts])
+    return Interactions(
+        user_ids=user_ids,
+        users=users,
+        item_ids=item_ids,
+        items=items,
+        type_names=type_names,
+        types=types,
+        ratings=np.concatenate([p.ratings for p in parts]),
+        timestamps=np.concatenate([p.timestamps for p in parts]),
+    )
+
+
+def fetch_interactions(url: str, user_key: str, item_key: str, fmt: str = "npz") -> Interactions:
+    text = (user_key, item_key, "interactionType")
+    arrays = fetch_arrays(url, fmt, text, INTERACTION_NUMBERS)
+    return Interactions(
+        user_ids=arrays[f"{user_key}.vocab"],
+        users=arrays[f"{user_key}.codes"],
+        item_ids=arrays[f"{item_key}.vocab"],
+        items=arrays[f"{item_key}.codes"],
+        type_names=arrays["interactionType.vocab"],
+        types=arrays["interactionType.codes"],
+        ratings=arrays["rating"].astype(np.float32, copy=False),
+        timestamps=arrays["timestamp"].astype(np.float64, copy=False),
+    )
+
+
+def fetch_catalog(url: str, id_key: str, fields: Sequence[str], fmt: str = "npz") -> Catalog:
+    arrays = fetch_arrays(url, fmt, (id_key, *fields), {})
+    ids = arrays[f"{id_key}.vocab"][arrays[f"{id_key}.codes"]]
+    columns = {field: StringColumn(arrays[f"{field}.codes"], arrays[f"{field}.vocab"]) for field in fields}
+    return Catalog(ids, columns)
+
+
+def fetch_arrays(url: str, fmt: str, text: Sequence[str], numbers: Mapping[str, type]) -> Dict[str, np.ndarray]:
+    with tracing.span("fetch export", url=url, format=fmt) as span:
+        response = requests.get(
+            url,
+            params={"format": fmt},
+            stream=True,
+            timeout=(10, READ_TIMEOUT_SECONDS),
+            headers=tracing.headers(),
+        )
+        response.raise_for_status()
+        if fmt == "npz":
+            span.set(bytes=len(response.content))
+            with np.load(io.BytesIO(response.content), allow_pickle=False) as payload:
+                return {name: payload[name] for name in payload.files}
+        response.raw.decode_content = True
+        return read_csv(response.raw, text, numbers)
+
+
+def read_csv(stream, text: Sequence[str], numbers: Mapping[str, type]) -> Dict[str, np.ndarray]:
+    encoders = {column: _Encoder() for column in text}
+    parts: Dict[str, List[np.ndarray]] = {column: [] for column in numbers}
+    dtype = {**{column: object for column in text}, **numbers}
+    for chunk in pd.read_csv(stream, dtype=dtype, chunksize=CHUNK_ROWS):
+        for column, encoder in encoders.items():
+            encoder.add(chunk[column])
+        for column in numbers:
+            parts[column].append(chunk[column].to_numpy())
+
+    arrays = {}
+    for column, encoder in encoders.items():
+        arrays[f"{column}.codes"] = encoder.codes()
+        arrays[f"{column}.vocab"] = encoder.vocab()
+    for column, dtype in numbers.items():
+        arrays[column] = _concat(parts[column], dtype)
+    return arrays
+
+
+class _Encoder:
+    """Dictionary-encodes a string column chunk by chunk into int32 codes."""
+
+    def __init__(self):
+        self._lookup: Dict[str, int] = {}
+        self._codes: List[np.ndarray] = []
+
+    def add(self, values: pd.Series) -> None:
+        # Factorize the chunk in C, then translate only its distinct values.
+        codes, uniques = pd.factorize(values, use_na_sentinel=True)
+        lookup = self._lookup
+        translate = [lookup.setdefault(str(value), len(lookup)) for value in uniques.tolist()]
+        # Code -1 (null) picks the appended MISSING.
+        self._codes.append(np.array(translate + [MISSING], dtype=np.int32)[codes])
+
+    def codes(self) -> np.ndarray:
+        return _concat(self._codes, np.int32)
+
+    def vocab(self) -> np.ndarray:
+        return np.array(list(self._lookup), dtype=str) if self._lookup else np.array([], dtype="U1")
+
+
+def _concat(parts: List[np.ndarray], dtype) -> np.ndarray:
+    return np.concatenate(parts).astype(dtype, copy=False) if parts else np.array([], dtype=dtype)
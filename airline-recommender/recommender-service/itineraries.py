@@ -0,0 +1,190 @@
+"""Multi-leg itinerary search over the catalog's route graph.
+
+`ItineraryIndex` is a time-expanded adjacency index built once per catalog
+version: every leg with a known departure, grouped by departure station and
+sorted by departure time, so the legs that can follow an arrival (between
+the minimum and maximum connection time) are one binary search away. Legs
+are also grouped by (source, destination) station pair, which gives a small
+station graph.
+
+`search` is a best-first search over partial itineraries, ordered by an
+upper bound on the combined score (the mean predicted rating of the legs)
+any completion could reach. The bound comes from the station graph: per
+query, each pair's best leg score, and from that the best score sum of m
+more legs from each station to the destination, ignoring times. A complete
+itinerary is only popped once no partial one can beat it, so results come
+out best first. The number of expansions is capped; when the cap is hit
+the best itineraries found so far are returned.
+"""
+import heapq
+import itertools
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from catalog import MISSING, Catalog, StringColumn
+
+
+class Itinerary(NamedTuple):
+    items: List[int]
+    score: float
+
+
+class ItineraryIndex:
+    """Legs by departure station and time; arrivals default to departures when unknown."""
+
+    def __init__(self, catalog: Catalog, arrival_field: Optional[str] = "arrival"):
+        self._stations: Dict[str, int] = {}
+        source = self._station_codes(catalog.columns.get("source"), len(catalog))
+        destination = self._station_codes(catalog.columns.get("destination"), len(catalog))
+        departures = catalog.departures
+        arrivals = catalog.epoch_times(arrival_field) if arrival_field else np.full(len(catalog), np.nan)
+        arrivals = np.where(np.isnan(arrivals), departures, arrivals)
+
+        legs = np.flatnonzero(
+            (source != MISSING) & (destination != MISSING) & (source != destination) & ~np.isnan(departures)
+        )
+        legs = legs[np.lexsort((departures[legs], source[legs]))]
+        self.items = legs.astype(np.int32)
+        self.sources = source[legs]
+        self.destinations = destination[legs]
+        self.departures = departures[legs]
+        self.arrivals = arrivals[legs]
+        # Legs leaving station s are [offsets[s], offsets[s + 1]).
+        self.offsets = np.searchsorted(self.sources, np.arange(len(self._stations) + 1))
+
+        # Station graph: one edge per (source, destination) pair, with the
+        # legs of each edge contiguous in `_by_edge`.
+        width = max(len(self._stations), 1)
+        keys, edge_of = np.unique(self.sources * width + self.destinations, return_inverse=True)
+        self._edge_sources, self._edge_destinations = np.divmod(keys, width)
+        self._by_edge = np.argsort(edge_of, kind="stable")
+        self._edge_starts = np.searchsorted(edge_of[self._by_edge], np.arange(len(keys)))
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def search(
+        self,
+        source: str,
+        destination: str,
+        scores: np.ndarray,
+        k: int = 5,
+        max_legs: int = 3,
+        min_connection: float = 45 * 60,
+        max_connection: float = 24 * 3600,
+        depart_after: Optional[float] = None,
+        depart_before: Optional[float] = None,
+        max_expansions: int = 20000,
+    ) -> List[Itinerary]:
+        """Top `k` itineraries from `source` to `destination`, best combined score first.
+
+        `scores` holds a predicted rating per catalog index. The departure
+        window (epoch seconds, inclusive) applies to the first leg; each
+        connection must leave between `min_connection` and `max_connection`
+        seconds after the previous leg arrives, and no station is visited twice.
+        """
+        origin = self._stations.get(source.lower())
+        target = self._stations.get(destination.lower())
+        if origin is None or target is None or origin == target or k <= 0 or max_legs <= 0:
+            return []
+
+        leg_scores = np.asarray(scores, dtype=np.float64)[self.items]
+        completions = self._best_completions(leg_scores, target, max_legs)
+        if not np.isfinite(completions[:, origin]).any():
+            return []
+
+        # Each expansion's successors form a batch sorted best first; only
+        # the batch's next candidate sits in the heap, as
+        # (-priority, arrival, tie-breaker, batch, position).
+        heap: list = []
+        counter = itertools.count()
+
+        def extend(path: Tuple[int, ...], total: float, start: int, stop: int, visited: List[int]) -> None:
+            n = len(path) + 1
+            nexts = self.destinations[start:stop]
+            totals = total + leg_scores[start:stop]
+            # The best mean any completion with m more legs could reach; -inf
+            # when the destination is out of reach within the leg limit.
+            priority = np.max([(totals + completions[m, nexts]) / (n + m) for m in range(max_legs - n + 1)], axis=0)
+            allowed = np.isfinite(priority)
+            for station in visited:
+                allowed &= nexts != station
+            keep = np.flatnonzero(allowed)
+            if not len(keep):
+                return
+            keep = keep[np.lexsort((self.arrivals[start + keep], -priority[keep]))]
+            batch = (path, (start + keep).tolist(), priority[keep].tolist(), totals[keep].tolist())
+            push(batch, 0)
+
+        def push(batch, position: int) -> None:
+            leg = batch[1][position]
+            heapq.heappush(heap, (-batch[2][position], self.arrivals[leg], next(counter), batch, position))
+
+        start, stop = self._departing(origin, depart_after, depart_before)
+        extend((), 0.0, start, stop, [origin])
+
+        results: List[Itinerary] = []
+        expansions = 0
+        while heap and len(results) < k and expansions < max_expansions:
+            _, arrival, _, batch, position = heapq.heappop(heap)
+            if position + 1 < len(batch[1]):
+                push(batch, position + 1)
+            prefix, legs, _, totals = batch
+            path, total = prefix + (legs[position],), totals[position]
+            station = int(self.destinations[path[-1]])
+            if station == target:
+                results.append(self._itinerary(path, total))
+                continue
+            expansions += 1
+            start, stop = self._departing(station, arrival + min_connection, arrival + max_connection)
+            extend(path, total, start, stop, [int(self.sources[leg]) for leg in path] + [station])
+
+        if len(results) < k and heap:
+            # Out of expansions: fall back to the complete itineraries still queued.
+            found = sorted(
+                (-priority, self.arrivals[leg], prefix + (leg,), total)
+                for _, _, _, (prefix, legs, priorities, totals), position in heap
+                for leg, priority, total in zip(legs[position:], priorities[position:], totals[position:])
+                if self.destinations[leg] == target
+            )
+            results.extend(self._itinerary(path, total) for _, _, path, total in found[: k - len(results)])
+        return results
+
+    def _best_completions(self, leg_scores: np.ndarray, target: int, max_legs: int) -> np.ndarray:
+        """[m, s]: best score sum of m legs from station s to `target`, ignoring times (-inf if none).
+
+        Paths are not extended past the target: reaching it completes an itinerary.
+        """
+        best = np.full((max_legs + 1, len(self._stations)), -np.inf)
+        best[0, target] = 0.0
+        if not len(leg_scores):
+            return best
+        edge_best = np.maximum.reduceat(leg_scores[self._by_edge], self._edge_starts)
+        for m in range(1, max_legs + 1):
+            np.maximum.at(best[m], self._edge_sources, edge_best + best[m - 1, self._edge_destinations])
+            best[m, target] = -np.inf
+        return best
+
+    def _itinerary(self, path: Tuple[int, ...], total: float) -> Itinerary:
+        return Itinerary(items=[int(self.items[leg]) for leg in path], score=total / len(path))
+
+    def _departing(self, station: int, after: Optional[float], before: Optional[float]) -> Tuple[int, int]:
+        """Positions of the legs leaving `station` within [after, before]."""
+        lo, hi = int(self.offsets[station]), int(self.offsets[station + 1])
+        times = self.departures[lo:hi]
+        start = lo if after is None else lo + int(np.searchsorted(times, after, side="left"))
+        stop = hi if before is None else lo + int(np.searchsorted(times, before, side="right"))
+        return start, stop
+
+    def _station_codes(self, column: Optional[StringColumn], size: int) -> np.ndarray:
+        """Station ids (case-insensitive, shared by sources and destinations) per catalog index."""
+        if column is None:
+            return np.full(size, MISSING, dtype=np.int64)
+        lookup = np.array(
+            [self._stations.setdefault(value.lower(), len(self._stations)) for value in column.vocab.tolist()]
+            + [MISSING],
+            dtype=np.int64,
+        )
+        # Code -1 (null) picks the appended MISSING.
+        return lookup[column.codes]
@@ -1,142 +1,712 @@
-import requests
+import numpy as np
 import pandas as pd
 from surprise import Dataset, Reader, SVD
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+import math
 import os
+import threading
 import time
-from typing import Optional
+from typing import NamedTuple, Optional
+
+import changes
+import tracing
+from catalog import MISSING, Catalog, reindex
+from fragments import FragmentCache, json_response, splice
+from implicit_als import ImplicitALS, interaction_matrix, parse_weights
+from incremental import Previous, latest, warm_als, warm_svd
+from ingest import Interactions, concat_interactions, fetch_catalog, fetch_interactions
+from itineraries import Itinerary, ItineraryIndex
+from model import FactorModel
+from pages import CursorError, RankedPages, StaleCursor, decode_cursor, encode_cursor, state_digest
+from retrieval import Retrieval
+from shared_model import SharedModelStore, join_arrays, split_arrays
+from timestamps import parse_time
+from tracing import Tracer
+from trending import Trending, decayed_counts
 
 app = FastAPI()
 
 DATA_SERVICE_URL = os.getenv("DATA_SERVICE_URL", "http://data-service:8000")
 
-flight_name_map = {}
-flight_route_map = {}
-flight_mean_rating = {}
-booked_users = set()
-algo = None
-all_flight_ids = []
+# Multi-worker mode: one worker trains, all workers map the same snapshot.
+SHARED_MODEL_DIR = os.getenv("SHARED_MODEL_DIR")
+SHARED_MODEL_POLL_SECONDS = float(os.getenv("SHARED_MODEL_POLL_SECONDS", "2"))
+
+# Cold-start ranking: interactions lose half their weight every half-life.
+TRENDING_HALF_LIFE_DAYS = float(os.getenv("TRENDING_HALF_LIFE_DAYS", "14"))
+
+# "svd" trains Surprise on rated bookings; "als" trains implicit ALS on every interaction.
+MODEL_ENGINE = os.getenv("MODEL_ENGINE", "svd").lower()
+INTERACTION_WEIGHTS = parse_weights(os.getenv("INTERACTION_WEIGHTS"))
+# SVD hyperparameters (Surprise's defaults); compare configs offline with evaluate.py.
+SVD_FACTORS = int(os.getenv("SVD_FACTORS", "100"))
+SVD_EPOCHS = int(os.getenv("SVD_EPOCHS", "20"))
+SVD_REGULARIZATION = float(os.getenv("SVD_REGULARIZATION", "0.02"))
+SVD_LEARNING_RATE = float(os.getenv("SVD_LEARNING_RATE", "0.005"))
+ALS_FACTORS = int(os.getenv("ALS_FACTORS", "32"))
+ALS_ITERATIONS = int(os.getenv("ALS_ITERATIONS", "15"))
+ALS_REGULARIZATION = float(os.getenv("ALS_REGULARIZATION", "0.05"))
+ALS_ALPHA = float(os.getenv("ALS_ALPHA", "2.0"))
+ALS_TOLERANCE = float(os.getenv("ALS_TOLERANCE", "1e-4"))
+# Threads solving ALS row blocks in parallel; 0 means one per CPU.
+TRAIN_WORKERS = int(os.getenv("TRAIN_WORKERS", "0"))
+
+# Retrain every RETRAIN_INTERVAL_SECONDS (0: only at startup and on a change-feed
+# reset). Retrains are warm-started from the serving model and train only on the
+# interactions since its data (see incremental.py), with a full retrain at least
+# every FULL_RETRAIN_HOURS. WARM_START_OVERLAP_SECONDS re-reads a little of the
+# previous data, for interactions that arrived late; WARM_START_REPLAY is the
+# share of older ratings SVD trains on again.
+RETRAIN_INTERVAL_SECONDS = float(os.getenv("RETRAIN_INTERVAL_SECONDS", "0"))
+FULL_RETRAIN_HOURS = float(os.getenv("FULL_RETRAIN_HOURS", "24"))
+WARM_START = os.getenv("WARM_START", "true").lower() not in ("0", "false", "no")
+SVD_WARM_EPOCHS = int(os.getenv("SVD_WARM_EPOCHS", "5"))
+ALS_WARM_ITERATIONS = int(os.getenv("ALS_WARM_ITERATIONS", "2"))
+WARM_START_OVERLAP_SECONDS = float(os.getenv("WARM_START_OVERLAP_SECONDS", "600"))
+WARM_START_REPLAY = float(os.getenv("WARM_START_REPLAY", "0.1"))
+
+# Bulk export format the trainer loads: "npz" (typed arrays) or "csv".
+TRAINING_DATA_FORMAT = os.getenv("TRAINING_DATA_FORMAT", "npz").lower()
+# Train on the interactions of the last n days only (0: all); the data-service
+# then reads just the monthly partitions in that window.
+TRAINING_WINDOW_DAYS = float(os.getenv("TRAINING_WINDOW_DAYS", "0"))
+
+# Follow the data-service change feed to apply catalog edits without a reload.
+CATALOG_CHANGE_FEED = os.getenv("CATALOG_CHANGE_FEED", "true").lower() not in ("0", "false", "no")
+
+# Connecting itineraries: leg limit and allowed layover per connection.
+ITINERARY_MAX_LEGS = int(os.getenv("ITINERARY_MAX_LEGS", "3"))
+ITINERARY_MIN_CONNECTION_MINUTES = float(os.getenv("ITINERARY_MIN_CONNECTION_MINUTES", "45"))
+ITINERARY_MAX_CONNECTION_MINUTES = float(os.getenv("ITINERARY_MAX_CONNECTION_MINUTES", "1440"))
+# Partial itineraries a single search may expand before returning what it has.
+ITINERARY_MAX_EXPANSIONS = int(os.getenv("ITINERARY_MAX_EXPANSIONS", "20000"))
+
+# Scoring precision: float64, float32, or float16 / int8 codes whose best
+# FACTOR_RESCORE x n candidates are re-scored at full precision.
+FACTOR_PRECISION = os.getenv("FACTOR_PRECISION", "float64").lower()
+FACTOR_RESCORE = int(os.getenv("FACTOR_RESCORE", "4"))
+
+# Two-stage ranking: candidates scored per personalized request, and how
+# many of a user's latest items seed them.
+CANDIDATE_BUDGET = int(os.getenv("CANDIDATE_BUDGET", "400"))
+RETRIEVAL_HISTORY_SIZE = int(os.getenv("RETRIEVAL_HISTORY_SIZE", "20"))
+# Leave out items the user already interacted with.
+RECOMMEND_EXCLUDE_SEEN = os.getenv("RECOMMEND_EXCLUDE_SEEN", "false").lower() in ("1", "true", "yes")
+
+# Cursor pagination: how deep a ranked list is kept, and how many lists.
+CURSOR_MAX_RESULTS = int(os.getenv("CURSOR_MAX_RESULTS", "500"))
+CURSOR_CACHE_ENTRIES = int(os.getenv("CURSOR_CACHE_ENTRIES", "4096"))
+
+# Request tracing (see tracing.py): spans kept in memory, optionally appended to
+# TRACE_EXPORT_PATH as JSONL; GET /traces lists requests slower than TRACE_SLOW_MS.
+TRACE_BUFFER_SPANS = int(os.getenv("TRACE_BUFFER_SPANS", "10000"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "").strip() or None
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "500"))
+
+tracer = Tracer("airline-recommender", TRACE_BUFFER_SPANS, TRACE_EXPORT_PATH)
+tracing.install(app, tracer)
+
+FLIGHT_FIELDS = ("airline", "source", "destination", "departure", "arrival")
+
+
+class Serving(NamedTuple):
+    """Everything a request reads, swapped as one object so readers never mix versions."""
+
+    catalog: Catalog
+    model: Optional[FactorModel]
+    # Candidate generators over the model's items (None without a model).
+    retrieval: Optional[Retrieval]
+    # Served to unknown users, and to everyone until the model is ready.
+    trending: Trending
+    ready: bool
+    # Counts publishes (the snapshot version when shared).
+    version: int
+    # Identifies this state's contents in pagination cursors, across workers.
+    digest: str
+    recommend_fragments: FragmentCache
+    route_fragments: FragmentCache
+    itineraries: ItineraryIndex
+    pages: RankedPages
+
+
+def _serving(
+    catalog: Catalog,
+    model: Optional[FactorModel],
+    trending_scores: np.ndarray,
+    ready: bool,
+    version: int,
+    retrieval: Optional[Retrieval] = None,
+) -> Serving:
+    # Fragments and ranked pages are tied to this version; filled on first use.
+    return Serving(
+        catalog=catalog,
+        model=model,
+        retrieval=retrieval,
+        trending=Trending(catalog, trending_scores),
+        ready=ready,
+        version=version,
+        digest=state_digest(
+            {**catalog.to_arrays(), "trending": trending_scores, "ready": np.array([ready])},
+            {
+                **{f"model.{k}": v for k, v in (model.to_arrays() if model is not None else {}).items()},
+                **{f"retrieval.{k}": v for k, v in (retrieval.to_arrays() if retrieval is not None else {}).items()},
+            },
+        ),
+        recommend_fragments=FragmentCache(len(catalog), lambda i: _format_recommendation(catalog, i)),
+        route_fragments=FragmentCache(len(catalog), lambda i: _format_route_item(catalog, i)),
+        itineraries=ItineraryIndex(catalog, arrival_field="arrival"),
+        pages=RankedPages(CURSOR_MAX_RESULTS, CURSOR_CACHE_ENTRIES),
+    )
+
+
+serving = _serving(Catalog.from_records([], "flightNumber", FLIGHT_FIELDS), None, np.zeros(0), False, 0)
+status_detail = "starting"
+
+shared_store = SharedModelStore(SHARED_MODEL_DIR) if SHARED_MODEL_DIR else None
+shared_version = 0
+shared_checked_at = 0.0
+
+# The trainer's last model and its data, for warm starts.
+previous: Optional[Previous] = None
+# The interactions it was trained on; warm retrains fetch only newer ones and merge them in.
+history: Optional[Interactions] = None
+full_trained_at = 0.0
+# Catalog changes applied so far; a retrain that saw some arrive while it ran carries its result over.
+catalog_changes = 0
+training_lock = threading.Lock()
+publish_lock = threading.Lock()
 
-@app.on_event("startup")
-def load_and_train_model():
-    global flight_name_map, flight_route_map, flight_mean_rating, booked_users, algo, all_flight_ids
 
-    for _ in range(10):
+@app.on_event("startup")
+def startup():
+    # Return immediately so the port serves /health (and trending results
+    # once the catalog is in) while data loads and the model trains.
+    threading.Thread(target=_bootstrap, name="model-bootstrap", daemon=True).start()
+
+
+def _bootstrap():
+    global status_detail
+
+    try:
+        if shared_store is not None and not shared_store.try_become_trainer():
+            if _wait_for_shared_snapshot():
+                return
+        since = load_and_train_model()
+        if RETRAIN_INTERVAL_SECONDS > 0:
+            threading.Thread(target=_retrain_forever, name="model-retrain", daemon=True).start()
+        if CATALOG_CHANGE_FEED:
+            _follow_catalog_changes(since)
+    except Exception as e:  # noqa: BLE001
+        status_detail = f"failed: {e}"
+        print(f"Model bootstrap failed: {e}")
+
+
+def _fetch_training_data():
+    global status_detail
+
+    attempt = 0
+    while True:
         try:
-            users = requests.get(f"{DATA_SERVICE_URL}/users").json()
-            flights = requests.get(f"{DATA_SERVICE_URL}/flights").json()
-            break
+            # Read the feed position first: changes made during the load are replayed after it.
+            # The catalog then comes from the primary (not a lagging replica), so it is at least as new.
+            since = changes.head(DATA_SERVICE_URL) if CATALOG_CHANGE_FEED else 0
+            interactions = _fetch_interactions()
+            return interactions, _fetch_catalog(), since
         except Exception as e:
+            attempt += 1
+            status_detail = f"waiting for data-service ({e})"
             print(f"Waiting for data-service... {e}")
-            time.sleep(3)
-    else:
-        raise RuntimeError("data-service did not respond in time")
-
-    flight_name_map = {f["flightNumber"]: f.get("airline", "Unknown") for f in flights if "flightNumber" in f}
-    flight_route_map = {
-        f["flightNumber"]: {
-            "airline": f.get("airline", "Unknown"),
-            "source": f.get("source"),
-            "destination": f.get("destination"),
-            "departure": f.get("departure"),
-            "arrival": f.get("arrival"),
-        }
-        for f in flights
-        if "flightNumber" in f
-    }
-    all_flight_ids = [f["flightNumber"] for f in flights if "flightNumber" in f]
+            time.sleep(min(3 * attempt, 30))
 
-    bookings = [
-        u for u in users
-        if u.get("interactionType") == "Book" and u.get("flightNumber") and u.get("userId") and u.get("rating") not in (None, "", "NaN")
-    ]
 
-    df = pd.DataFrame(bookings)
-    df = df.dropna(subset=["userId", "flightNumber", "rating"])
-    df["rating"] = pd.to_numeric(df["rating"], errors="coerce")
-    df = df.dropna(subset=["rating"])
+def _fetch_catalog() -> Catalog:
+    # With the change feed, from the primary (not a lagging replica): at least as new as the feed position.
+    consistent = "?consistent=true" if CATALOG_CHANGE_FEED else ""
+    return fetch_catalog(
+        f"{DATA_SERVICE_URL}/flights/export{consistent}", "flightNumber", FLIGHT_FIELDS, TRAINING_DATA_FORMAT
+    )
 
-    if not df.empty:
-        flight_mean_rating = df.groupby("flightNumber")["rating"].mean().to_dict()
+
+def _fetch_interactions() -> Interactions:
+    window = f"?days={TRAINING_WINDOW_DAYS:g}" if TRAINING_WINDOW_DAYS > 0 else ""
+    return fetch_interactions(
+        f"{DATA_SERVICE_URL}/users/export{window}", "userId", "flightNumber", TRAINING_DATA_FORMAT
+    )
+
+
+def _fetch_recent(since: float) -> Interactions:
+    """`history` with the interactions from `since` on fetched again and merged in.
+
+    Kept rows from `since` on are replaced by the fetched ones, so rows
+    stored with a timestamp before `since` after the last fetch are only
+    picked up by the next full retrain; the warm-start overlap covers
+    rows that arrive a little late.
+    """
+    if not math.isfinite(since):
+        return _fetch_interactions()
+    since = math.floor(since)
+    stamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(since))
+    recent_rows = fetch_interactions(
+        f"{DATA_SERVICE_URL}/users/export?since={stamp}", "userId", "flightNumber", TRAINING_DATA_FORMAT
+    )
+    with np.errstate(invalid="ignore"):
+        keep = ~(history.timestamps >= since)
+        if TRAINING_WINDOW_DAYS > 0:
+            # Like the export's window: rows without a timestamp fall outside it.
+            keep &= history.timestamps >= time.time() - TRAINING_WINDOW_DAYS * 86400
+    print(f"Fetched {len(recent_rows)} interactions since {stamp}; kept {int(keep.sum())} older ones")
+    return concat_interactions([history.rows(keep), recent_rows])
+
+
+def load_and_train_model() -> int:
+    """Load everything and train from scratch; returns the change-feed position the data was read at."""
+    global status_detail
+
+    with training_lock, tracer.span("load_and_train_model") as span:
+        status_detail = "loading data"
+        interactions, catalog, since = _fetch_training_data()
+        span.set(items=len(catalog), interactions=len(interactions))
+        print(
+            f"Loaded {len(catalog)} flights and {len(interactions)} interactions "
+            f"({interactions.nbytes() / 1e6:.1f} MB)"
+        )
+
+        trending_scores = _trending_scores(catalog, interactions)
+        # A reload (after a change-feed reset) keeps serving the current model until the new one is trained.
+        if not serving.ready:
+            _publish(catalog, None, trending_scores, ready=False)
+
+        status_detail = "training model"
+        model = _train_and_publish(catalog, interactions, trending_scores, warm=False, changes_seen=catalog_changes)
+        if model is None:
+            print("No training data available; airline model not trained.")
+            status_detail = "ready (no training data)"
+            return since
+        status_detail = "ready"
+    return since
+
+
+def retrain_model():
+    """Retrain on fresh interactions while serving; warm-started unless a full retrain is due."""
+    global status_detail
+
+    with training_lock, tracer.span("retrain_model") as span:
+        changes_seen = catalog_changes
+        full_due = time.monotonic() - full_trained_at >= FULL_RETRAIN_HOURS * 3600
+        warm = WARM_START and previous is not None and history is not None and not full_due
+        # The serving catalog is current up to the feed; a fresh export could be ahead of it.
+        catalog = serving.catalog if CATALOG_CHANGE_FEED else _fetch_catalog()
+        # A warm start trains on the recent slice, so it only fetches that; a full retrain fetches everything.
+        if warm:
+            interactions = _fetch_recent(previous.trained_through - WARM_START_OVERLAP_SECONDS)
+        else:
+            interactions = _fetch_interactions()
+        span.set(items=len(catalog), interactions=len(interactions), warm=warm)
+        model = _train_and_publish(catalog, interactions, _trending_scores(catalog, interactions), warm, changes_seen)
+        status_detail = "ready" if model is not None else "ready (no training data)"
+
+
+def _retrain_forever():
+    while True:
+        time.sleep(RETRAIN_INTERVAL_SECONDS)
+        try:
+            retrain_model()
+        except Exception as e:  # noqa: BLE001
+            print(f"Retraining failed: {e}")
+
+
+def _train_and_publish(
+    catalog: Catalog, interactions: Interactions, trending_scores: np.ndarray, warm: bool, changes_seen: int
+) -> Optional[FactorModel]:
+    """Train, publish and return the serving model (None without training data)."""
+    global previous, history, full_trained_at
+
+    started = time.perf_counter()
+    with tracing.span("train", engine=MODEL_ENGINE, warm=warm):
+        if warm:
+            trained = _train_warm(catalog, interactions)
+        elif MODEL_ENGINE == "als":
+            trained = _train_als(catalog, interactions)
+        else:
+            trained = _train_svd(catalog, interactions)
+
+    model = retrieval = None
+    if trained is not None:
+        model = trained.with_precision(FACTOR_PRECISION, FACTOR_RESCORE)
+        with tracing.span("build retrieval"):
+            retrieval = Retrieval.build(
+                catalog, model, interactions, RETRIEVAL_HISTORY_SIZE, index_min_items=CANDIDATE_BUDGET
+            )
+
+    with publish_lock:
+        if catalog_changes != changes_seen:
+            # Catalog changes were applied while this trained; move the result onto the current catalog.
+            current = serving.catalog
+            source = catalog.indices_of(current.ids)
+            _publish(
+                current,
+                model.with_items(source) if model is not None else None,
+                reindex(trending_scores, source),
+                ready=True,
+                retrieval=retrieval.with_items(source) if retrieval is not None else None,
+            )
+        else:
+            _publish(catalog, model, trending_scores, ready=True, retrieval=retrieval)
+
+    # Warm starts continue from the served factors, so the trained copy can be freed.
+    previous = Previous(model, catalog, latest(interactions)) if model is not None else None
+    history = interactions if WARM_START else None
+    if not warm:
+        full_trained_at = time.monotonic()
+    print(f"{'Warm' if warm else 'Full'} training took {time.perf_counter() - started:.1f}s")
+    return model
+
+
+def _follow_catalog_changes(since: int):
+    """Apply catalog upserts/deletes from the data-service feed as they happen; runs forever."""
+    attempt = 0
+    while True:
+        try:
+            for event in changes.stream(DATA_SERVICE_URL, since):
+                attempt = 0
+                if event.name == "reset":
+                    print("Catalog change feed reset; reloading")
+                    since = load_and_train_model()
+                    break
+                if event.name == "changes":
+                    _apply_catalog_changes(event.data["upserts"], event.data["deletes"])
+                since = event.id
+        except Exception as e:  # noqa: BLE001
+            attempt += 1
+            print(f"Catalog change feed interrupted: {e}")
+            time.sleep(min(3 * attempt, 30))
+
+
+def _apply_catalog_changes(upserts, deletes):
+    """Serve the current state with catalog changes applied; the model and trending carry over per item."""
+    global catalog_changes
+
+    with publish_lock:
+        state = serving
+        catalog, source = state.catalog.apply_changes(upserts, deletes, "flightNumber", FLIGHT_FIELDS)
+        model = state.model.with_items(source) if state.model is not None else None
+        retrieval = state.retrieval.with_items(source) if state.retrieval is not None else None
+        _publish(catalog, model, reindex(state.trending.scores, source), state.ready, retrieval)
+        catalog_changes += 1
+    print(f"Applied catalog changes: {len(upserts)} upserted, {len(deletes)} deleted flights")
+
+
+def _rated(interactions: Interactions) -> np.ndarray:
+    """The rated bookings, which SVD trains on."""
+    return (
+        interactions.of_type("Book")
+        & (interactions.users != MISSING)
+        & (interactions.items != MISSING)
+        & ~np.isnan(interactions.ratings)
+    )
+
+
+def _train_svd(
+    catalog: Catalog,
+    interactions: Interactions,
+    factors: int = SVD_FACTORS,
+    epochs: int = SVD_EPOCHS,
+    regularization: float = SVD_REGULARIZATION,
+) -> Optional[FactorModel]:
+    rated = _rated(interactions)
+    if not rated.any():
+        return None
+    # Surprise needs raw ids; only the rated-booking subset is ever materialized.
+    df = pd.DataFrame(
+        {
+            "userId": interactions.user_ids[interactions.users[rated]],
+            "flightNumber": interactions.item_ids[interactions.items[rated]],
+            "rating": interactions.ratings[rated],
+        }
+    )
 
     reader = Reader(rating_scale=(1, 5))
-    data = Dataset.load_from_df(df[["userId", "flightNumber", "rating"]], reader)
+    data = Dataset.load_from_df(df, reader)
     trainset = data.build_full_trainset()
 
-    algo = SVD()
+    algo = SVD(n_factors=factors, n_epochs=epochs, reg_all=regularization, lr_all=SVD_LEARNING_RATE)
     algo.fit(trainset)
+    return FactorModel.from_surprise(algo, catalog)
+
+
+def _train_als(
+    catalog: Catalog,
+    interactions: Interactions,
+    factors: int = ALS_FACTORS,
+    iterations: int = ALS_ITERATIONS,
+    regularization: float = ALS_REGULARIZATION,
+    workers: int = TRAIN_WORKERS,
+) -> Optional[FactorModel]:
+    matrix = interaction_matrix(
+        interactions.users,
+        interactions.item_index(catalog),
+        interactions.type_weights(INTERACTION_WEIGHTS),
+        n_users=len(interactions.user_ids),
+        n_items=len(catalog),
+    )
+    if not matrix.nnz:
+        return None
+    als = ImplicitALS(
+        factors=factors,
+        regularization=regularization,
+        alpha=ALS_ALPHA,
+        iterations=iterations,
+        workers=workers or None,
+        tolerance=ALS_TOLERANCE,
+    )
+    started = time.perf_counter()
+    user_factors, item_factors = als.fit(matrix)
+    print(
+        f"ALS trained on {matrix.nnz} user-item pairs with {als.workers} workers: "
+        f"{len(als.loss_history)} iterations in {time.perf_counter() - started:.1f}s, "
+        f"loss {als.loss_history[-1] if als.loss_history else 0.0:.4g}"
+        + (" (converged)" if als.converged else "")
+    )
+    return FactorModel.from_factors(interactions.user_ids, user_factors, item_factors)
+
+
+def _train_warm(catalog: Catalog, interactions: Interactions) -> Optional[FactorModel]:
+    """Continue training the previous model on the interactions since its data."""
+    since = previous.trained_through - WARM_START_OVERLAP_SECONDS
+    if MODEL_ENGINE == "als":
+        matrix = interaction_matrix(
+            interactions.users,
+            interactions.item_index(catalog),
+            interactions.type_weights(INTERACTION_WEIGHTS),
+            n_users=len(interactions.user_ids),
+            n_items=len(catalog),
+        )
+        if not matrix.nnz:
+            return None
+        user_factors, item_factors, users, items = warm_als(previous, catalog, interactions, since)
+        als = ImplicitALS(
+            factors=previous.model.n_factors,
+            regularization=ALS_REGULARIZATION,
+            alpha=ALS_ALPHA,
+            iterations=ALS_WARM_ITERATIONS,
+            workers=TRAIN_WORKERS or None,
+        )
+        user_factors, item_factors = als.fit(matrix, user_factors, item_factors, users, items)
+        print(f"ALS warm start re-solved {len(users)} users and {len(items)} items")
+        return FactorModel.from_factors(interactions.user_ids, user_factors, item_factors)
+
+    model, trained = warm_svd(
+        previous,
+        catalog,
+        interactions,
+        _rated(interactions),
+        since,
+        epochs=SVD_WARM_EPOCHS,
+        learning_rate=SVD_LEARNING_RATE,
+        regularization=SVD_REGULARIZATION,
+        replay=WARM_START_REPLAY,
+    )
+    print(f"SVD warm start: {SVD_WARM_EPOCHS} epochs over {trained} ratings")
+    return model
+
+
+def _publish(
+    catalog: Catalog,
+    model: Optional[FactorModel],
+    trending_scores: np.ndarray,
+    ready: bool,
+    retrieval: Optional[Retrieval] = None,
+):
+    """Serve a new state; before `ready` it is the trending-only warm-up state."""
+    global serving
+
+    if shared_store is not None:
+        arrays = join_arrays(
+            catalog=catalog.to_arrays(),
+            model=model.to_arrays() if model is not None else {},
+            retrieval=retrieval.to_arrays() if retrieval is not None else {},
+            stats={"trending": trending_scores, "ready": np.array([ready])},
+        )
+        # Serve from the mapped copy as well so this worker's private arrays can be freed.
+        if _install_shared(shared_store.publish(arrays)):
+            return
+    serving = _serving(catalog, model, trending_scores, ready, serving.version + 1, retrieval)
+
+
+def _install_shared(version: int) -> bool:
+    global serving, shared_version
+
+    try:
+        arrays = shared_store.load(version)
+        if arrays is None:
+            return False
+        model_arrays = split_arrays(arrays, "model")
+        retrieval_arrays = split_arrays(arrays, "retrieval")
+        catalog = Catalog.from_arrays(split_arrays(arrays, "catalog"), FLIGHT_FIELDS)
+        model = FactorModel.from_arrays(model_arrays) if model_arrays else None
+        retrieval = Retrieval.from_arrays(retrieval_arrays) if retrieval_arrays else None
+        trending_scores, ready = arrays["stats.trending"], bool(arrays["stats.ready"][0])
+    except (OSError, KeyError) as e:
+        # The trainer pruned it while it was being mapped; keep the current state and retry on the next poll.
+        print(f"Shared model snapshot v{version} unavailable ({e!r}); keeping v{shared_version}")
+        return False
+    serving = _serving(catalog, model, trending_scores, ready, version, retrieval)
+    shared_version = version
+    print(f"Serving shared model snapshot v{version}")
+    return True
+
+
+def _wait_for_shared_snapshot() -> bool:
+    """Follow the trainer's snapshots until one is ready; False if this worker has to train instead."""
+    global status_detail
+
+    status_detail = "waiting for shared model"
+    while True:
+        version = shared_store.current_version()
+        if version and version != shared_version:
+            _install_shared(version)
+        if serving.ready:
+            status_detail = "ready"
+            return True
+        # The trainer may have died before finishing; take over if so.
+        if shared_store.try_become_trainer():
+            return False
+        time.sleep(1)
+
+
+def _current() -> Serving:
+    """The serving state, after picking up a newer shared snapshot if one was published."""
+    global shared_checked_at
+
+    if shared_store is not None and not shared_store.is_trainer:
+        now = time.monotonic()
+        if now - shared_checked_at >= SHARED_MODEL_POLL_SECONDS:
+            shared_checked_at = now
+            version = shared_store.current_version()
+            if version and version != shared_version:
+                _install_shared(version)
+    return serving
+
+
+def _trending_scores(catalog: Catalog, interactions: Interactions) -> np.ndarray:
+    """Time-decayed interaction count per catalog index, over every interaction type."""
+    return decayed_counts(
+        interactions.item_index(catalog),
+        interactions.timestamps,
+        len(catalog),
+        half_life=TRENDING_HALF_LIFE_DAYS * 86400,
+        now=time.time(),
+    )
+
+
+def _parse_time(name: str, value: Optional[str]) -> Optional[float]:
+    if value is None or not value.strip():
+        return None
+    try:
+        return parse_time(value.strip())
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"{name} must be an ISO-8601 timestamp")
+
+
+def _require_catalog(state: Serving):
+    if not len(state.catalog):
+        raise HTTPException(status_code=503, detail="Catalog is still loading", headers={"Retry-After": "5"})
+
+
+def _check_top_n(top_n: int):
+    if not 1 <= top_n <= CURSOR_MAX_RESULTS:
+        raise HTTPException(status_code=422, detail=f"top_n must be between 1 and {CURSOR_MAX_RESULTS}")
+
+
+def _page(state: Serving, query: tuple, top_n: int, cursor: Optional[str], rank):
+    """(catalog indices of the requested page, cursor of the next page or None)."""
+    try:
+        offset = decode_cursor(cursor, state.digest, query)
+    except StaleCursor as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    items, more = state.pages.page(query, offset, top_n, rank)
+    tracing.annotate(items=len(items), offset=offset)
+    return items, encode_cursor(state.digest, query, offset + top_n) if more else None
+
+
+def _rank_for_user(state: Serving, user_row: int, n: int, items: Optional[np.ndarray] = None) -> np.ndarray:
+    """Top `n` catalog indices for a known user: re-ranks `items`, or the candidate pipeline's output."""
+    filters = []
+    if RECOMMEND_EXCLUDE_SEEN and state.retrieval is not None:
+        filters.append(state.retrieval.seen_filter(user_row))
+    if items is None:
+        if state.retrieval is not None:
+            return state.retrieval.rank(
+                user_row, n, state.model, state.catalog, state.trending, CANDIDATE_BUDGET, filters
+            )
+        return state.model.top(user_row, n)
+    for keep in filters:
+        items = items[keep(items)]
+    return items[state.model.top(user_row, n, items)]
 
-    booked_users.update(df["userId"])
 
 @app.get("/recommend/{user_id}")
-def recommend(user_id: str):
-    global flight_name_map, flight_route_map, booked_users, algo, all_flight_ids
-
+def recommend(user_id: str, top_n: int = 10, cursor: Optional[str] = None):
+    """Top flights for a user; pass `nextCursor` back as `cursor` for the next page."""
     if not user_id.strip():
         raise HTTPException(status_code=422, detail="User ID cannot be empty")
+    _check_top_n(top_n)
 
-    if user_id not in booked_users:
-        top = all_flight_ids[:10]
-        return {
-            "recommendations": [
-                {
-                    "flightNumber": fid,
-                    "flightName": _format_flight_name(fid),
-                    **_format_flight_details(fid),
-                }
-                for fid in top
-            ]
-        }
+    state = _current()
+    _require_catalog(state)
+    user_row = state.model.user_index(user_id) if state.ready and state.model is not None else None
 
-    predictions = [algo.predict(user_id, fid) for fid in all_flight_ids]
-    predictions.sort(key=lambda x: x.est, reverse=True)
+    def rank(n: int) -> np.ndarray:
+        if user_row is None:
+            # Cold start (or model still training): trending flights.
+            return state.trending.top(n)
+        return _rank_for_user(state, user_row, n)
 
+    ranked, next_cursor = _page(state, ("recommend", user_id), top_n, cursor, rank)
+    return json_response(
+        {"nextCursor": next_cursor},
+        "recommendations",
+        [state.recommend_fragments.get(i) for i in ranked.tolist()],
+    )
+
+
+def _format_recommendation(catalog: Catalog, index: int) -> dict:
     return {
-        "recommendations": [
-            {
-                "flightNumber": pred.iid,
-                "flightName": _format_flight_name(pred.iid),
-                **_format_flight_details(pred.iid),
-            }
-            for pred in predictions[:10]
-        ]
+        "flightNumber": catalog.item_id(index),
+        "flightName": _format_flight_name(catalog, index),
+        **_format_flight_details(catalog, index),
     }
 
 
-def _format_flight_details(flight_number: str) -> dict:
-    meta = flight_route_map.get(flight_number) or {}
+def _format_flight_details(catalog: Catalog, index: int) -> dict:
     # Keep keys stable and optional; callers can ignore.
-    return {
-        "airline": meta.get("airline"),
-        "source": meta.get("source"),
-        "destination": meta.get("destination"),
-        "departure": meta.get("departure"),
-        "arrival": meta.get("arrival"),
-    }
+    return {field: catalog.value(field, index) for field in FLIGHT_FIELDS}
 
 
-def _format_flight_name(flight_number: str) -> str:
-    meta = flight_route_map.get(flight_number) or {}
-    airline = meta.get("airline") or flight_name_map.get(flight_number, "Unknown")
-    source = meta.get("source")
-    destination = meta.get("destination")
+def _format_flight_name(catalog: Catalog, index: int) -> str:
+    flight_number = catalog.item_id(index)
+    airline = catalog.value("airline", index) or "Unknown"
+    source = catalog.value("source", index)
+    destination = catalog.value("destination", index)
     if source and destination:
         return f"{airline} {flight_number} {source}→{destination}"
     return f"{airline} {flight_number}"
 
 
-def _format_route_item(flight_number: str) -> dict:
-    meta = flight_route_map.get(flight_number) or {}
+def _format_route_item(catalog: Catalog, index: int) -> dict:
     return {
-        "id": flight_number,
-        "name": _format_flight_name(flight_number),
+        "id": catalog.item_id(index),
+        "name": _format_flight_name(catalog, index),
         "mode": "air",
-        "source": meta.get("source"),
-        "destination": meta.get("destination"),
-        "departure": meta.get("departure"),
-        "arrival": meta.get("arrival"),
+        "source": catalog.value("source", index),
+        "destination": catalog.value("destination", index),
+        "departure": catalog.value("departure", index),
+        "arrival": catalog.value("arrival", index),
         "meta": {
-            "airline": meta.get("airline"),
+            "airline": catalog.value("airline", index),
         },
     }
 
@@ -145,8 +715,37 @@ def health():
     return {"status": "healthy"}
 
 
+@app.get("/ready")
+def ready():
+    state = _current()
+    if not state.ready:
+        status = "warming" if len(state.catalog) else "loading"
+        return JSONResponse(status_code=503, content={"status": status, "detail": status_detail})
+    return {"status": "ready", "detail": status_detail}
+
+
+@app.get("/traces")
+def traces(min_ms: float = TRACE_SLOW_MS, limit: int = 20):
+    """Recent requests (and training runs) that took at least `min_ms`, newest first, with their spans."""
+    return {"minMs": min_ms, "traces": tracer.slow_traces(min_ms, max(1, min(limit, 200)))}
+
+
+@app.get("/traces/{trace_id}")
+def trace(trace_id: str):
+    """The spans this service holds for one trace."""
+    return {"traceId": trace_id, "spans": tracer.trace(trace_id)}
+
+
 @app.get("/recommend-route")
-def recommend_route(source: str, destination: str, user_id: Optional[str] = None, top_n: int = 10):
+def recommend_route(
+    source: str,
+    destination: str,
+    user_id: Optional[str] = None,
+    top_n: int = 10,
+    depart_after: Optional[str] = None,
+    depart_before: Optional[str] = None,
+    cursor: Optional[str] = None,
+):
     """Route-based recommendations.
 
     Inputs:
@@ -154,42 +753,124 @@ def recommend_route(source: str, destination: str, user_id: Optional[str] = None
     - destination: airport code (e.g. JFK)
     - user_id: optional user id for personalization
     - top_n: number of results
+    - depart_after / depart_before: optional ISO-8601 departure window (inclusive;
+      naive times are UTC)
+    - cursor: `nextCursor` of the previous page, sent with the same parameters
     """
-    global flight_route_map, flight_mean_rating, booked_users, algo
-
     src = (source or "").strip()
     dst = (destination or "").strip()
     if not src or not dst:
         raise HTTPException(status_code=422, detail="source and destination are required")
+    _check_top_n(top_n)
 
-    # Filter flights to the requested route.
-    route_flights = [
-        fid
-        for fid, meta in flight_route_map.items()
-        if (meta.get("source") or "").lower() == src.lower() and (meta.get("destination") or "").lower() == dst.lower()
-    ]
+    after = _parse_time("depart_after", depart_after)
+    before = _parse_time("depart_before", depart_before)
+    windowed = after is not None or before is not None
 
-    if not route_flights:
-        raise HTTPException(status_code=404, detail="No flights found for this route")
+    state = _current()
+    _require_catalog(state)
 
-    # Personalized ranking if user_id is known + model is trained.
-    if user_id and user_id in booked_users and algo is not None:
-        predictions = [algo.predict(user_id, fid) for fid in route_flights]
-        predictions.sort(key=lambda x: x.est, reverse=True)
-        ranked = [p.iid for p in predictions[:top_n]]
-    else:
-        # Fallback: rank by mean rating from historical bookings, then stable by id.
-        ranked = sorted(
-            route_flights,
-            key=lambda fid: (
-                -(flight_mean_rating.get(fid, 0.0) or 0.0),
-                fid,
-            ),
-        )[:top_n]
+    # Flights on the requested route, straight from the route index; a
+    # departure window is cut by binary search before anything is scored.
+    route_flights = state.catalog.route(src, dst, after, before)
 
-    return {
-        "source": src,
-        "destination": dst,
-        "userId": user_id,
-        "recommendations": [_format_route_item(fid) for fid in ranked],
-    }
+    if not len(route_flights):
+        detail = "No flights found for this route"
+        if windowed and len(state.catalog.route(src, dst)):
+            detail = "No flights found for this route in the departure window"
+        raise HTTPException(status_code=404, detail=detail)
+
+    # Personalized ranking if user_id is known + model is trained.
+    user_row = state.model.user_index(user_id) if user_id and state.ready and state.model is not None else None
+
+    def rank(n: int) -> np.ndarray:
+        if user_row is not None:
+            # The route index is this query's candidate generator.
+            return _rank_for_user(state, user_row, n, route_flights)
+        if windowed:
+            return state.trending.rank(route_flights, n)
+        # Fallback: the route's trending flights, precomputed at refresh.
+        return state.trending.route(src, dst, n)
+
+    query = ("route", src.lower(), dst.lower(), user_id, after, before)
+    ranked, next_cursor = _page(state, query, top_n, cursor, rank)
+
+    return json_response(
+        {
+            "source": src,
+            "destination": dst,
+            "userId": user_id,
+            "departAfter": depart_after or None,
+            "departBefore": depart_before or None,
+            "nextCursor": next_cursor,
+        },
+        "recommendations",
+        [state.route_fragments.get(i) for i in ranked.tolist()],
+    )
+
+
+@app.get("/itineraries")
+def itineraries(
+    source: str,
+    destination: str,
+    user_id: Optional[str] = None,
+    top_k: int = 5,
+    max_legs: int = ITINERARY_MAX_LEGS,
+    min_connection_minutes: float = ITINERARY_MIN_CONNECTION_MINUTES,
+    max_connection_minutes: float = ITINERARY_MAX_CONNECTION_MINUTES,
+    depart_after: Optional[str] = None,
+    depart_before: Optional[str] = None,
+):
+    """Direct and connecting itineraries, best combined predicted rating first.
+
+    An itinerary's score is the mean predicted rating of its legs for
+    `user_id` (trending popularity for unknown users). Connections leave
+    between `min_connection_minutes` and `max_connection_minutes` after the
+    previous flight arrives; the departure window applies to the first flight.
+    """
+    src = (source or "").strip()
+    dst = (destination or "").strip()
+    if not src or not dst:
+        raise HTTPException(status_code=422, detail="source and destination are required")
+    if not 1 <= max_legs <= ITINERARY_MAX_LEGS:
+        raise HTTPException(status_code=422, detail=f"max_legs must be between 1 and {ITINERARY_MAX_LEGS}")
+    if min_connection_minutes < 0 or max_connection_minutes < min_connection_minutes:
+        raise HTTPException(status_code=422, detail="connection time bounds are invalid")
+
+    after = _parse_time("depart_after", depart_after)
+    before = _parse_time("depart_before", depart_before)
+
+    state = _current()
+    _require_catalog(state)
+
+    user_row = state.model.user_index(user_id) if user_id and state.ready and state.model is not None else None
+    scores = state.model.scores(user_row) if user_row is not None else state.trending.scores
+    found = state.itineraries.search(
+        src,
+        dst,
+        scores,
+        k=top_k,
+        max_legs=max_legs,
+        min_connection=min_connection_minutes * 60,
+        max_connection=max_connection_minutes * 60,
+        depart_after=after,
+        depart_before=before,
+        max_expansions=ITINERARY_MAX_EXPANSIONS,
+    )
+    if not found:
+        raise HTTPException(status_code=404, detail="No itineraries found for this route")
+
+    return json_response(
+        {"source": src, "destination": dst, "userId": user_id},
+        "itineraries",
+        [_format_itinerary(state, itinerary) for itinerary in found],
+    )
+
+
+def _format_itinerary(state: Serving, itinerary: Itinerary) -> bytes:
+    # Legs reuse the route fragments of this catalog version.
+    return splice(
+        {"score": round(itinerary.score, 4), "connections": len(itinerary.items) - 1},
+        "legs",
+        [state.route_fragments.get(i) for i in itinerary.items],
+    )
@@ -0,0 +1,113 @@
+"""Model snapshots shared between uvicorn workers through memory-mapped files.
+
+When `SHARED_MODEL_DIR` is set, the first worker to take `trainer.lock`
+trains and publishes snapshots; every worker (the trainer included) maps
+the current snapshot read-only, so the factors and catalog exist once in
+the page cache no matter how many workers run. Layout:
+
+    SHARED_MODEL_DIR/
+        trainer.lock     held (flock) by the training worker
+        VERSION          current snapshot version (the version counter)
+        v00000042/       one .npy file per array
+"""
+import fcntl
+import os
+import shutil
+from typing import Dict, Optional
+
+import numpy as np
+
+
+class SharedModelStore:
+    def __init__(self, root: str, keep: int = 3):
+        self.root = root
+        self.keep = keep
+        self._lock_file = None
+        os.makedirs(root, exist_ok=True)
+
+    @property
+    def is_trainer(self) -> bool:
+        return self._lock_file is not None
+
+    def try_become_trainer(self) -> bool:
+        """Take the trainer lock without blocking; it is held until the process exits."""
+        if self._lock_file is not None:
+            return True
+        lock_file = open(os.path.join(self.root, "trainer.lock"), "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def current_version(self) -> int:
+        try:
+            with open(os.path.join(self.root, "VERSION")) as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def publish(self, arrays: Dict[str, np.ndarray]) -> int:
+        """Write a new snapshot and bump VERSION; returns the new version."""
+        version = self.current_version() + 1
+        final = self._path(version)
+        staging = f"{final}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        for name, array in arrays.items():
+            np.save(os.path.join(staging, f"{name}.npy"), np.ascontiguousarray(array), allow_pickle=False)
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(staging, final)
+
+        # Readers only ever see complete snapshots: the directory is in place
+        # before the counter that points at it changes.
+        counter = os.path.join(self.root, "VERSION")
+        with open(f"{counter}.tmp", "w") as f:
+            f.write(str(version))
+        os.replace(f"{counter}.tmp", counter)
+
+        self._prune(version)
+        return version
+
+    def load(self, version: int) -> Optional[Dict[str, np.ndarray]]:
+        """Map every array of a snapshot read-only (None if it has been pruned).
+
+        A trainer may prune the snapshot while it is being mapped; the result
+        can then lack arrays, which `from_arrays` reports as a KeyError.
+        """
+        path = self._path(version)
+        try:
+            names = [n for n in os.listdir(path) if n.endswith(".npy")]
+            return {name[: -len(".npy")]: _map(os.path.join(path, name)) for name in names}
+        except FileNotFoundError:
+            return None
+
+    def _path(self, version: int) -> str:
+        return os.path.join(self.root, f"v{version:08d}")
+
+    def _prune(self, version: int) -> None:
+        # Workers still mapping a pruned snapshot keep their pages until they
+        # switch; unlinking only drops the directory entry.
+        for name in os.listdir(self.root):
+            if name.startswith("v") and name[1:].isdigit() and int(name[1:]) <= version - self.keep:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+
+def _map(path: str) -> np.ndarray:
+    try:
+        return np.load(path, mmap_mode="r", allow_pickle=False)
+    except ValueError:
+        # Empty arrays cannot be memory-mapped.
+        return np.load(path, allow_pickle=False)
+
+
+def split_arrays(arrays: Dict[str, np.ndarray], prefix: str) -> Dict[str, np.ndarray]:
+    """Select the arrays published under `prefix.` and strip the prefix."""
+    start = len(prefix) + 1
+    return {name[start:]: array for name, array in arrays.items() if name.startswith(f"{prefix}.")}
+
+
+def join_arrays(**sections: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    return {f"{prefix}.{name}": array for prefix, arrays in sections.items() for name, array in arrays.items()}
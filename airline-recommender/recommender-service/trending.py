@@ -0,0 +1,53 @@
+"""Time-decayed popularity ("trending") rankings.
+
+Every interaction, whatever its type, contributes a weight that halves every
+`half_life` seconds of age. Rankings are computed once per refresh, globally
+and per route, so serving one is an array slice.
+"""
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from catalog import Catalog
+
+
+def decayed_counts(
+    item_index: np.ndarray,
+    timestamps: np.ndarray,
+    n_items: int,
+    half_life: float,
+    now: float,
+) -> np.ndarray:
+    """Sum of 2^(-age / half_life) per item; rows with unknown items or times are ignored."""
+    valid = (item_index >= 0) & ~np.isnan(timestamps)
+    age = np.maximum(now - timestamps[valid], 0.0)
+    weights = np.exp2(-age / half_life)
+    return np.bincount(item_index[valid], weights=weights, minlength=n_items)
+
+
+class Trending:
+    """Items ranked by decayed popularity, globally and within each route."""
+
+    def __init__(self, catalog: Catalog, scores: np.ndarray):
+        self.scores = scores
+        self.ranked = np.argsort(-scores, kind="stable")
+        self._routes: Dict[Tuple[str, str], np.ndarray] = {
+            route: items[np.argsort(-scores[items], kind="stable")]
+            for route, items in catalog.routes().items()
+        }
+
+    def top(self, n: int) -> np.ndarray:
+        return self.ranked[:n]
+
+    def rank(self, items: np.ndarray, n: Optional[int] = None) -> np.ndarray:
+        """`items` reordered most trending first (ties keep their given order)."""
+        ranked = items[np.argsort(-self.scores[items], kind="stable")]
+        return ranked if n is None else ranked[:n]
+
+    def route(self, source: str, destination: str, n: Optional[int] = None) -> np.ndarray:
+        """Route items, most trending first (empty if the route is unknown)."""
+        ranked = self._routes.get((source.lower(), destination.lower()), _EMPTY)
+        return ranked if n is None else ranked[:n]
+
+
+_EMPTY = np.array([], dtype=np.int32)
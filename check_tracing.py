@@ -0,0 +1,41 @@
+"""Fail unless every service's copy of tracing.py is identical.
+
+Usage: python check_tracing.py
+"""
+import hashlib
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+COPIES = [
+    "gateway-server/app/tracing.py",
+    "airline-recommender/data-service/tracing.py",
+    "airline-recommender/recommender-service/tracing.py",
+    "rail-recommender/data-service/tracing.py",
+    "rail-recommender/recommender-service/tracing.py",
+]
+
+
+def main() -> int:
+    digests = {}
+    for path in COPIES:
+        file = ROOT / path
+        if not file.is_file():
+            print(f"FAIL: {path} is missing")
+            return 1
+        digests[path] = hashlib.sha256(file.read_bytes()).hexdigest()
+
+    reference = digests[COPIES[0]]
+    differing = [path for path, digest in digests.items() if digest != reference]
+    if differing:
+        print(f"FAIL: these copies differ from {COPIES[0]}:")
+        for path in differing:
+            print(f"  {path}")
+        return 1
+
+    print(f"OK: {len(COPIES)} copies of tracing.py are identical")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
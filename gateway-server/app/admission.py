@@ -0,0 +1,232 @@
+"""Admission control for upstream calls: rate limits, concurrency limits and load shedding.
+
+Every upstream (a recommender or data-service base URL) has an `Upstream`
+limiter: a token bucket for its request rate and a cap on requests in
+flight. Requests over the cap wait in a queue ordered by priority, then
+arrival. Interactive recommendation calls are HIGH, searches NORMAL and
+health checks and background refreshes LOW; lower priorities may only fill
+part of the slots, so a burst of them cannot starve interactive traffic.
+
+A request is shed with `Overloaded` (503 + Retry-After) instead of queueing
+when the upstream's bucket is empty, when its expected wait (queue ahead
+of it x recent upstream latency / slots) is past its priority's wait
+budget, or when it actually waited that long. Clients over their own token
+bucket get `RateLimited` (429 + Retry-After) before reaching any queue.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+HIGH, NORMAL, LOW = 0, 1, 2
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+# Share of an upstream's slots each priority may fill, and share of the queue wait budget it gets.
+SLOT_SHARE = {HIGH: 1.0, NORMAL: 0.75, LOW: 0.25}
+WAIT_SHARE = {HIGH: 1.0, NORMAL: 0.5, LOW: 0.1}
+
+LATENCY_SMOOTHING = 0.1
+
+
+class RateLimited(HTTPException):
+    def __init__(self, retry_after: float, detail: str = "Too many requests"):
+        super().__init__(status_code=429, detail=detail, headers={"Retry-After": _seconds(retry_after)})
+
+
+class Overloaded(HTTPException):
+    def __init__(self, retry_after: float, detail: str = "Upstream is overloaded"):
+        super().__init__(status_code=503, detail=detail, headers={"Retry-After": _seconds(retry_after)})
+
+
+def _seconds(value: float) -> str:
+    return str(max(1, math.ceil(value)))
+
+
+class TokenBucket:
+    """`rate` tokens per second, up to `burst`; a rate of 0 or less never limits."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """0 when a token was taken, else the seconds until one is available."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class ClientLimits:
+    """One token bucket per client key, for the `max_clients` most recently seen clients."""
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def check(self, client: str) -> None:
+        if self.rate <= 0:
+            return
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+        wait = bucket.take()
+        if wait:
+            raise RateLimited(wait)
+
+
+class Upstream:
+    def __init__(self, name: str, max_concurrency: int, rate: float, burst: float, max_wait: float):
+        self.name = name
+        self.max_concurrency = max(max_concurrency, 1)
+        self.bucket = TokenBucket(rate, burst)
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.latency = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self.admitted = {priority: 0 for priority in PRIORITY_NAMES}
+        self.shed = {priority: 0 for priority in PRIORITY_NAMES}
+
+    @asynccontextmanager
+    async def slot(self, priority: int = NORMAL):
+        """Hold one of the upstream's slots for the duration of a call; raises Overloaded."""
+        await self._acquire(priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self.latency += LATENCY_SMOOTHING * (elapsed - self.latency)
+            self.in_flight -= 1
+            self._wake()
+
+    def _cap(self, priority: int) -> int:
+        return max(1, int(self.max_concurrency * SLOT_SHARE[priority]))
+
+    def _expected_wait(self, priority: int) -> float:
+        ahead = sum(1 for waiter in self._waiters if waiter[0] <= priority)
+        return (ahead + 1) * self.latency / self._cap(priority)
+
+    async def _acquire(self, priority: int) -> None:
+        wait = self.bucket.take()
+        if wait:
+            self.shed[priority] += 1
+            raise Overloaded(wait, f"{self.name} is over its request rate")
+
+        ahead = any(waiter[0] <= priority for waiter in self._waiters)
+        if not ahead and self.in_flight < self._cap(priority):
+            self.in_flight += 1
+            self.admitted[priority] += 1
+            return
+
+        budget = self.max_wait * WAIT_SHARE[priority]
+        expected = self._expected_wait(priority)
+        if expected > budget:
+            self.shed[priority] += 1
+            raise Overloaded(expected, f"{self.name} is overloaded")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._order), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), budget)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # The caller went away; hand on a slot granted meanwhile.
+            if future.done() and not future.cancelled():
+                self.in_flight -= 1
+                self._wake()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+        if future.cancelled():
+            self.shed[priority] += 1
+            raise Overloaded(max(self._expected_wait(priority), budget), f"{self.name} is overloaded")
+        # _wake counted the slot as ours when it resolved the future.
+        self.admitted[priority] += 1
+
+    def _wake(self) -> None:
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.in_flight >= self._cap(priority):
+                return
+            heapq.heappop(self._waiters)
+            self.in_flight += 1
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "inFlight": self.in_flight,
+            "queued": len(self._waiters),
+            "maxConcurrency": self.max_concurrency,
+            "latencyMs": round(self.latency * 1000, 1),
+            "admitted": {PRIORITY_NAMES[p]: count for p, count in self.admitted.items()},
+            "shed": {PRIORITY_NAMES[p]: count for p, count in self.shed.items()},
+        }
+
+
+class Admission:
+    """The gateway's per-upstream limiters, created on first use, and its per-client limits."""
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        rate: float,
+        burst: float,
+        max_wait: float,
+        client_rate: float,
+        client_burst: float,
+    ):
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.clients = ClientLimits(client_rate, client_burst)
+        self._upstreams: Dict[str, Upstream] = {}
+
+    def upstream(self, base_url: str) -> Upstream:
+        upstream = self._upstreams.get(base_url)
+        if upstream is None:
+            upstream = self._upstreams[base_url] = Upstream(
+                base_url, self.max_concurrency, self.rate, self.burst, self.max_wait
+            )
+        return upstream
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: upstream.stats() for name, upstream in self._upstreams.items()}
+
+
+def client_key(headers, peer: Optional[str], header: Optional[str]) -> str:
+    """The client identity for rate limiting: the first value of `header` when configured, else the peer address."""
+    if header:
+        value = headers.get(header, "").split(",")[0].strip()
+        if value:
+            return value
+    return peer or "unknown"
@@ -0,0 +1,136 @@
+"""Replica selection for the recommender services.
+
+Each mode has a `ReplicaSet` of recommender base URLs. Personalized
+requests (those with a user id) go to the user's replica on a consistent
+hash ring, so a user's pages and per-user caches stay on one replica, and
+adding or removing a replica only moves about 1/n of the users. Anonymous
+requests go to the replica with the fewest requests outstanding.
+
+Replicas leave the rotation for `eject_seconds` when their `/ready` check
+fails to answer, or after `failure_threshold` consecutive failed proxied
+requests. Replicas that answer but are still training (`/ready` 503) are
+only used when no replica is ready. Hashed users skip past unavailable
+replicas to the next one on the ring, and return when theirs is back. When
+every replica is out, all of them are tried again rather than none.
+"""
+import bisect
+import hashlib
+import random
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+VIRTUAL_NODES = 160
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes: Sequence[str], virtual_nodes: int = VIRTUAL_NODES):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+        self._distinct = len(set(nodes))
+
+    def walk(self, key: str) -> Iterator[str]:
+        """The distinct nodes clockwise from `key`'s point; the first is its owner."""
+        if not self._nodes:
+            return
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen = set()
+        for offset in range(len(self._nodes)):
+            node = self._nodes[(start + offset) % len(self._nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == self._distinct:
+                    return
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.ready = True
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.last_error: Optional[str] = None
+
+    def available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+
+class ReplicaSet:
+    def __init__(self, urls: Sequence[str], eject_seconds: float = 30.0, failure_threshold: int = 3):
+        urls = list(dict.fromkeys(url.rstrip("/") for url in urls if url.strip()))
+        self.replicas: Dict[str, Replica] = {url: Replica(url) for url in urls}
+        self.ring = HashRing(urls)
+        self.eject_seconds = eject_seconds
+        self.failure_threshold = failure_threshold
+
+    def _tiers(self) -> List[Callable[[Replica], bool]]:
+        now = time.monotonic()
+        return [
+            lambda replica: replica.available(now) and replica.ready,
+            lambda replica: replica.available(now),
+            lambda replica: True,
+        ]
+
+    def pick(self, affinity: Optional[str] = None, exclude: Sequence[str] = ()) -> Replica:
+        """The replica for a request: by hash of `affinity` when given, else the least loaded."""
+        for accept in self._tiers():
+            if affinity:
+                for url in self.ring.walk(affinity):
+                    replica = self.replicas[url]
+                    if url not in exclude and accept(replica):
+                        return replica
+                continue
+            candidates = [r for r in self.replicas.values() if r.url not in exclude and accept(r)]
+            if candidates:
+                random.shuffle(candidates)
+                return min(candidates, key=lambda replica: replica.outstanding)
+        raise LookupError("no replica left to try")
+
+    @contextmanager
+    def track(self, replica: Replica):
+        replica.outstanding += 1
+        try:
+            yield
+        finally:
+            replica.outstanding -= 1
+
+    def succeeded(self, replica: Replica) -> None:
+        replica.failures = 0
+
+    def failed(self, replica: Replica, error: str) -> None:
+        replica.failures += 1
+        replica.last_error = error
+        if replica.failures >= self.failure_threshold:
+            self.eject(replica, error)
+
+    def eject(self, replica: Replica, error: str) -> None:
+        replica.ejected_until = time.monotonic() + self.eject_seconds
+        replica.last_error = error
+        replica.failures = 0
+
+    def checked(self, replica: Replica, ready: Optional[bool], error: Optional[str] = None) -> None:
+        """Record a `/ready` check: True or False when it answered, None when it did not."""
+        if ready is None:
+            self.eject(replica, error or "health check failed")
+            return
+        replica.ready = ready
+
+    def stats(self) -> List[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "url": replica.url,
+                "available": replica.available(now),
+                "ready": replica.ready,
+                "outstanding": replica.outstanding,
+                "lastError": replica.last_error,
+            }
+            for replica in self.replicas.values()
+        ]
@@ -1,12 +1,20 @@
 import os
 import asyncio
+import re
 import socket
+import time
 from typing import Literal, Optional
 
 import httpx
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 
+from . import tracing
+from .admission import HIGH, LOW, NORMAL, PRIORITY_NAMES, Admission, Overloaded, client_key
+from .balancer import ReplicaSet
+from .registry import CodeRegistry
+from .tracing import Tracer
 
 Mode = Literal["air", "rail"]
 
@@ -23,8 +31,14 @@ app.add_middleware(
 )
 
 
-AIRLINE_RECOMMENDER_URL = os.getenv("AIRLINE_RECOMMENDER_URL", "http://host.docker.internal:8101").rstrip("/")
-RAIL_RECOMMENDER_URL = os.getenv("RAIL_RECOMMENDER_URL", "http://host.docker.internal:8001").rstrip("/")
+def _url_list(name: str, default: str) -> list[str]:
+    # NAME_URLS (comma-separated replicas) wins over the single NAME_URL.
+    value = os.getenv(f"{name}S") or os.getenv(name, default)
+    return [url.strip().rstrip("/") for url in value.split(",") if url.strip()]
+
+
+AIRLINE_RECOMMENDER_URLS = _url_list("AIRLINE_RECOMMENDER_URL", "http://host.docker.internal:8101")
+RAIL_RECOMMENDER_URLS = _url_list("RAIL_RECOMMENDER_URL", "http://host.docker.internal:8001")
 
 AIRLINE_DATA_SERVICE_URL = os.getenv("AIRLINE_DATA_SERVICE_URL", "http://airline-data-service:8000").rstrip("/")
 RAIL_DATA_SERVICE_URL = os.getenv("RAIL_DATA_SERVICE_URL", "http://rail-data-service:8000").rstrip("/")
@@ -35,10 +49,159 @@ RAIL_POSTGRES_HOST = os.getenv("RAIL_POSTGRES_HOST", "rail-postgres")
 RAIL_POSTGRES_PORT = int(os.getenv("RAIL_POSTGRES_PORT", "5432"))
 
 TIMEOUT_SECONDS = float(os.getenv("GATEWAY_TIMEOUT_SECONDS", "10"))
+CODE_REGISTRY_REFRESH_SECONDS = float(os.getenv("CODE_REGISTRY_REFRESH_SECONDS", "60"))
+
+# Admission control (see admission.py). Per upstream: requests in flight, and
+# a token bucket of requests per second (0 turns it off).
+GATEWAY_UPSTREAM_CONCURRENCY = int(os.getenv("GATEWAY_UPSTREAM_CONCURRENCY", "32"))
+GATEWAY_UPSTREAM_RATE = float(os.getenv("GATEWAY_UPSTREAM_RATE", "0"))
+GATEWAY_UPSTREAM_BURST = float(os.getenv("GATEWAY_UPSTREAM_BURST", "100"))
+# Longest a high-priority request queues for an upstream slot before it is shed
+# (normal and low priority get a fraction of it).
+GATEWAY_MAX_QUEUE_WAIT_SECONDS = float(os.getenv("GATEWAY_MAX_QUEUE_WAIT_SECONDS", "0.5"))
+# Per-client token bucket (off by default; 0 turns it off). Clients are told
+# apart by the first value of GATEWAY_CLIENT_KEY_HEADER when set, else by peer
+# address. Behind a proxy or load balancer every request has the proxy's
+# address, so set the header (e.g. X-Forwarded-For) before turning this on.
+GATEWAY_CLIENT_RATE = float(os.getenv("GATEWAY_CLIENT_RATE", "0"))
+GATEWAY_CLIENT_BURST = float(os.getenv("GATEWAY_CLIENT_BURST", "40"))
+GATEWAY_CLIENT_KEY_HEADER = os.getenv("GATEWAY_CLIENT_KEY_HEADER", "").strip()
+
+# Request tracing (see tracing.py): spans kept in memory, optionally appended to
+# TRACE_EXPORT_PATH as JSONL; GET /traces lists requests slower than TRACE_SLOW_MS.
+TRACE_BUFFER_SPANS = int(os.getenv("TRACE_BUFFER_SPANS", "10000"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "").strip() or None
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "500"))
+
+# Recommender replicas (see balancer.py). A replica leaves the rotation for
+# REPLICA_EJECT_SECONDS when its /ready check (every REPLICA_HEALTH_CHECK_SECONDS)
+# gets no answer or after REPLICA_FAILURE_THRESHOLD failed requests in a row.
+# A request whose replica is unreachable is retried on up to
+# GATEWAY_REPLICA_ATTEMPTS replicas in all.
+REPLICA_HEALTH_CHECK_SECONDS = float(os.getenv("REPLICA_HEALTH_CHECK_SECONDS", "5"))
+REPLICA_EJECT_SECONDS = float(os.getenv("REPLICA_EJECT_SECONDS", "30"))
+REPLICA_FAILURE_THRESHOLD = int(os.getenv("REPLICA_FAILURE_THRESHOLD", "3"))
+GATEWAY_REPLICA_ATTEMPTS = int(os.getenv("GATEWAY_REPLICA_ATTEMPTS", "2"))
+
+recommenders: dict[str, ReplicaSet] = {
+    mode: ReplicaSet(urls, eject_seconds=REPLICA_EJECT_SECONDS, failure_threshold=REPLICA_FAILURE_THRESHOLD)
+    for mode, urls in (("air", AIRLINE_RECOMMENDER_URLS), ("rail", RAIL_RECOMMENDER_URLS))
+}
+
+tracer = Tracer("gateway", TRACE_BUFFER_SPANS, TRACE_EXPORT_PATH)
+tracing.install(app, tracer)
+
+admission = Admission(
+    max_concurrency=GATEWAY_UPSTREAM_CONCURRENCY,
+    rate=GATEWAY_UPSTREAM_RATE,
+    burst=GATEWAY_UPSTREAM_BURST,
+    max_wait=GATEWAY_MAX_QUEUE_WAIT_SECONDS,
+    client_rate=GATEWAY_CLIENT_RATE,
+    client_burst=GATEWAY_CLIENT_BURST,
+)
+
+# Known codes per mode, from the data-services' /codes lists.
+registry = CodeRegistry({})
+_code_lists: dict[str, tuple[Optional[str], list[str]]] = {}
+
+
+async def _fetch_codes(client: httpx.AsyncClient, mode: Mode, base_url: str) -> None:
+    etag, codes = _code_lists.get(mode, (None, []))
+    headers = {"If-None-Match": etag} if etag else {}
+    async with admission.upstream(base_url).slot(LOW):
+        resp = await client.get(f"{base_url}/codes", headers=headers)
+    if resp.status_code == 304:
+        return
+    resp.raise_for_status()
+    _code_lists[mode] = (resp.headers.get("etag"), resp.json()["codes"])
+
+
+async def refresh_registry() -> None:
+    """Re-read both code lists; a data-service that fails keeps its last list."""
+    global registry
+    before = {mode: etag for mode, (etag, _) in _code_lists.items()}
+    async with httpx.AsyncClient(timeout=TIMEOUT_SECONDS) as client:
+        await asyncio.gather(
+            _fetch_codes(client, "air", AIRLINE_DATA_SERVICE_URL),
+            _fetch_codes(client, "rail", RAIL_DATA_SERVICE_URL),
+            return_exceptions=True,
+        )
+    if {mode: etag for mode, (etag, _) in _code_lists.items()} != before:
+        registry = CodeRegistry({mode: codes for mode, (_, codes) in _code_lists.items()})
+
+
+async def _refresh_registry_forever() -> None:
+    while True:
+        try:
+            await refresh_registry()
+        except Exception as e:
+            print(f"Code registry refresh failed: {e}")
+        await asyncio.sleep(CODE_REGISTRY_REFRESH_SECONDS)
+
+
+async def _check_replica(client: httpx.AsyncClient, replicas: ReplicaSet, replica) -> None:
+    try:
+        async with admission.upstream(replica.url).slot(LOW):
+            resp = await client.get(f"{replica.url}/ready")
+    except Overloaded:
+        # Busy with real traffic, which reports its own failures.
+        return
+    except httpx.RequestError as e:
+        replicas.checked(replica, None, f"unreachable ({e})")
+        return
+    if resp.status_code == 200:
+        replicas.checked(replica, True)
+    elif resp.status_code == 503:
+        # Up, but still loading or warming its model.
+        replicas.checked(replica, False)
+    else:
+        replicas.checked(replica, None, f"/ready returned {resp.status_code}")
+
+
+async def check_replicas() -> None:
+    async with httpx.AsyncClient(timeout=min(TIMEOUT_SECONDS, 3.0)) as client:
+        await asyncio.gather(
+            *(
+                _check_replica(client, replicas, replica)
+                for replicas in recommenders.values()
+                for replica in replicas.replicas.values()
+            )
+        )
+
+
+async def _check_replicas_forever() -> None:
+    while True:
+        try:
+            await check_replicas()
+        except Exception as e:
+            print(f"Recommender replica check failed: {e}")
+        await asyncio.sleep(REPLICA_HEALTH_CHECK_SECONDS)
+
+
+@app.middleware("http")
+async def limit_clients(request: Request, call_next):
+    # The gateway's own liveness probe and CORS preflights are never limited.
+    if request.url.path != "/health" and request.method != "OPTIONS":
+        peer = request.client.host if request.client else None
+        try:
+            admission.clients.check(client_key(request.headers, peer, GATEWAY_CLIENT_KEY_HEADER))
+        except HTTPException as e:
+            return JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+    return await call_next(request)
+
+
+@app.on_event("startup")
+async def start_registry_refresh():
+    app.state.registry_task = asyncio.create_task(_refresh_registry_forever())
+    app.state.replica_task = asyncio.create_task(_check_replicas_forever())
 
 
 def _auto_detect_mode(source: str, destination: str) -> Mode:
-    # Simple heuristic:
+    # Codes that the registry knows in exactly one mode route there.
+    known = registry.mode_for(source or "", destination or "")
+    if known is not None:
+        return known
+    # Otherwise (unknown codes, or both served by both modes), a simple heuristic:
     # - Airline seeded data uses 3-letter uppercase airport codes (e.g., BOS, DEN)
     # - Rail seeded data often uses non-3-letter codes (sometimes 3-letter too, but not always)
     # Users can always override with explicit mode.
@@ -49,17 +212,23 @@ def _auto_detect_mode(source: str, destination: str) -> Mode:
     return "rail"
 
 
-def _base_url_for_mode(mode: Mode) -> str:
-    return AIRLINE_RECOMMENDER_URL if mode == "air" else RAIL_RECOMMENDER_URL
+class UpstreamUnreachable(HTTPException):
+    def __init__(self, url: str, error: Exception):
+        super().__init__(status_code=502, detail=f"Upstream unreachable: {url} ({error})")
 
 
-async def _proxy_get(base_url: str, path: str, params: dict):
+async def _proxy_get(base_url: str, path: str, params: dict, priority: int = NORMAL):
     url = f"{base_url}{path}"
-    async with httpx.AsyncClient(timeout=TIMEOUT_SECONDS) as client:
-        try:
-            resp = await client.get(url, params=params)
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=502, detail=f"Upstream unreachable: {url} ({e})")
+    with tracing.span(f"GET {path}", upstream=base_url, priority=PRIORITY_NAMES[priority]) as span:
+        queued = time.perf_counter()
+        async with admission.upstream(base_url).slot(priority):
+            span.set(queueMs=round((time.perf_counter() - queued) * 1000, 3))
+            async with httpx.AsyncClient(timeout=TIMEOUT_SECONDS) as client:
+                try:
+                    resp = await client.get(url, params=params, headers=tracing.headers())
+                except httpx.RequestError as e:
+                    raise UpstreamUnreachable(url, e)
+        span.set(status=resp.status_code, bytes=len(resp.content))
 
     try:
         body = resp.json()
@@ -72,16 +241,54 @@ async def _proxy_get(base_url: str, path: str, params: dict):
     return body
 
 
+async def _proxy_recommender(
+    mode: Mode, path: str, params: dict, priority: int = NORMAL, user_id: Optional[str] = None
+) -> tuple[object, str]:
+    """GET `path` from one of the mode's recommender replicas; (body, replica URL).
+
+    With a user id the user's own replica is used, else the least busy one.
+    An unreachable replica counts against it and the next one is tried.
+    """
+    replicas = recommenders[mode]
+    tried: list[str] = []
+    while True:
+        replica = replicas.pick(user_id, exclude=tried)
+        tried.append(replica.url)
+        try:
+            with replicas.track(replica):
+                body = await _proxy_get(replica.url, path, params=params, priority=priority)
+        except UpstreamUnreachable as e:
+            replicas.failed(replica, e.detail)
+            if len(tried) >= min(GATEWAY_REPLICA_ATTEMPTS, len(replicas.replicas)):
+                raise
+            continue
+        except Overloaded:
+            raise
+        except HTTPException as e:
+            if e.status_code >= 500:
+                replicas.failed(replica, f"{path} returned {e.status_code}")
+            else:
+                replicas.succeeded(replica)
+            raise
+        replicas.succeeded(replica)
+        tracing.annotate(mode=mode, replica=replica.url, attempts=len(tried))
+        return body, replica.url
+
+
 async def _check_http_health(name: str, base_url: str) -> tuple[str, str]:
     url = f"{base_url.rstrip('/')}/health"
-    async with httpx.AsyncClient(timeout=TIMEOUT_SECONDS) as client:
-        try:
-            resp = await client.get(url)
-            if resp.status_code == 200:
-                return name, "healthy"
-            return name, f"unhealthy ({resp.status_code})"
-        except httpx.RequestError:
-            return name, "unreachable"
+    try:
+        async with admission.upstream(base_url.rstrip("/")).slot(LOW):
+            async with httpx.AsyncClient(timeout=TIMEOUT_SECONDS) as client:
+                resp = await client.get(url)
+    except httpx.RequestError:
+        return name, "unreachable"
+    except HTTPException:
+        # Shed: the upstream is busy with higher-priority traffic.
+        return name, "busy"
+    if resp.status_code == 200:
+        return name, "healthy"
+    return name, f"unhealthy ({resp.status_code})"
 
 
 def _check_tcp(name: str, host: str, port: int) -> tuple[str, str]:
@@ -94,7 +301,50 @@ def _check_tcp(name: str, host: str, port: int) -> tuple[str, str]:
 
 @app.get("/health")
 def health():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "admission": admission.stats(),
+        "recommenders": {mode: replicas.stats() for mode, replicas in recommenders.items()},
+        "tracing": tracer.stats(),
+    }
+
+
+@app.get("/traces")
+def traces(min_ms: float = TRACE_SLOW_MS, limit: int = 20):
+    """Recent gateway requests that took at least `min_ms`, newest first, with their gateway spans."""
+    return {"minMs": min_ms, "traces": tracer.slow_traces(min_ms, max(1, min(limit, 200)))}
+
+
+@app.get("/traces/{trace_id}")
+async def trace(trace_id: str):
+    """Every span of one trace, from the gateway and from each service behind it."""
+    if not re.fullmatch(r"[0-9a-f]{32}", trace_id):
+        raise HTTPException(status_code=422, detail="trace_id must be 32 lowercase hex digits")
+    urls = [
+        *(url for replicas in recommenders.values() for url in replicas.replicas),
+        AIRLINE_DATA_SERVICE_URL,
+        RAIL_DATA_SERVICE_URL,
+    ]
+    async with httpx.AsyncClient(timeout=min(TIMEOUT_SECONDS, 3.0)) as client:
+        results = await asyncio.gather(
+            *(client.get(f"{url}/traces/{trace_id}") for url in urls), return_exceptions=True
+        )
+    spans = tracer.trace(trace_id)
+    unreachable = []
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception) or result.status_code != 200:
+            unreachable.append(url)
+            continue
+        spans.extend(result.json()["spans"])
+    spans.sort(key=lambda span: span["start"])
+    return {"traceId": trace_id, "spans": spans, "unreachable": unreachable}
+
+
+def _recommender_checks(name: str, urls: list[str]) -> list:
+    # One entry per replica: "airline-recommender-service", or "-1", "-2", ... with several.
+    if len(urls) == 1:
+        return [_check_http_health(name, urls[0])]
+    return [_check_http_health(f"{name}-{i}", url) for i, url in enumerate(urls, start=1)]
 
 
 @app.get("/service-health")
@@ -107,9 +357,9 @@ async def service_health():
     checks = [
         _check_http_health("gateway-server", "http://127.0.0.1:9000"),
         _check_http_health("airline-data-service", AIRLINE_DATA_SERVICE_URL),
-        _check_http_health("airline-recommender-service", AIRLINE_RECOMMENDER_URL),
+        *_recommender_checks("airline-recommender-service", AIRLINE_RECOMMENDER_URLS),
         _check_http_health("rail-data-service", RAIL_DATA_SERVICE_URL),
-        _check_http_health("rail-recommender-service", RAIL_RECOMMENDER_URL),
+        *_recommender_checks("rail-recommender-service", RAIL_RECOMMENDER_URLS),
     ]
 
     results: dict[str, str] = {}
@@ -132,22 +382,32 @@ async def recommend_route(
     mode: Optional[Mode] = None,
     user_id: Optional[str] = None,
     top_n: int = 10,
+    depart_after: Optional[str] = None,
+    depart_before: Optional[str] = None,
+    cursor: Optional[str] = None,
 ):
     if not (source or "").strip() or not (destination or "").strip():
         raise HTTPException(status_code=422, detail="source and destination are required")
 
     chosen_mode: Mode = mode or _auto_detect_mode(source, destination)
-    base_url = _base_url_for_mode(chosen_mode)
-
-    payload = await _proxy_get(
-        base_url,
-        "/recommend-route",
-        params={
-            "source": source,
-            "destination": destination,
-            "user_id": user_id,
-            "top_n": top_n,
-        },
+
+    params = {
+        "source": source,
+        "destination": destination,
+        "user_id": user_id,
+        "top_n": top_n,
+    }
+    # Departure window (ISO-8601, inclusive); only forwarded when given.
+    if depart_after:
+        params["depart_after"] = depart_after
+    if depart_before:
+        params["depart_before"] = depart_before
+    # Opaque page cursor from the previous response's nextCursor.
+    if cursor:
+        params["cursor"] = cursor
+
+    payload, base_url = await _proxy_recommender(
+        chosen_mode, "/recommend-route", params, priority=HIGH, user_id=user_id
     )
 
     return {
@@ -157,10 +417,58 @@ async def recommend_route(
     }
 
 
+@app.get("/itineraries")
+async def itineraries(
+    source: str,
+    destination: str,
+    mode: Optional[Mode] = None,
+    user_id: Optional[str] = None,
+    top_k: int = 5,
+    max_legs: Optional[int] = None,
+    min_connection_minutes: Optional[float] = None,
+    max_connection_minutes: Optional[float] = None,
+    depart_after: Optional[str] = None,
+    depart_before: Optional[str] = None,
+):
+    if not (source or "").strip() or not (destination or "").strip():
+        raise HTTPException(status_code=422, detail="source and destination are required")
+
+    chosen_mode: Mode = mode or _auto_detect_mode(source, destination)
+
+    params = {"source": source, "destination": destination, "user_id": user_id, "top_k": top_k}
+    # Search limits default to the recommender's own settings; only forwarded when given.
+    optional = {
+        "max_legs": max_legs,
+        "min_connection_minutes": min_connection_minutes,
+        "max_connection_minutes": max_connection_minutes,
+        "depart_after": depart_after,
+        "depart_before": depart_before,
+    }
+    params.update({key: value for key, value in optional.items() if value is not None and value != ""})
+
+    payload, base_url = await _proxy_recommender(chosen_mode, "/itineraries", params, user_id=user_id)
+
+    return {
+        **(payload if isinstance(payload, dict) else {"data": payload}),
+        "mode": chosen_mode,
+        "upstream": base_url,
+    }
+
+
+@app.get("/suggest")
+async def suggest(prefix: str, mode: Optional[Mode] = None, limit: int = 10):
+    """Known codes starting with `prefix`, with the modes that serve each."""
+    limit = max(1, min(limit, 100))
+    return {"prefix": prefix, "codes": registry.suggest(prefix, limit=limit, mode=mode)}
+
+
 @app.get("/recommend/{user_id}")
-async def recommend_user(user_id: str, mode: Mode, top_n: int = 10):
+async def recommend_user(user_id: str, mode: Mode, top_n: int = 10, cursor: Optional[str] = None):
     if not (user_id or "").strip():
         raise HTTPException(status_code=422, detail="user_id is required")
 
-    base_url = _base_url_for_mode(mode)
-    return await _proxy_get(base_url, f"/recommend/{user_id}", params={"top_n": top_n})
+    params = {"top_n": top_n}
+    if cursor:
+        params["cursor"] = cursor
+    payload, _ = await _proxy_recommender(mode, f"/recommend/{user_id}", params, priority=HIGH, user_id=user_id)
+    return payload
@@ -0,0 +1,81 @@
+"""In-memory registry of the airport and station codes each mode serves.
+
+Built from the data-services' `GET /codes` lists and replaced as a whole on
+every refresh, so readers never see a half-built registry. Codes match
+case-insensitively, like the data-services' route queries. Exact lookups
+are dict hits; prefix suggestions walk a trie.
+"""
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class _Node:
+    __slots__ = ("children", "key")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.key: Optional[str] = None
+
+
+class CodeTrie:
+    """Prefix trie over lower-cased code keys."""
+
+    def __init__(self, keys: Iterable[str] = ()):
+        self._root = _Node()
+        for key in keys:
+            self.insert(key)
+
+    def insert(self, key: str) -> None:
+        node = self._root
+        for char in key:
+            node = node.children.setdefault(char, _Node())
+        node.key = key
+
+    def with_prefix(self, prefix: str, limit: int, accept: Optional[Callable[[str], bool]] = None) -> List[str]:
+        """Up to `limit` keys starting with `prefix` (and passing `accept`), in lexicographic order."""
+        node = self._root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return []
+        found: List[str] = []
+        stack = [node]
+        while stack and len(found) < limit:
+            node = stack.pop()
+            if node.key is not None and (accept is None or accept(node.key)):
+                found.append(node.key)
+            # Reverse order on the stack pops the smallest child first.
+            stack.extend(node.children[char] for char in sorted(node.children, reverse=True))
+        return found
+
+
+class CodeRegistry:
+    def __init__(self, codes_by_mode: Dict[str, Iterable[str]]):
+        self._modes: Dict[str, Tuple[str, ...]] = {}
+        self._display: Dict[str, str] = {}
+        for mode, codes in codes_by_mode.items():
+            for code in codes:
+                key = code.strip().lower()
+                if not key:
+                    continue
+                self._display.setdefault(key, code.strip())
+                if mode not in self._modes.get(key, ()):
+                    self._modes[key] = self._modes.get(key, ()) + (mode,)
+        self._trie = CodeTrie(self._modes)
+
+    def __len__(self) -> int:
+        return len(self._modes)
+
+    def modes(self, code: str) -> Tuple[str, ...]:
+        return self._modes.get(code.strip().lower(), ())
+
+    def mode_for(self, source: str, destination: str) -> Optional[str]:
+        """The one mode serving both codes, or None when unknown or ambiguous."""
+        shared = set(self.modes(source)) & set(self.modes(destination))
+        return shared.pop() if len(shared) == 1 else None
+
+    def suggest(self, prefix: str, limit: int = 10, mode: Optional[str] = None) -> List[dict]:
+        """Codes starting with `prefix` (case-insensitive), optionally only those `mode` serves."""
+        prefix = prefix.strip().lower()
+        accept = None if mode is None else (lambda key: mode in self._modes[key])
+        keys = self._trie.with_prefix(prefix, limit, accept)
+        return [{"code": self._display[key], "modes": list(self._modes[key])} for key in keys]
@@ -0,0 +1,179 @@
+"""Checks for gateway modules that need no running services.
+
+Run from this directory with the gateway requirements installed: python test_units.py
+"""
+import asyncio
+import sys
+
+from app.admission import HIGH, LOW, NORMAL, ClientLimits, Overloaded, RateLimited, TokenBucket, Upstream
+from app.balancer import HashRing, ReplicaSet
+
+
+def _assert(condition: bool, message: str):
+    if not condition:
+        raise AssertionError(message)
+
+
+async def _hold(upstream: Upstream, priority: int, release: asyncio.Event, order: list, name: str):
+    async with upstream.slot(priority):
+        order.append(name)
+        await release.wait()
+
+
+async def _admission():
+    # Low priority may only fill its share of the slots; high priority can use all of them.
+    upstream = Upstream("up", max_concurrency=4, rate=0, burst=1, max_wait=5.0)
+    release, order = asyncio.Event(), []
+    lows = [asyncio.create_task(_hold(upstream, LOW, release, order, f"low{i}")) for i in range(2)]
+    await asyncio.sleep(0.01)
+    _assert(order == ["low0"], f"Expected one low-priority slot of four, got {order}")
+    highs = [asyncio.create_task(_hold(upstream, HIGH, release, order, f"high{i}")) for i in range(3)]
+    await asyncio.sleep(0.01)
+    print(f"- 2 low then 3 high calls on 4 slots -> admitted {order}")
+    _assert(order == ["low0", "high0", "high1", "high2"], f"High priority did not get the free slots: {order}")
+
+    # Queued calls are admitted by priority, not arrival.
+    normal = asyncio.create_task(_hold(upstream, NORMAL, release, order, "normal"))
+    high = asyncio.create_task(_hold(upstream, HIGH, release, order, "high3"))
+    await asyncio.sleep(0.01)
+    release.set()
+    await asyncio.gather(*lows, *highs, normal, high)
+    print(f"- queued low, normal, high -> admitted in order {order[4:]}")
+    _assert(order[4:6] == ["high3", "normal"], f"Queued calls were not admitted by priority: {order}")
+    _assert(upstream.in_flight == 0 and not upstream._waiters, "Slots leaked after every call finished")
+
+    # A call whose expected wait is past its budget is shed at once.
+    upstream = Upstream("slow", max_concurrency=1, rate=0, burst=1, max_wait=1.0)
+    upstream.latency = 2.0
+    release = asyncio.Event()
+    holder = asyncio.create_task(_hold(upstream, HIGH, release, [], "holder"))
+    await asyncio.sleep(0.01)
+    try:
+        async with upstream.slot(NORMAL):
+            pass
+    except Overloaded as e:
+        print(f"- call expected to wait 2 s with a 0.5 s budget -> {e.status_code}")
+        _assert(e.headers.get("Retry-After") == "2", f"Unexpected Retry-After: {e.headers}")
+    else:
+        raise AssertionError("Expected a call past its wait budget to be shed")
+
+    # A caller that goes away while queued gives its place up.
+    upstream.latency = 0.0
+    waiter = asyncio.create_task(_hold(upstream, HIGH, release, [], "waiter"))
+    await asyncio.sleep(0.01)
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    release.set()
+    await holder
+    _assert(upstream.in_flight == 0 and not upstream._waiters, "A cancelled waiter leaked a slot")
+
+    # An upstream over its request rate sheds instead of queueing.
+    upstream = Upstream("rated", max_concurrency=10, rate=1, burst=1, max_wait=5.0)
+    async with upstream.slot(HIGH):
+        pass
+    try:
+        async with upstream.slot(HIGH):
+            pass
+    except Overloaded as e:
+        print(f"- second call on a 1/s upstream -> {e.status_code}")
+    else:
+        raise AssertionError("Expected a call over the upstream rate to be shed")
+
+
+def test_admission():
+    print("\nTesting admission")
+
+    bucket = TokenBucket(rate=10, burst=2)
+    waits = [bucket.take() for _ in range(3)]
+    _assert(waits[:2] == [0.0, 0.0] and 0 < waits[2] <= 0.1, f"Unexpected token bucket waits {waits}")
+    _assert(TokenBucket(rate=0, burst=1).take() == 0.0, "A rate of 0 should never limit")
+
+    clients = ClientLimits(rate=1, burst=2)
+    clients.check("a")
+    clients.check("a")
+    try:
+        clients.check("a")
+    except RateLimited as e:
+        print(f"- third call from a client with burst 2 -> {e.status_code}")
+    else:
+        raise AssertionError("Expected a client over its burst to be rate limited")
+    clients.check("b")
+
+    asyncio.run(_admission())
+
+
+def test_balancer():
+    print("\nTesting balancer")
+    users = [f"user-{i}" for i in range(5000)]
+
+    urls = [f"http://replica-{i}" for i in range(4)]
+    ring = HashRing(urls)
+    owners = {user: next(ring.walk(user)) for user in users}
+    shares = [sum(owner == url for owner in owners.values()) / len(users) for url in urls]
+    print(f"- users per replica of 4: {[round(share, 3) for share in shares]}")
+    _assert(all(0.15 < share < 0.35 for share in shares), f"Users are spread unevenly: {shares}")
+    _assert(sorted(ring.walk(users[0])) == sorted(urls), "walk should visit every replica once")
+
+    grown = HashRing(urls + ["http://replica-4"])
+    moved = [user for user in users if next(grown.walk(user)) != owners[user]]
+    print(f"- adding a fifth replica moves {len(moved) / len(users):.3f} of users")
+    _assert(len(moved) / len(users) < 0.3, "Adding a replica moved too many users")
+    _assert(all(next(grown.walk(user)) == "http://replica-4" for user in moved), "Users moved between old replicas")
+
+    replicas = ReplicaSet(urls + ["http://replica-0/", " "], eject_seconds=30, failure_threshold=2)
+    _assert(list(replicas.replicas) == urls, f"Replica URLs were not normalized: {list(replicas.replicas)}")
+
+    user = users[0]
+    home = replicas.pick(user)
+    _assert(all(replicas.pick(user) is home for _ in range(10)), "A user's requests left their replica")
+
+    # Failures past the threshold eject the replica; its users move on and come back afterwards.
+    replicas.failed(home, "boom")
+    _assert(replicas.pick(user) is home, "One failure should not eject a replica")
+    replicas.failed(home, "boom")
+    moved_to = replicas.pick(user)
+    print(f"- after {replicas.failure_threshold} failures {home.url} -> {moved_to.url}")
+    _assert(moved_to is not home, "An ejected replica still got its users")
+    home.ejected_until = 0.0
+    _assert(replicas.pick(user) is home, "The user did not return to their replica")
+
+    # Replicas still training are only used when none is ready.
+    for replica in replicas.replicas.values():
+        replicas.checked(replica, ready=replica is home)
+    _assert(all(replicas.pick(u) is home for u in users[:50]), "A not-ready replica got traffic")
+    replicas.checked(home, ready=False)
+    _assert(replicas.pick(user) is home, "With no replica ready, users should keep their replica")
+
+    # Anonymous requests go to the least loaded replica; excluded replicas are skipped.
+    for replica in replicas.replicas.values():
+        replicas.checked(replica, ready=True)
+    busy = [replicas.replicas[url] for url in urls[:3]]
+    with replicas.track(busy[0]), replicas.track(busy[1]), replicas.track(busy[2]):
+        _assert(replicas.pick().url == urls[3], "An anonymous request did not go to the idle replica")
+        _assert(replicas.pick(exclude=[urls[3]]).url != urls[3], "An excluded replica was picked")
+    _assert(all(replica.outstanding == 0 for replica in replicas.replicas.values()), "track leaked a count")
+
+    # With every replica ejected, all of them are tried again rather than none.
+    for replica in replicas.replicas.values():
+        replicas.checked(replica, ready=None, error="unreachable")
+    _assert(replicas.pick(user).url in urls, "No replica was picked with every replica ejected")
+    try:
+        replicas.pick(user, exclude=urls)
+    except LookupError:
+        pass
+    else:
+        raise AssertionError("Expected LookupError with every replica excluded")
+
+
+def main():
+    try:
+        test_admission()
+        test_balancer()
+    except AssertionError as e:
+        print(f"\nTEST FAILED: {e}")
+        sys.exit(1)
+    print("\nAll tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Catalog read cache keyed by query and catalog version, with conditional GET.
+
+Every write to a catalog table bumps its row in `catalog_versions` (a
+statement-level trigger, so writes from any process or from psql count).
+Reads are served from an in-process cache of encoded response bodies; the
+version is re-read from Postgres at most every `check_interval` seconds,
+and immediately after a write made through this process. A changed version
+drops every cached result.
+
+Each cached body carries an ETag (a digest of the body), so clients that
+send `If-None-Match` get a 304 without a body, and without a database round
+trip while the version is fresh.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, NamedTuple, Optional
+
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+
+import tracing
+
+NOT_FOUND = object()
+
+
+def version_sql(table: str) -> str:
+    """Idempotent DDL for the version row of `table` and the trigger that bumps it."""
+    return f"""
+CREATE TABLE IF NOT EXISTS catalog_versions (
+  name TEXT PRIMARY KEY,
+  version BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+BEGIN
+  UPDATE catalog_versions SET version = version + 1 WHERE name = TG_TABLE_NAME;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO catalog_versions (name) VALUES ('{table}') ON CONFLICT (name) DO NOTHING;
+
+CREATE OR REPLACE TRIGGER {table}_catalog_version
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+  FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+"""
+
+
+class Entry(NamedTuple):
+    body: Optional[bytes]
+    etag: Optional[str]
+
+
+class CatalogCache:
+    def __init__(self, connect: Callable, table: str, check_interval: float = 1.0, max_entries: int = 1024):
+        self._connect = connect
+        self.table = table
+        self.check_interval = check_interval
+        self.max_entries = max_entries
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+        self._entries: "OrderedDict[Hashable, Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def version(self) -> int:
+        """The catalog version, re-read from Postgres when the last read is stale."""
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self.check_interval:
+            return self._version
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT version FROM catalog_versions WHERE name = %s", (self.table,))
+                row = cur.fetchone()
+        version = int(row[0]) if row else 0
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._checked_at = now
+        return version
+
+    def invalidate(self) -> None:
+        """Re-read the version on the next request (call after writing the table)."""
+        self._checked_at = 0.0
+
+    def get(self, key: Hashable, load: Callable[[], Any]) -> Entry:
+        """The cached result for `key`, loading it on a miss; `load` returns `NOT_FOUND` for a 404."""
+        version = self.version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                tracing.annotate(cacheHit=True)
+                return entry
+
+        tracing.annotate(cacheHit=False)
+        with tracing.span("catalog load", table=self.table):
+            result = load()
+        if result is NOT_FOUND:
+            entry = Entry(None, None)
+        else:
+            body = json.dumps(jsonable_encoder(result), separators=(",", ":")).encode()
+            entry = Entry(body, '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest())
+
+        with self._lock:
+            # Don't keep a result loaded while the version moved on.
+            if version == self._version:
+                self._entries[key] = entry
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def respond(self, request: Request, key: Hashable, load: Callable[[], Any], not_found: str) -> Response:
+        """A cached JSON response, or 304 when the client's `If-None-Match` matches."""
+        entry = self.get(key, load)
+        if entry.body is None:
+            raise HTTPException(status_code=404, detail=not_found)
+        headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+        if _matches(request.headers.get("if-none-match"), entry.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison, as If-None-Match requires.
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
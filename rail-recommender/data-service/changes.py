@@ -0,0 +1,227 @@
+"""Catalog change feed: a change log kept by triggers, streamed as Server-Sent Events.
+
+A row-level trigger appends (op, key) to `catalog_changes` for every insert,
+update and delete on the catalog table, and wakes listeners with
+`NOTIFY catalog_changes`. A TRUNCATE is logged too, as a reset.
+
+`GET /changes?since=<id>` streams the log after `id` and then waits on
+LISTEN for more. Changes are sent in batches, coalesced per key against the
+table's current rows: a key whose row exists is an upsert (the full row, as
+the catalog endpoints return it), any other key is a delete. Each event's
+SSE id is the last change it covers, so clients resume with
+`Last-Event-ID` or `since`. A `reset` event means the client cannot catch
+up from the log (it was truncated or pruned past `since`) and should reload
+the whole catalog.
+
+The log's ids only work as a cursor if they become visible in id order: a
+transaction that took lower ids but committed after a higher one would be
+skipped for good. So every statement that writes the catalog first takes a
+transaction-level advisory lock, held until commit; writers that reach the
+log queue behind each other, and ids commit in order. The lock is taken
+before the statement touches any row, so writers cannot deadlock on it.
+"""
+import asyncio
+import json
+import select
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi.responses import StreamingResponse
+from psycopg2.extras import RealDictCursor
+
+CHANNEL = "catalog_changes"
+BATCH_SIZE = 1000
+HEARTBEAT_SECONDS = 15.0
+
+
+def changes_sql(table: str, key_column: str, retention_days: float) -> str:
+    """Idempotent DDL for the change log and the triggers on `table`; prunes old entries."""
+    return f"""
+CREATE TABLE IF NOT EXISTS catalog_changes (
+  id BIGSERIAL PRIMARY KEY,
+  table_name TEXT NOT NULL,
+  op TEXT NOT NULL,
+  item_key TEXT NOT NULL,
+  changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS catalog_changes_table_id_idx ON catalog_changes (table_name, id);
+
+CREATE OR REPLACE FUNCTION log_catalog_change() RETURNS trigger AS $$
+DECLARE
+  new_key TEXT;
+  old_key TEXT;
+BEGIN
+  IF TG_OP <> 'DELETE' THEN
+    new_key := to_jsonb(NEW) ->> TG_ARGV[0];
+    INSERT INTO catalog_changes (table_name, op, item_key) VALUES (TG_TABLE_NAME, TG_OP, new_key);
+  END IF;
+  IF TG_OP <> 'INSERT' THEN
+    old_key := to_jsonb(OLD) ->> TG_ARGV[0];
+    IF old_key IS DISTINCT FROM new_key THEN
+      INSERT INTO catalog_changes (table_name, op, item_key) VALUES (TG_TABLE_NAME, 'DELETE', old_key);
+    END IF;
+  END IF;
+  -- Identical notifications in one transaction are delivered once.
+  PERFORM pg_notify('{CHANNEL}', TG_TABLE_NAME);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION lock_catalog_changes() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_advisory_xact_lock(hashtext('{CHANNEL}'));
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION log_catalog_truncate() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO catalog_changes (table_name, op, item_key) VALUES (TG_TABLE_NAME, 'TRUNCATE', '');
+  PERFORM pg_notify('{CHANNEL}', TG_TABLE_NAME);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER {table}_lock_changes
+  BEFORE INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+  FOR EACH STATEMENT EXECUTE FUNCTION lock_catalog_changes();
+
+CREATE OR REPLACE TRIGGER {table}_log_changes
+  AFTER INSERT OR UPDATE OR DELETE ON {table}
+  FOR EACH ROW EXECUTE FUNCTION log_catalog_change('{key_column}');
+
+CREATE OR REPLACE TRIGGER {table}_log_truncate
+  AFTER TRUNCATE ON {table}
+  FOR EACH STATEMENT EXECUTE FUNCTION log_catalog_truncate();
+
+DELETE FROM catalog_changes WHERE changed_at < now() - interval '{float(retention_days)} days';
+"""
+
+
+def head(connect: Callable, table: str) -> int:
+    """Id of the latest logged change to `table` (0 if none)."""
+    with connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM catalog_changes WHERE table_name = %s", (table,))
+            return int(cur.fetchone()[0])
+
+
+def change_feed(
+    connect: Callable,
+    table: str,
+    key_column: str,
+    columns: str,
+    since: Optional[int],
+    listen: Optional[Callable] = None,
+) -> StreamingResponse:
+    """SSE stream of `table`'s changes after `since` (from the current head when None).
+
+    `columns` is the select list of the rows the catalog endpoints return.
+    The stream holds a `listen()` connection (`connect()` by default) open
+    for LISTEN while it lasts.
+    """
+    return StreamingResponse(
+        _events(listen or connect, connect, table, key_column, columns, since),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _events(
+    listen: Callable,
+    connect: Callable,
+    table: str,
+    key_column: str,
+    columns: str,
+    since: Optional[int],
+):
+    # Listen before the first read so no notification falls in between.
+    listener = await asyncio.to_thread(_listen, listen)
+    try:
+        if since is None:
+            since = await asyncio.to_thread(head, connect, table)
+        yield _event("hello", since, {"since": since})
+
+        while True:
+            last, upserts, deletes, reset = await asyncio.to_thread(
+                _read_changes, connect, table, key_column, columns, since
+            )
+            if reset:
+                since = last
+                yield _event("reset", since, {})
+                continue
+            if last > since:
+                since = last
+                yield _event("changes", since, {"upserts": upserts, "deletes": deletes})
+                continue
+
+            readable, _, _ = await asyncio.to_thread(select.select, [listener], [], [], HEARTBEAT_SECONDS)
+            if readable:
+                listener.poll()
+                listener.notifies.clear()
+            else:
+                yield ": keepalive\n\n"
+    finally:
+        listener.close()
+
+
+def _listen(listen: Callable):
+    """A `listen()` connection subscribed to the change channel."""
+    listener = listen()
+    try:
+        with listener.cursor() as cur:
+            cur.execute(f"LISTEN {CHANNEL}")
+    except Exception:
+        listener.close()
+        raise
+    return listener
+
+
+def _read_changes(
+    connect: Callable,
+    table: str,
+    key_column: str,
+    columns: str,
+    since: int,
+) -> Tuple[int, List[Dict], List[str], bool]:
+    """(last change id, upserted rows, deleted keys, reset) for the next batch after `since`."""
+    with connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT MIN(id), MAX(id) FROM catalog_changes WHERE table_name = %s", (table,))
+            oldest, newest = cur.fetchone()
+            # Entries after `since` were pruned, or `since` is from another log.
+            if (oldest is not None and since < oldest - 1) or since > (newest or 0):
+                return int(newest or 0), [], [], True
+
+            cur.execute(
+                """
+                SELECT id, op, item_key FROM catalog_changes
+                WHERE table_name = %s AND id > %s
+                ORDER BY id
+                LIMIT %s
+                """,
+                (table, since, BATCH_SIZE),
+            )
+            changes = cur.fetchall()
+        if not changes:
+            return since, [], [], False
+
+        for change_id, op, _ in changes:
+            if op == "TRUNCATE":
+                return int(change_id), [], [], True
+        last = int(changes[-1][0])
+        keys = list(dict.fromkeys(key for _, _, key in changes))
+
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                f"SELECT {columns}, {key_column}::text AS _key FROM {table} WHERE {key_column}::text = ANY(%s)",
+                (keys,),
+            )
+            rows = {row.pop("_key"): row for row in cur.fetchall()}
+    upserts = [rows[key] for key in keys if key in rows]
+    deletes = [key for key in keys if key not in rows]
+    return last, upserts, deletes, False
+
+
+def _event(name: str, event_id: int, data: dict) -> str:
+    return f"id: {event_id}\nevent: {name}\ndata: {json.dumps(data, default=str)}\n\n"
@@ -0,0 +1,275 @@
+# One module, copied into each service because every service is built from its own directory:
+#   gateway-server/app/tracing.py
+#   airline-recommender/data-service/tracing.py
+#   airline-recommender/recommender-service/tracing.py
+#   rail-recommender/data-service/tracing.py
+#   rail-recommender/recommender-service/tracing.py
+# Change all five together; `python check_tracing.py` at the repo root fails while they differ.
+"""Request tracing across the gateway, recommenders and data-services, with no external backend.
+
+A trace starts where a request enters (the gateway, or any service called
+without one) and travels in the W3C `traceparent` header on every call a
+traced request makes. Each service records its own spans: name, start,
+duration, and attributes such as item counts or cache hits. They go into a
+bounded in-memory ring buffer, and optionally also into a JSONL file that a
+background thread appends to. A full export queue drops spans rather than
+slowing requests.
+
+`GET /traces` on a service lists its recent slow traces; `GET
+/traces/{trace_id}` returns every span it holds for one trace.
+
+Server spans last until the response body is sent, so streamed exports are
+timed in full. Work outside a request (such as a recommender training at
+startup) opens its own root span with `Tracer.span`. Outside any span,
+`span`, `annotate` and `headers` do nothing.
+"""
+import contextvars
+import json
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+UNTRACED_PATHS = ("/health", "/ready", "/traces")
+
+_current: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent_id: Optional[str], attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self.start = time.time()
+        self.duration_ms: Optional[float] = None
+        self._started = time.perf_counter()
+        self._tokens: List[contextvars.Token] = []
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        self._tokens.append(_current.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc is not None and self.error is None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _current.reset(self._tokens.pop())
+        self.end()
+
+    def end(self) -> None:
+        if self.duration_ms is None:
+            self.duration_ms = round((time.perf_counter() - self._started) * 1000, 3)
+            self.tracer.record(self)
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentId": self.parent_id,
+            "service": self.tracer.service,
+            "name": self.name,
+            "start": self.start,
+            "durationMs": self.duration_ms,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoSpan:
+    """Stands in for a span outside any trace."""
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+class JsonlExporter:
+    """Appends spans to `path`, one JSON object per line, from a background thread.
+
+    Past `max_bytes` the file is moved to `path.1` (replacing the previous one).
+    """
+
+    def __init__(self, path: str, max_bytes: int = 100_000_000, max_queue: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._queue: "queue.Queue[dict]" = queue.Queue(max_queue)
+        threading.Thread(target=self._write_forever, name="trace-export", daemon=True).start()
+
+    def put(self, span: dict) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_forever(self) -> None:
+        while True:
+            lines = [self._queue.get()]
+            while len(lines) < 1000:
+                try:
+                    lines.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(lines)
+            except OSError as e:
+                self.dropped += len(lines)
+                print(f"Trace export to {self.path} failed: {e}")
+
+    def _write(self, spans: List[dict]) -> None:
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            os.replace(self.path, f"{self.path}.1")
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(span, separators=(",", ":"), default=str) + "\n" for span in spans)
+
+
+class Tracer:
+    def __init__(
+        self,
+        service: str,
+        max_spans: int = 10000,
+        export_path: Optional[str] = None,
+        export_max_bytes: int = 100_000_000,
+    ):
+        self.service = service
+        self._spans: "deque[Span]" = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self.exporter = JsonlExporter(export_path, export_max_bytes) if export_path else None
+
+    def span(self, name: str, traceparent: Optional[str] = None, **attributes: Any) -> Span:
+        """A child of the current span; else continues `traceparent`, or starts a new trace."""
+        parent = _current.get()
+        if parent is not None:
+            return Span(self, name, parent.trace_id, parent.span_id, attributes)
+        match = TRACEPARENT.match((traceparent or "").strip().lower())
+        if match:
+            return Span(self, name, match.group(1), match.group(2), attributes)
+        return Span(self, name, secrets.token_hex(16), None, attributes)
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+        if self.exporter is not None:
+            self.exporter.put(span.to_dict())
+
+    def trace(self, trace_id: str) -> List[dict]:
+        """Every span held for `trace_id`, in start order."""
+        with self._lock:
+            spans = [span for span in self._spans if span.trace_id == trace_id]
+        return [span.to_dict() for span in sorted(spans, key=lambda span: span.start)]
+
+    def slow_traces(self, min_ms: float, limit: int = 20) -> List[dict]:
+        """Recent traces whose first span here took at least `min_ms`, newest first, with their spans."""
+        with self._lock:
+            spans = list(self._spans)
+        by_trace: Dict[str, List[Span]] = {}
+        for span in spans:
+            by_trace.setdefault(span.trace_id, []).append(span)
+        traces = []
+        for trace_id, members in by_trace.items():
+            local = {span.span_id for span in members}
+            # The span that entered this service: its parent, if any, is elsewhere.
+            entry = min((span for span in members if span.parent_id not in local), key=lambda span: span.start)
+            if entry.duration_ms >= min_ms:
+                traces.append((entry, members))
+        traces.sort(key=lambda trace: trace[0].start, reverse=True)
+        return [
+            {
+                "traceId": entry.trace_id,
+                "name": entry.name,
+                "start": entry.start,
+                "durationMs": entry.duration_ms,
+                "error": entry.error,
+                "spans": [span.to_dict() for span in sorted(members, key=lambda span: span.start)],
+            }
+            for entry, members in traces[:limit]
+        ]
+
+    def stats(self) -> dict:
+        with self._lock:
+            held = len(self._spans)
+        return {
+            "spans": held,
+            "capacity": self._spans.maxlen,
+            "exportDropped": self.exporter.dropped if self.exporter is not None else 0,
+        }
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+def span(name: str, **attributes: Any):
+    """A child span of the current span (a no-op outside any trace)."""
+    parent = _current.get()
+    if parent is None:
+        return _NoSpan()
+    return parent.tracer.span(name, **attributes)
+
+
+def annotate(**attributes: Any) -> None:
+    """Set attributes on the current span, if any."""
+    parent = _current.get()
+    if parent is not None:
+        parent.set(**attributes)
+
+
+def headers() -> Dict[str, str]:
+    """The `traceparent` header for an outgoing call from the current span ({} outside a trace)."""
+    parent = _current.get()
+    return {"traceparent": parent.traceparent()} if parent is not None else {}
+
+
+def install(app, tracer: Tracer, untraced: Iterable[str] = UNTRACED_PATHS) -> None:
+    """Trace every request to `app` except CORS preflights and paths under `untraced`."""
+    untraced = tuple(untraced)
+
+    @app.middleware("http")
+    async def trace_requests(request, call_next):
+        path = request.url.path
+        if request.method == "OPTIONS" or any(path == p or path.startswith(p + "/") for p in untraced):
+            return await call_next(request)
+        server = tracer.span(f"{request.method} {path}", request.headers.get("traceparent"))
+        if request.url.query:
+            server.set(query=request.url.query)
+        token = _current.set(server)
+        try:
+            response = await call_next(request)
+        except Exception as e:
+            server.error = f"{type(e).__name__}: {e}"
+            server.end()
+            raise
+        finally:
+            _current.reset(token)
+        server.set(status=response.status_code)
+        response.headers["traceparent"] = server.traceparent()
+        body = response.body_iterator
+
+        async def timed_body():
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                server.end()
+
+        response.body_iterator = timed_body()
+        return response
@@ -9,11 +9,227 @@ CREATE TABLE IF NOT EXISTS trains (
   destination TEXT NULL
 );
 
+-- Interactions, range-partitioned by month on ts (see data-service/partitions.py);
+-- the data-service creates upcoming partitions and applies retention.
+CREATE OR REPLACE FUNCTION parse_timestamp(value TEXT) RETURNS TIMESTAMPTZ AS $$
+BEGIN
+  RETURN value::timestamptz;
+EXCEPTION WHEN others THEN
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- Creates the partition of `parent` for the month (UTC) starting at `month`,
+-- moving that month's rows out of the default partition; false if it exists.
+CREATE OR REPLACE FUNCTION create_month_partition(parent TEXT, month DATE) RETURNS BOOLEAN AS $$
+DECLARE
+  first_day DATE := date_trunc('month', month)::date;
+  lower_bound TIMESTAMPTZ := first_day::timestamp AT TIME ZONE 'UTC';
+  upper_bound TIMESTAMPTZ := (first_day + interval '1 month')::timestamp AT TIME ZONE 'UTC';
+  part TEXT := parent || '_p' || to_char(first_day, 'YYYYMM');
+BEGIN
+  IF to_regclass(part) IS NOT NULL THEN
+    RETURN FALSE;
+  END IF;
+  EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS)', part, parent);
+  EXECUTE format(
+    'WITH moved AS (DELETE FROM %I WHERE ts >= %L AND ts < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+    parent || '_default', lower_bound, upper_bound, part
+  );
+  EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', parent, part, lower_bound, upper_bound);
+  RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Creates upcoming and parked-row partitions and applies retention; one row per action taken.
+CREATE OR REPLACE FUNCTION maintain_partitions(parent TEXT, months_ahead INT, keep_months INT, drop_old BOOLEAN)
+RETURNS TABLE (action TEXT, partition_name TEXT) AS $$
+DECLARE
+  this_month DATE := date_trunc('month', now() AT TIME ZONE 'UTC')::date;
+  months DATE[];
+  parked DATE[];
+  month DATE;
+  part TEXT;
+BEGIN
+  -- One maintainer per table at a time (several workers may run this).
+  PERFORM pg_advisory_xact_lock(hashtext('maintain_partitions:' || parent));
+  SELECT array_agg(m::date) INTO months
+  FROM generate_series(this_month::timestamp, this_month + make_interval(months => months_ahead), interval '1 month') m;
+  EXECUTE format(
+    'SELECT array_agg(DISTINCT date_trunc(''month'', ts AT TIME ZONE ''UTC'')::date) FROM %I', parent || '_default'
+  ) INTO parked;
+  FOREACH month IN ARRAY months || COALESCE(parked, '{}')
+  LOOP
+    IF create_month_partition(parent, month) THEN
+      action := 'created';
+      partition_name := parent || '_p' || to_char(month, 'YYYYMM');
+      RETURN NEXT;
+    END IF;
+  END LOOP;
+
+  IF keep_months > 0 THEN
+    FOR part IN
+      SELECT child.relname FROM pg_inherits
+      JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+      WHERE pg_inherits.inhparent = parent::regclass
+        AND child.relname ~ ('^' || parent || '_p[0-9]{6}$')
+        AND to_date(right(child.relname, 6), 'YYYYMM') < this_month - make_interval(months => keep_months)
+      ORDER BY child.relname
+    LOOP
+      IF drop_old THEN
+        EXECUTE format('DROP TABLE %I', part);
+        action := 'dropped';
+      ELSE
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, part);
+        action := 'detached';
+      END IF;
+      partition_name := part;
+      RETURN NEXT;
+    END LOOP;
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('train_interactions') AND relkind = 'r') THEN
+    ALTER TABLE train_interactions RENAME TO train_interactions_unpartitioned;
+  END IF;
+END $$;
+
 CREATE TABLE IF NOT EXISTS train_interactions (
-  id BIGSERIAL PRIMARY KEY,
+  id BIGSERIAL,
   user_id TEXT NOT NULL,
   train_number INTEGER NOT NULL REFERENCES trains(train_number) ON DELETE CASCADE,
   interaction_type TEXT NOT NULL,
-  ts TEXT NOT NULL,
-  rating DOUBLE PRECISION NULL
+  rating DOUBLE PRECISION NULL,
+  ts TIMESTAMPTZ NOT NULL,
+  PRIMARY KEY (id, ts)
+) PARTITION BY RANGE (ts);
+
+CREATE TABLE IF NOT EXISTS train_interactions_default PARTITION OF train_interactions DEFAULT;
+
+DO $$
+DECLARE
+  months DATE[];
+  month DATE;
+  skipped BIGINT;
+BEGIN
+  IF to_regclass('train_interactions_unpartitioned') IS NULL THEN
+    RETURN;
+  END IF;
+  SELECT array_agg(DISTINCT date_trunc('month', parse_timestamp(ts) AT TIME ZONE 'UTC')::date) INTO months
+  FROM train_interactions_unpartitioned
+  WHERE parse_timestamp(ts) IS NOT NULL;
+  FOREACH month IN ARRAY COALESCE(months, '{}')
+  LOOP
+    PERFORM create_month_partition('train_interactions', month);
+  END LOOP;
+  INSERT INTO train_interactions (id, user_id, train_number, interaction_type, rating, ts)
+  SELECT id, user_id, train_number, interaction_type, rating, parse_timestamp(ts) FROM train_interactions_unpartitioned WHERE parse_timestamp(ts) IS NOT NULL;
+  SELECT COUNT(*) INTO skipped FROM train_interactions_unpartitioned WHERE parse_timestamp(ts) IS NULL;
+  IF skipped > 0 THEN
+    RAISE WARNING 'train_interactions: % rows with unparseable timestamps were not migrated', skipped;
+  END IF;
+  PERFORM setval(pg_get_serial_sequence('train_interactions', 'id'), GREATEST((SELECT MAX(id) FROM train_interactions), 1));
+  DROP TABLE train_interactions_unpartitioned;
+END $$;
+
+SELECT * FROM maintain_partitions('train_interactions', 3, 0, false);
+
+-- Parsed departure time, kept in sync by a trigger, for indexed
+-- departure-window queries. NULL when the text is not a timestamp.
+CREATE OR REPLACE FUNCTION parse_departure(value TEXT) RETURNS TIMESTAMPTZ AS $$
+BEGIN
+  RETURN value::timestamptz;
+EXCEPTION WHEN others THEN
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+CREATE OR REPLACE FUNCTION set_departure_at() RETURNS trigger AS $$
+BEGIN
+  NEW.departure_at := parse_departure(NEW.departure);
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE trains ADD COLUMN IF NOT EXISTS departure_at TIMESTAMPTZ;
+
+CREATE OR REPLACE TRIGGER trains_departure_at
+  BEFORE INSERT OR UPDATE OF departure ON trains
+  FOR EACH ROW EXECUTE FUNCTION set_departure_at();
+
+UPDATE trains SET departure_at = parse_departure(departure) WHERE departure_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS trains_route_departure_idx
+  ON trains (LOWER(source), LOWER(destination), departure_at);
+
+-- Catalog version, bumped by every write to trains; the data-service keys its
+-- read cache and ETags on it.
+CREATE TABLE IF NOT EXISTS catalog_versions (
+  name TEXT PRIMARY KEY,
+  version BIGINT NOT NULL DEFAULT 0
 );
+
+CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+BEGIN
+  UPDATE catalog_versions SET version = version + 1 WHERE name = TG_TABLE_NAME;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO catalog_versions (name) VALUES ('trains') ON CONFLICT (name) DO NOTHING;
+
+CREATE OR REPLACE TRIGGER trains_catalog_version
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON trains
+  FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+
+-- Catalog change log for the data-service change feed (GET /changes):
+-- one row per changed train, with a NOTIFY to wake subscribers.
+CREATE TABLE IF NOT EXISTS catalog_changes (
+  id BIGSERIAL PRIMARY KEY,
+  table_name TEXT NOT NULL,
+  op TEXT NOT NULL,
+  item_key TEXT NOT NULL,
+  changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS catalog_changes_table_id_idx ON catalog_changes (table_name, id);
+
+CREATE OR REPLACE FUNCTION log_catalog_change() RETURNS trigger AS $$
+DECLARE
+  new_key TEXT;
+  old_key TEXT;
+BEGIN
+  IF TG_OP <> 'DELETE' THEN
+    new_key := to_jsonb(NEW) ->> TG_ARGV[0];
+    INSERT INTO catalog_changes (table_name, op, item_key) VALUES (TG_TABLE_NAME, TG_OP, new_key);
+  END IF;
+  IF TG_OP <> 'INSERT' THEN
+    old_key := to_jsonb(OLD) ->> TG_ARGV[0];
+    IF old_key IS DISTINCT FROM new_key THEN
+      INSERT INTO catalog_changes (table_name, op, item_key) VALUES (TG_TABLE_NAME, 'DELETE', old_key);
+    END IF;
+  END IF;
+  -- Identical notifications in one transaction are delivered once.
+  PERFORM pg_notify('catalog_changes', TG_TABLE_NAME);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION log_catalog_truncate() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO catalog_changes (table_name, op, item_key) VALUES (TG_TABLE_NAME, 'TRUNCATE', '');
+  PERFORM pg_notify('catalog_changes', TG_TABLE_NAME);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trains_log_changes
+  AFTER INSERT OR UPDATE OR DELETE ON trains
+  FOR EACH ROW EXECUTE FUNCTION log_catalog_change('train_number');
+
+CREATE OR REPLACE TRIGGER trains_log_truncate
+  AFTER TRUNCATE ON trains
+  FOR EACH STATEMENT EXECUTE FUNCTION log_catalog_truncate();
@@ -0,0 +1,13 @@
+#!/bin/bash
+# Hot standby of the "postgres" service: cloned with pg_basebackup on first
+# start, then kept up to date by streaming replication (read-only).
+set -e
+export PGDATA=/var/lib/postgresql/data
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+  until pg_basebackup -h postgres -U admin -D "$PGDATA" -R -X stream -c fast; do
+    rm -rf "${PGDATA:?}"/*
+    sleep 2
+  done
+fi
+chmod 0700 "$PGDATA"
+exec postgres
@@ -0,0 +1,95 @@
+"""Benchmark scoring at each FACTOR_PRECISION against the float64 path.
+
+For every precision it reports the memory of the matrix a request scans,
+the memory the whole model holds (codes plus the factors it re-scores
+with), the latency of one full-catalog `FactorModel.top` call, and how much of
+the float64 top n it returns (overlap@n).
+
+    python bench_precision.py --items 500000 --factors 100
+    python bench_precision.py --model-dir /shared/model   # a trained shared snapshot
+"""
+import argparse
+import time
+
+import numpy as np
+
+from model import PRECISIONS, FactorModel
+from shared_model import SharedModelStore, split_arrays
+
+
+def synthetic_model(n_items: int, n_users: int, n_factors: int, seed: int = 0) -> FactorModel:
+    """Clustered factors at the scale SVD learns (init std 0.1), with item biases."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 0.1, (64, n_factors))
+    item_factors = centers[rng.integers(0, 64, n_items)] + rng.normal(0, 0.05, (n_items, n_factors))
+    return FactorModel(
+        user_ids=np.array([f"u{i}" for i in range(n_users)]),
+        user_factors=rng.normal(0, 0.1, (n_users, n_factors)),
+        user_bias=rng.normal(0, 0.1, n_users),
+        item_factors=item_factors,
+        item_bias=rng.normal(0, 0.1, n_items),
+        global_mean=3.5,
+    )
+
+
+def scan_bytes(model: FactorModel) -> int:
+    codes = model.item_codes
+    if codes is None:
+        return model.item_factors.nbytes
+    return codes.codes.nbytes + (codes.scales.nbytes if codes.scales is not None else 0)
+
+
+def run(model: FactorModel, n: int, users: int, rescore: int) -> None:
+    rows = np.random.default_rng(1).integers(0, model.n_users, min(users, model.n_users)).tolist()
+    model = model.with_precision("float64")
+    reference = {row: set(model.top(row, n).tolist()) for row in rows}
+    baseline = None
+
+    print(f"{len(model.item_factors)} items x {model.n_factors} factors, top {n}, {len(rows)} users")
+    print(
+        f"{'precision':>9} {'scan MB':>8} {'saved':>6} {'total MB':>8} {'saved':>6} "
+        f"{'p50 ms':>7} {'p95 ms':>7} {'speedup':>7} {'overlap':>7}"
+    )
+    for precision in PRECISIONS:
+        variant = model.with_precision(precision, rescore)
+        variant.top(rows[0], n)  # warm up
+        timings, overlap = [], []
+        for row in rows:
+            started = time.perf_counter()
+            top = variant.top(row, n)
+            timings.append(time.perf_counter() - started)
+            overlap.append(len(reference[row] & set(top.tolist())) / n)
+        p50, p95 = np.percentile(timings, [50, 95]) * 1000
+        megabytes, total = scan_bytes(variant) / 1e6, variant.nbytes() / 1e6
+        if baseline is None:
+            baseline = (megabytes, total, p50)
+        print(
+            f"{precision:>9} {megabytes:>8.1f} {1 - megabytes / baseline[0]:>6.0%} "
+            f"{total:>8.1f} {1 - total / baseline[1]:>6.0%} {p50:>7.2f} {p95:>7.2f} "
+            f"{baseline[2] / p50:>6.1f}x {np.mean(overlap):>7.3f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--items", type=int, default=200_000)
+    parser.add_argument("--factors", type=int, default=100)
+    parser.add_argument("--model-dir", help="benchmark the current snapshot of this SHARED_MODEL_DIR instead")
+    parser.add_argument("-n", type=int, default=10)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rescore", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.model_dir:
+        store = SharedModelStore(args.model_dir)
+        arrays = store.load(store.current_version())
+        if not arrays or not split_arrays(arrays, "model"):
+            raise SystemExit(f"No trained model snapshot in {args.model_dir}")
+        model = FactorModel.from_arrays(split_arrays(arrays, "model"))
+    else:
+        model = synthetic_model(args.items, max(args.users, 1), args.factors)
+    run(model, args.n, args.users, args.rescore)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""Columnar in-memory catalog.
+
+Items are addressed by an integer index (their position in the catalog).
+String attributes are dictionary-encoded: each column is an int32 code array
+plus a small vocabulary, so repeated values (airlines, airports, stations)
+are stored once instead of once per item. Response dicts are never kept
+around; callers materialize them only for the items they return.
+
+Departure times are parsed once per catalog (one parse per distinct value)
+into epoch seconds, and each route also keeps its items sorted by
+departure, so a departure window is two binary searches.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from timestamps import epoch_seconds
+
+
+MISSING = -1
+
+
+class StringColumn:
+    """Dictionary-encoded string column (`MISSING` marks a null value)."""
+
+    __slots__ = ("codes", "vocab")
+
+    def __init__(self, codes: np.ndarray, vocab: np.ndarray):
+        self.codes = codes
+        self.vocab = vocab
+
+    @classmethod
+    def encode(cls, values: Iterable[Optional[str]]) -> "StringColumn":
+        lookup: Dict[str, int] = {}
+        codes: List[int] = []
+        for value in values:
+            if value is None:
+                codes.append(MISSING)
+                continue
+            value = str(value)
+            code = lookup.get(value)
+            if code is None:
+                code = len(lookup)
+                lookup[value] = code
+            codes.append(code)
+        vocab = np.array(list(lookup), dtype=str) if lookup else np.array([], dtype="U1")
+        return cls(np.asarray(codes, dtype=np.int32), vocab)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, index: int) -> Optional[str]:
+        code = self.codes[index]
+        if code == MISSING:
+            return None
+        return str(self.vocab[code])
+
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.vocab.nbytes
+
+
+class Catalog:
+    """Immutable columnar catalog with an O(1) (source, destination) route index.
+
+    `departures` holds each item's departure as epoch seconds (NaN if unknown).
+
+    Id lookups binary-search `ids` through a sort permutation instead of
+    keeping a per-process dict, so every array here can be memory-mapped.
+    """
+
+    def __init__(self, ids: np.ndarray, columns: Dict[str, StringColumn], order: Optional[np.ndarray] = None):
+        self.ids = ids
+        self.columns = columns
+        self._order = order if order is not None else np.argsort(ids, kind="stable")
+        self.departures = self.epoch_times("departure")
+        self._routes = self._build_route_index()
+        self._routes_by_departure = self._build_departure_index()
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict], id_key: str, fields: Sequence[str]) -> "Catalog":
+        """Build a catalog from data-service rows, skipping rows without an id."""
+        ids: List[str] = []
+        values: Dict[str, List[Optional[str]]] = {field: [] for field in fields}
+        for record in records:
+            item_id = record.get(id_key)
+            if item_id is None:
+                continue
+            ids.append(str(item_id))
+            for field in fields:
+                values[field].append(record.get(field))
+
+        columns = {}
+        for field in fields:
+            columns[field] = StringColumn.encode(values.pop(field))
+        id_array = np.array(ids, dtype=str) if ids else np.array([], dtype="U1")
+        return cls(id_array, columns)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, item_id: str) -> bool:
+        return self.index_of(item_id) is not None
+
+    def index_of(self, item_id: str) -> Optional[int]:
+        index = int(self.indices_of([item_id])[0])
+        return index if index != MISSING else None
+
+    def indices_of(self, item_ids: Iterable[str]) -> np.ndarray:
+        """Vectorized id -> index lookup; unknown ids map to `MISSING`."""
+        keys = np.asarray(item_ids if isinstance(item_ids, np.ndarray) else list(item_ids), dtype=str)
+        if not len(self.ids) or not len(keys):
+            return np.full(len(keys), MISSING, dtype=np.int64)
+        pos = np.searchsorted(self.ids, keys, sorter=self._order)
+        candidates = self._order[np.minimum(pos, len(self.ids) - 1)].astype(np.int64)
+        return np.where(self.ids[candidates] == keys, candidates, MISSING)
+
+    def item_id(self, index: int) -> str:
+        return str(self.ids[index])
+
+    def value(self, field: str, index: int) -> Optional[str]:
+        return self.columns[field][index]
+
+    def route(
+        self,
+        source: str,
+        destination: str,
+        depart_after: Optional[float] = None,
+        depart_before: Optional[float] = None,
+    ) -> np.ndarray:
+        """Indices of items on a route (case-insensitive).
+
+        Without a window they come in catalog order. With `depart_after` and/or
+        `depart_before` (epoch seconds, inclusive) they come in departure order,
+        and items with an unknown departure are left out.
+        """
+        key = (source.lower(), destination.lower())
+        if depart_after is None and depart_before is None:
+            return self._routes.get(key, _EMPTY)
+        items, times = self._routes_by_departure.get(key, (_EMPTY, _EMPTY_TIMES))
+        start = 0 if depart_after is None else int(np.searchsorted(times, depart_after, side="left"))
+        stop = len(times) if depart_before is None else int(np.searchsorted(times, depart_before, side="right"))
+        return items[start:stop]
+
+    def apply_changes(
+        self,
+        upserts: Sequence[dict],
+        deletes: Iterable[str],
+        id_key: str,
+        fields: Sequence[str],
+    ) -> Tuple["Catalog", np.ndarray]:
+        """A new catalog with `upserts` (data-service rows) applied and `deletes` (ids) removed.
+
+        Also returns, per item of the new catalog, its index in this one
+        (`MISSING` for added items), for carrying item-aligned arrays over
+        with `reindex`. Kept items stay in order and added ones go last;
+        vocabularies only grow, so existing codes stay valid.
+        """
+        rows: Dict[str, dict] = {}
+        for record in upserts:
+            if record.get(id_key) is not None:
+                rows[str(record[id_key])] = record
+        upserted = list(rows)
+        existing = self.indices_of(upserted)
+        added = [item_id for item_id, index in zip(upserted, existing.tolist()) if index == MISSING]
+
+        # Positions in this catalog followed by the added items.
+        positions = existing.copy()
+        positions[existing == MISSING] = np.arange(len(self), len(self) + len(added))
+        keep = np.ones(len(self) + len(added), dtype=bool)
+        removed = self.indices_of([item_id for item_id in deletes if item_id not in rows])
+        keep[removed[removed != MISSING]] = False
+
+        columns = {}
+        for field in fields:
+            column = self.columns[field]
+            lookup = {value: code for code, value in enumerate(column.vocab.tolist())}
+            codes = np.concatenate((column.codes, np.full(len(added), MISSING, dtype=np.int32)))
+            for item_id, position in zip(upserted, positions.tolist()):
+                value = rows[item_id].get(field)
+                codes[position] = MISSING if value is None else lookup.setdefault(str(value), len(lookup))
+            vocab = np.array(list(lookup), dtype=str) if lookup else column.vocab
+            columns[field] = StringColumn(codes[keep], vocab)
+
+        ids = np.concatenate((self.ids, np.array(added, dtype=str))) if added else self.ids
+        source = np.concatenate((np.arange(len(self)), np.full(len(added), MISSING)))[keep]
+        return Catalog(ids[keep], columns), source
+
+    def routes(self) -> Dict[Tuple[str, str], np.ndarray]:
+        return self._routes
+
+    def nbytes(self) -> int:
+        return self.ids.nbytes + self._order.nbytes + sum(column.nbytes() for column in self.columns.values())
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {"ids": self.ids, "order": self._order}
+        for field, column in self.columns.items():
+            arrays[f"{field}.codes"] = column.codes
+            arrays[f"{field}.vocab"] = column.vocab
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], fields: Sequence[str]) -> "Catalog":
+        columns = {field: StringColumn(arrays[f"{field}.codes"], arrays[f"{field}.vocab"]) for field in fields}
+        return cls(arrays["ids"], columns, order=arrays["order"])
+
+    def epoch_times(self, field: str) -> np.ndarray:
+        """A timestamp column as epoch seconds per item (NaN if unknown), parsed once per distinct value."""
+        column = self.columns.get(field)
+        if column is None:
+            return np.full(len(self), np.nan)
+        # Code -1 (null) picks the appended NaN.
+        return np.append(epoch_seconds(column.vocab.tolist()), np.nan)[column.codes]
+
+    def _build_departure_index(self) -> Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]]:
+        index = {}
+        for key, items in self._routes.items():
+            times = self.departures[items]
+            known = np.flatnonzero(~np.isnan(times))
+            order = known[np.argsort(times[known], kind="stable")]
+            index[key] = (items[order], times[order])
+        return index
+
+    def _build_route_index(self) -> Dict[Tuple[str, str], np.ndarray]:
+        source = self.columns.get("source")
+        destination = self.columns.get("destination")
+        if source is None or destination is None or not len(self):
+            return {}
+
+        # Fold each vocabulary to lower case so the index matches the
+        # case-insensitive comparison the endpoints have always used.
+        src_keys, src_fold = _fold_vocab(source.vocab)
+        dst_keys, dst_fold = _fold_vocab(destination.vocab)
+
+        valid = (source.codes != MISSING) & (destination.codes != MISSING)
+        index = np.flatnonzero(valid)
+        if not len(index):
+            return {}
+        key = src_fold[source.codes[index]] * max(len(dst_keys), 1) + dst_fold[destination.codes[index]]
+
+        order = np.argsort(key, kind="stable")
+        index = index[order].astype(np.int32)
+        key = key[order]
+        boundaries = np.flatnonzero(np.diff(key)) + 1
+        starts = np.concatenate(([0], boundaries)).tolist()
+        ends = np.concatenate((boundaries, [len(key)])).tolist()
+        width = max(len(dst_keys), 1)
+        routes = {}
+        for start, end in zip(starts, ends):
+            s, d = divmod(int(key[start]), width)
+            routes[(src_keys[s], dst_keys[d])] = index[start:end]
+        return routes
+
+
+def reindex(values: np.ndarray, source: np.ndarray, fill=0) -> np.ndarray:
+    """Item-aligned rows carried over to a changed catalog (see `Catalog.apply_changes`); added items get `fill`."""
+    out = np.full((len(source),) + values.shape[1:], fill, dtype=values.dtype)
+    known = source != MISSING
+    out[known] = values[source[known]]
+    return out
+
+
+def _fold_vocab(vocab: np.ndarray) -> Tuple[List[str], np.ndarray]:
+    keys: List[str] = []
+    lookup: Dict[str, int] = {}
+    fold = np.empty(len(vocab), dtype=np.int64)
+    for code, value in enumerate(vocab.tolist()):
+        lowered = value.lower()
+        folded = lookup.get(lowered)
+        if folded is None:
+            folded = len(keys)
+            lookup[lowered] = folded
+            keys.append(lowered)
+        fold[code] = folded
+    return keys, fold
+
+
+_EMPTY = np.array([], dtype=np.int32)
+_EMPTY_TIMES = np.array([], dtype=np.float64)
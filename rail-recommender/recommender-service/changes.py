@@ -0,0 +1,57 @@
+"""Client for the data-service catalog change feed (Server-Sent Events).
+
+`GET /changes/head` gives the id to subscribe from after a full catalog
+load; `GET /changes?since=<id>` streams `changes` events (upserted rows and
+deleted ids) and `reset` events (the log cannot be replayed; reload).
+"""
+import json
+from typing import Iterator, NamedTuple
+
+import requests
+
+import tracing
+
+# The feed sends a keepalive well within this; a silent connection is dead.
+READ_TIMEOUT_SECONDS = 60.0
+
+
+class Event(NamedTuple):
+    name: str
+    id: int
+    data: dict
+
+
+def head(base_url: str) -> int:
+    response = requests.get(f"{base_url}/changes/head", timeout=10, headers=tracing.headers())
+    response.raise_for_status()
+    return int(response.json()["id"])
+
+
+def stream(base_url: str, since: int) -> Iterator[Event]:
+    """Events after change `since`; returns when the connection ends, raises on errors."""
+    with requests.get(
+        f"{base_url}/changes",
+        params={"since": since},
+        stream=True,
+        timeout=(10, READ_TIMEOUT_SECONDS),
+    ) as response:
+        response.raise_for_status()
+        name, event_id, data = "message", since, []
+        for line in response.iter_lines(decode_unicode=True):
+            if line is None:
+                continue
+            if not line:
+                if data:
+                    yield Event(name, event_id, json.loads("\n".join(data)))
+                name, data = "message", []
+                continue
+            if line.startswith(":"):
+                continue
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "event":
+                name = value
+            elif field == "id" and value.isdigit():
+                event_id = int(value)
+            elif field == "data":
+                data.append(value)
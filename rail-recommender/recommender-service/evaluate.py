@@ -0,0 +1,259 @@
+"""Offline evaluation and hyperparameter search for the recommender.
+
+Loads the same bulk exports the service trains on and splits the
+interactions at a point in time: the model is trained on everything
+before the cutoff and judged on what users did after it.
+
+- RMSE over the held-out rated bookings (SVD only; ALS scores are
+  preferences, not ratings);
+- precision@K and recall@K of each user's top K over the whole catalog,
+  with items seen before the cutoff left out, against the items the user
+  booked after it;
+- training time, model size and the latency of one full-catalog scoring
+  + top-K call.
+
+Each point of the grid (factors x epochs x regularization) trains in its
+own process. Configs that no other config beats on both recall@K and
+training time are marked as the frontier.
+
+    python evaluate.py --engine svd --factors 16,32,100 --epochs 10,20 \\
+        --regularization 0.02,0.05 --workers 4 --json results.json
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+import main
+from catalog import MISSING, Catalog
+from ingest import Interactions, fetch_catalog, fetch_interactions
+from model import FactorModel, top_n
+
+ITEM_KEY = "trainNumber"
+CATALOG_EXPORT = "/trains/export"
+CATALOG_ID = "train_number"
+CATALOG_FIELDS = main.TRAIN_FIELDS
+
+# Users scored per batch are capped so the dense score block stays near this many cells.
+BATCH_CELLS = 1 << 22
+
+
+class Split(NamedTuple):
+    catalog: Catalog
+    train: Interactions
+    test: Interactions
+    cutoff: float
+
+
+def load_split(data_service_url: str, test_fraction: float, fmt: str = "npz") -> Split:
+    """The catalog and the interactions split at the `1 - test_fraction` quantile of their timestamps."""
+    interactions = fetch_interactions(f"{data_service_url}/users/export", "userId", ITEM_KEY, fmt)
+    catalog = fetch_catalog(f"{data_service_url}{CATALOG_EXPORT}", CATALOG_ID, CATALOG_FIELDS, fmt)
+    timed = ~np.isnan(interactions.timestamps)
+    cutoff = float(np.quantile(interactions.timestamps[timed], 1 - test_fraction))
+    return Split(
+        catalog,
+        _rows(interactions, timed & (interactions.timestamps <= cutoff)),
+        _rows(interactions, timed & (interactions.timestamps > cutoff)),
+        cutoff,
+    )
+
+
+def _rows(interactions: Interactions, mask: np.ndarray) -> Interactions:
+    return Interactions(
+        user_ids=interactions.user_ids,
+        users=interactions.users[mask],
+        item_ids=interactions.item_ids,
+        items=interactions.items[mask],
+        type_names=interactions.type_names,
+        types=interactions.types[mask],
+        ratings=interactions.ratings[mask],
+        timestamps=interactions.timestamps[mask],
+    )
+
+
+def train(split: Split, engine: str, factors: int, epochs: int, regularization: float) -> Optional[FactorModel]:
+    if engine == "als":
+        # One thread per config; the grid is already spread over processes.
+        return main._train_als(split.catalog, split.train, factors, epochs, regularization, workers=1)
+    return main._train_svd(split.catalog, split.train, factors, epochs, regularization)
+
+
+def evaluate(split: Split, model: FactorModel, k: int, max_users: int, relevant_type: str = "Book") -> Dict[str, float]:
+    """RMSE, precision@k and recall@k of `model` on the held-out interactions."""
+    n_items = len(split.catalog)
+    train_rows, train_items, _ = _pairs(split.train, split.catalog, model)
+    test_rows, test_items, _ = _pairs(split.test, split.catalog, model, split.test.of_type(relevant_type))
+
+    metrics = {"rmse": _rmse(split, model)}
+
+    users = np.unique(test_rows)
+    if max_users and len(users) > max_users:
+        users = np.sort(np.random.default_rng(0).choice(users, max_users, replace=False))
+    if not len(users):
+        return {**metrics, "precision": float("nan"), "recall": float("nan"), "users": 0}
+
+    seen = _indicator(train_rows, train_items, (model.n_users, n_items))
+    relevant = _indicator(test_rows, test_items, (model.n_users, n_items))
+    # Only unseen items are ranked, so only unseen items can be hits.
+    relevant = relevant - relevant.multiply(seen)
+    relevant.eliminate_zeros()
+
+    hits = np.zeros(len(users))
+    totals = np.asarray(relevant[users].sum(axis=1)).ravel()
+    batch = max(1, BATCH_CELLS // max(n_items, 1))
+    k = min(k, n_items)
+    for start in range(0, len(users), batch):
+        rows = users[start:start + batch]
+        # Ranking ignores the per-user terms (global mean, user bias) and clipping.
+        scores = model.user_factors[rows] @ model.item_factors.T + model.item_bias
+        scores[seen[rows].toarray() > 0] = -np.inf
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        hits[start:start + len(rows)] = np.take_along_axis(relevant[rows].toarray(), top, axis=1).sum(axis=1)
+
+    scored = totals > 0
+    metrics["precision"] = float(np.mean(hits[scored] / k)) if scored.any() else float("nan")
+    metrics["recall"] = float(np.mean(hits[scored] / totals[scored])) if scored.any() else float("nan")
+    metrics["users"] = int(scored.sum())
+    return metrics
+
+
+def scoring_latency_ms(model: FactorModel, k: int, samples: int = 200) -> float:
+    """Median time of one request's full-catalog scoring and top-k cut."""
+    rows = np.random.default_rng(0).integers(0, model.n_users, min(samples, model.n_users))
+    timings = []
+    for row in rows.tolist():
+        started = time.perf_counter()
+        top_n(model.predict(row), k)
+        timings.append(time.perf_counter() - started)
+    return float(np.median(timings) * 1000) if timings else float("nan")
+
+
+def _pairs(interactions: Interactions, catalog: Catalog, model: FactorModel, mask: Optional[np.ndarray] = None):
+    """(model user rows, catalog indices, row mask) of the interactions (in `mask`) with known user and item."""
+    rows = np.append(model.user_rows(interactions.user_ids), MISSING)[interactions.users]
+    items = interactions.item_index(catalog)
+    known = (rows != MISSING) & (items != MISSING)
+    if mask is not None:
+        known &= mask
+    return rows[known], items[known], known
+
+
+def _indicator(rows: np.ndarray, items: np.ndarray, shape) -> csr_matrix:
+    matrix = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, items)), shape=shape)
+    matrix.data[:] = 1
+    return matrix
+
+
+def _rmse(split: Split, model: FactorModel) -> float:
+    if not np.isfinite(model.rating_scale).all():
+        return float("nan")
+    rated = split.test.of_type("Book") & ~np.isnan(split.test.ratings)
+    rows, items, known = _pairs(split.test, split.catalog, model, rated)
+    if not len(rows):
+        return float("nan")
+    est = np.einsum("ij,ij->i", model.user_factors[rows], model.item_factors[items])
+    est += model.item_bias[items] + model.user_bias[rows] + model.global_mean
+    est = np.clip(est, *model.rating_scale)
+    return float(np.sqrt(np.mean((est - split.test.ratings[known]) ** 2)))
+
+
+_split: Optional[Split] = None
+
+
+def _init_worker(split: Split):
+    global _split
+    _split = split
+
+
+def _run(config: dict, k: int, max_users: int) -> dict:
+    started = time.perf_counter()
+    model = train(_split, **config)
+    train_seconds = time.perf_counter() - started
+    if model is None:
+        return {**config, "error": "no training data"}
+    return {
+        **config,
+        **evaluate(_split, model, k, max_users),
+        "trainSeconds": round(train_seconds, 3),
+        "modelMB": round(model.nbytes() / 1e6, 2),
+        "scoreMs": round(scoring_latency_ms(model, k), 3),
+    }
+
+
+def frontier(results: List[dict]) -> None:
+    """Mark results that no other result beats on both recall and training time."""
+    scored = [r for r in results if "error" not in r and not np.isnan(r["recall"])]
+    for r in scored:
+        r["frontier"] = not any(
+            o is not r
+            and o["recall"] >= r["recall"]
+            and o["trainSeconds"] <= r["trainSeconds"]
+            and (o["recall"] > r["recall"] or o["trainSeconds"] < r["trainSeconds"])
+            for o in scored
+        )
+
+
+def _ints(text: str) -> List[int]:
+    return [int(value) for value in text.split(",") if value.strip()]
+
+
+def _floats(text: str) -> List[float]:
+    return [float(value) for value in text.split(",") if value.strip()]
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--data-service", default=main.DATA_SERVICE_URL)
+    parser.add_argument("--format", default=main.TRAINING_DATA_FORMAT, choices=("npz", "csv"))
+    parser.add_argument("--engine", default=main.MODEL_ENGINE, choices=("svd", "als"))
+    parser.add_argument("--factors", type=_ints, default=[16, 32, 64, 100])
+    parser.add_argument("--epochs", type=_ints, default=[10, 20], help="SVD epochs / ALS iterations")
+    parser.add_argument("--regularization", type=_floats, default=[0.02, 0.05])
+    parser.add_argument("--test-fraction", type=float, default=0.2)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--max-users", type=int, default=2000, help="users sampled for precision/recall (0: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    split = load_split(args.data_service, args.test_fraction, args.format)
+    print(
+        f"{len(split.catalog)} items; {len(split.train)} interactions before "
+        f"{time.strftime('%Y-%m-%d %H:%M', time.gmtime(split.cutoff))} UTC, {len(split.test)} after"
+    )
+    grid = [
+        {"engine": args.engine, "factors": f, "epochs": e, "regularization": r}
+        for f, e, r in itertools.product(args.factors, args.epochs, args.regularization)
+    ]
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(split,)) as pool:
+        results = list(pool.map(_run, grid, itertools.repeat(args.k), itertools.repeat(args.max_users)))
+    frontier(results)
+
+    print(
+        f"{'factors':>7} {'epochs':>6} {'reg':>6} {'rmse':>7} {'p@' + str(args.k):>7} {'r@' + str(args.k):>7} "
+        f"{'train s':>8} {'MB':>7} {'score ms':>8}"
+    )
+    for r in sorted(results, key=lambda r: r.get("trainSeconds", float("inf"))):
+        if "error" in r:
+            print(f"{r['factors']:>7} {r['epochs']:>6} {r['regularization']:>6} {r['error']}")
+            continue
+        print(
+            f"{r['factors']:>7} {r['epochs']:>6} {r['regularization']:>6} {r['rmse']:>7.4f} {r['precision']:>7.4f} "
+            f"{r['recall']:>7.4f} {r['trainSeconds']:>8.2f} {r['modelMB']:>7.2f} {r['scoreMs']:>8.3f}"
+            + ("  *" if r.get("frontier") else "")
+        )
+    print("* on the recall / training time frontier")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    cli()
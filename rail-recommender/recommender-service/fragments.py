@@ -0,0 +1,47 @@
+"""Pre-rendered JSON fragments for catalog items.
+
+A response item only depends on the catalog, so its JSON is rendered once
+per catalog version and then spliced into every response that returns it.
+The envelope around the fragments is encoded with orjson.
+"""
+from typing import Callable, Iterable, List, Optional
+
+import orjson
+from fastapi import Response
+
+
+class FragmentCache:
+    """Lazily rendered, index-addressed cache of item JSON fragments.
+
+    Build a new cache whenever the catalog is replaced; entries are never
+    invalidated individually.
+    """
+
+    def __init__(self, size: int, render: Callable[[int], dict]):
+        self._render = render
+        self._fragments: List[Optional[bytes]] = [None] * size
+
+    def __len__(self) -> int:
+        return len(self._fragments)
+
+    def get(self, index: int) -> bytes:
+        fragment = self._fragments[index]
+        if fragment is None:
+            fragment = orjson.dumps(self._render(index))
+            self._fragments[index] = fragment
+        return fragment
+
+    def render_all(self) -> None:
+        for index in range(len(self._fragments)):
+            self.get(index)
+
+
+def splice(envelope: dict, key: str, fragments: Iterable[bytes]) -> bytes:
+    """Encode `envelope` with `key` appended as a JSON array of pre-rendered fragments."""
+    head = orjson.dumps(envelope)[:-1]
+    separator = b"," if len(head) > 1 else b""
+    return b"".join((head, separator, b'"', key.encode(), b'":[', b",".join(fragments), b"]}"))
+
+
+def json_response(envelope: dict, key: str, fragments: Iterable[bytes], status_code: int = 200) -> Response:
+    return Response(content=splice(envelope, key, fragments), status_code=status_code, media_type="application/json")
@@ -0,0 +1,154 @@
+"""Warm-started retraining from the previous model.
+
+A warm start keeps the previous model's factors for the users and items it
+knew (matched by id, so catalog and user order may change in between),
+gives new ids fresh rows, and trains only on what changed:
+
+- SVD runs a few epochs of minibatch SGD, with Surprise's update rule,
+  learning rate and regularization, over the interactions since the
+  previous model's data plus a `replay` sample of older ones, which keeps
+  the factors from drifting toward recent users;
+- ALS re-solves only the users and items with new interactions, against
+  the fixed factors of everyone else.
+
+Training cost then follows the number of new interactions rather than the
+size of the history. Warm starts accumulate approximation error, so the
+trainer still runs a full retrain periodically.
+"""
+from typing import NamedTuple, Tuple
+
+import numpy as np
+
+from catalog import MISSING, Catalog
+from ingest import Interactions
+from model import FactorModel
+
+# Surprise's SVD initializes factors from N(0, 0.1); ALS uses N(0, 0.01).
+SVD_INIT_STD = 0.1
+ALS_INIT_STD = 0.01
+SGD_BATCH = 1024
+
+
+class Previous(NamedTuple):
+    """The model a warm start continues from, and what it was trained on."""
+
+    model: FactorModel
+    catalog: Catalog
+    # Latest interaction timestamp in its training data.
+    trained_through: float
+
+
+def aligned_items(previous: Previous, catalog: Catalog) -> FactorModel:
+    """The previous model over `catalog`; items it did not know get zero rows."""
+    if previous.catalog is catalog:
+        return previous.model
+    return previous.model.with_items(previous.catalog.indices_of(catalog.ids))
+
+
+def recent(interactions: Interactions, since: float) -> np.ndarray:
+    """Rows with a timestamp after `since`."""
+    with np.errstate(invalid="ignore"):
+        return interactions.timestamps > since
+
+
+def latest(interactions: Interactions) -> float:
+    """The latest interaction timestamp (-inf when there are none)."""
+    known = interactions.timestamps[~np.isnan(interactions.timestamps)]
+    return float(known.max()) if len(known) else float("-inf")
+
+
+def warm_svd(
+    previous: Previous,
+    catalog: Catalog,
+    interactions: Interactions,
+    rated: np.ndarray,
+    since: float,
+    epochs: int,
+    learning_rate: float,
+    regularization: float,
+    replay: float,
+    seed: int = 0,
+) -> Tuple[FactorModel, int]:
+    """Continue training the previous SVD model; (model, ratings trained on).
+
+    `rated` selects the rated-booking rows; those after `since`, and a
+    `replay` fraction of the rest, are trained on.
+    """
+    rng = np.random.default_rng(seed)
+    base = aligned_items(previous, catalog)
+    fresh = rated & recent(interactions, since)
+    train = fresh | (rated & ~fresh & (rng.random(len(interactions)) < replay))
+
+    # Users: the previous model's rows, then a row per new user with ratings to train on.
+    rows_by_code = base.user_rows(interactions.user_ids)
+    new_users = np.unique(interactions.users[train])
+    new_users = new_users[rows_by_code[new_users] == MISSING]
+    rows_by_code[new_users] = base.n_users + np.arange(len(new_users))
+    user_ids = np.concatenate([base.user_ids, interactions.user_ids[new_users]]).astype(str)
+    user_factors = np.concatenate(
+        [np.asarray(base.user_factors, dtype=np.float64), rng.normal(0, SVD_INIT_STD, (len(new_users), base.n_factors))]
+    )
+    user_bias = np.concatenate([np.asarray(base.user_bias, dtype=np.float64), np.zeros(len(new_users))])
+
+    # Items: known items keep their rows; new items with ratings start random, the rest stay zero.
+    item_factors = np.array(base.item_factors, dtype=np.float64)
+    item_bias = np.array(base.item_bias, dtype=np.float64)
+    items = interactions.item_index(catalog)
+    unknown = ~item_factors.any(axis=1) & (item_bias == 0)
+    new_items = np.unique(items[train & (items != MISSING)])
+    new_items = new_items[unknown[new_items]]
+    item_factors[new_items] = rng.normal(0, SVD_INIT_STD, (len(new_items), item_factors.shape[1]))
+
+    train &= items != MISSING
+    users = rows_by_code[interactions.users[train]]
+    items = items[train]
+    ratings = interactions.ratings[train].astype(np.float64)
+    global_mean = float(interactions.ratings[rated].mean()) if rated.any() else base.global_mean
+
+    for _ in range(epochs):
+        order = rng.permutation(len(ratings))
+        for start in range(0, len(order), SGD_BATCH):
+            batch = order[start:start + SGD_BATCH]
+            u, i, r = users[batch], items[batch], ratings[batch]
+            pu, qi = user_factors[u], item_factors[i]
+            err = r - (global_mean + user_bias[u] + item_bias[i] + np.einsum("ij,ij->i", pu, qi))
+            np.add.at(user_bias, u, learning_rate * (err - regularization * user_bias[u]))
+            np.add.at(item_bias, i, learning_rate * (err - regularization * item_bias[i]))
+            np.add.at(user_factors, u, learning_rate * (err[:, None] * qi - regularization * pu))
+            np.add.at(item_factors, i, learning_rate * (err[:, None] * pu - regularization * qi))
+
+    model = FactorModel(
+        user_ids=user_ids,
+        user_factors=user_factors,
+        user_bias=user_bias,
+        item_factors=item_factors,
+        item_bias=item_bias,
+        global_mean=global_mean,
+        rating_scale=base.rating_scale,
+    )
+    return model, len(ratings)
+
+
+def warm_als(previous: Previous, catalog: Catalog, interactions: Interactions, since: float, seed: int = 0):
+    """Warm-start arguments for `ImplicitALS.fit` over `interactions` (rows by user code, columns by catalog index).
+
+    Returns (user_factors, item_factors, users, items): the previous factors
+    where known, random ones elsewhere, and the users and items to re-solve:
+    those with interactions after `since` and those the previous model lacked.
+    """
+    rng = np.random.default_rng(seed)
+    base = aligned_items(previous, catalog)
+    rows = base.user_rows(interactions.user_ids)
+    known_users = rows != MISSING
+    user_factors = rng.normal(0, ALS_INIT_STD, (len(rows), base.n_factors))
+    user_factors[known_users] = base.user_factors[rows[known_users]]
+
+    item_factors = np.array(base.item_factors, dtype=np.float64)
+    known_items = item_factors.any(axis=1)
+    item_factors[~known_items] = rng.normal(0, ALS_INIT_STD, (int((~known_items).sum()), base.n_factors))
+
+    fresh = recent(interactions, since) & (interactions.users != MISSING)
+    items = interactions.item_index(catalog)
+    users = np.union1d(interactions.users[fresh], np.flatnonzero(~known_users))
+    items = np.union1d(items[fresh & (items != MISSING)], np.flatnonzero(~known_items))
+    return user_factors, item_factors, users.astype(np.int64), items.astype(np.int64)
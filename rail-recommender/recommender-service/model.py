@@ -0,0 +1,310 @@
+"""Matrix-factorization model held as plain NumPy arrays.
+
+Item rows are aligned with catalog indices, so scoring a set of catalog
+items is a single gather + matrix-vector product. Items the model never saw
+keep zero factors and bias, which reproduces Surprise's SVD estimate for
+unknown items (global mean + user bias). Implicit-feedback models use the
+same arrays with zero biases and an unbounded scale.
+
+Factors can be kept at reduced precision for scoring: float32, or float16 /
+int8 codes (int8 with a scale per row). Quantized models scan the codes
+and re-score the best candidates with the full-precision factors, which
+are then only read row by row; in a memory-mapped shared snapshot only
+those pages become resident.
+"""
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from catalog import MISSING, Catalog, reindex
+
+PRECISIONS = ("float64", "float32", "float16", "int8")
+# Rows dequantized per block while scanning, so a block stays in cache.
+SCAN_CHUNK = 2048
+
+
+class Quantized(NamedTuple):
+    """Reduced-precision copy of a factor matrix; int8 rows carry a scale."""
+
+    codes: np.ndarray
+    scales: Optional[np.ndarray]
+
+    @classmethod
+    def encode(cls, factors: np.ndarray, precision: str) -> "Quantized":
+        if precision == "float16":
+            return cls(factors.astype(np.float16), None)
+        peak = np.abs(factors).max(axis=1) if factors.size else np.zeros(len(factors))
+        scales = np.where(peak > 0, peak / 127.0, 1.0).astype(np.float32)
+        codes = np.clip(np.rint(factors / scales[:, None]), -127, 127).astype(np.int8)
+        return cls(codes, scales)
+
+    def rows(self, index=slice(None)) -> np.ndarray:
+        """Dequantized float32 rows."""
+        values = self.codes[index].astype(np.float32)
+        if self.scales is not None:
+            values *= self.scales[index][..., None]
+        return values
+
+    def dot(self, vector: np.ndarray, items: Optional[np.ndarray] = None) -> np.ndarray:
+        """codes . vector per row (of `items`), dequantizing one block at a time."""
+        codes = self.codes if items is None else self.codes[items]
+        out = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), SCAN_CHUNK):
+            out[start:start + SCAN_CHUNK] = codes[start:start + SCAN_CHUNK].astype(np.float32) @ vector
+        if self.scales is not None:
+            out *= self.scales if items is None else self.scales[items]
+        return out
+
+    def take(self, source: np.ndarray) -> "Quantized":
+        return Quantized(
+            reindex(self.codes, source),
+            reindex(self.scales, source, fill=1.0) if self.scales is not None else None,
+        )
+
+
+class FactorModel:
+    """Biased matrix factorization: r_ui = mu + b_u + b_i + q_i . p_u."""
+
+    def __init__(
+        self,
+        user_ids: np.ndarray,
+        user_factors: np.ndarray,
+        user_bias: np.ndarray,
+        item_factors: np.ndarray,
+        item_bias: np.ndarray,
+        global_mean: float,
+        rating_scale: Tuple[float, float] = (1, 5),
+        user_order: Optional[np.ndarray] = None,
+        item_codes: Optional[Quantized] = None,
+        user_codes: Optional[Quantized] = None,
+        rescore: int = 4,
+    ):
+        self.user_ids = user_ids
+        self.user_factors = user_factors
+        self.user_bias = user_bias
+        self.item_factors = item_factors
+        self.item_bias = item_bias
+        self.global_mean = float(global_mean)
+        self.rating_scale = (float(rating_scale[0]), float(rating_scale[1]))
+        self._user_order = user_order if user_order is not None else np.argsort(user_ids, kind="stable")
+        # Reduced-precision factors for scanning (None: scan the factors themselves).
+        self.item_codes = item_codes
+        self.user_codes = user_codes
+        # Candidates per result re-scored at full precision after a quantized scan.
+        self.rescore = rescore
+
+    @classmethod
+    def from_surprise(cls, algo, catalog: Catalog) -> "FactorModel":
+        """Copy a fitted Surprise SVD into catalog-aligned arrays."""
+        trainset = algo.trainset
+        user_ids = np.array([str(trainset.to_raw_uid(u)) for u in range(trainset.n_users)], dtype=str)
+
+        raw_items = [str(trainset.to_raw_iid(i)) for i in range(trainset.n_items)]
+        index = catalog.indices_of(raw_items)
+        known = index != MISSING
+
+        n_factors = algo.qi.shape[1]
+        item_factors = np.zeros((len(catalog), n_factors))
+        item_bias = np.zeros(len(catalog))
+        item_factors[index[known]] = algo.qi[known]
+        item_bias[index[known]] = algo.bi[known]
+
+        return cls(
+            user_ids=user_ids,
+            user_factors=np.asarray(algo.pu),
+            user_bias=np.asarray(algo.bu),
+            item_factors=item_factors,
+            item_bias=item_bias,
+            global_mean=trainset.global_mean,
+            rating_scale=trainset.rating_scale,
+        )
+
+    @classmethod
+    def from_factors(cls, user_ids: np.ndarray, user_factors: np.ndarray, item_factors: np.ndarray) -> "FactorModel":
+        """Wrap unbiased factors (implicit ALS); scores are preferences, not ratings."""
+        return cls(
+            user_ids=user_ids,
+            user_factors=user_factors,
+            user_bias=np.zeros(len(user_ids), dtype=user_factors.dtype),
+            item_factors=item_factors,
+            item_bias=np.zeros(len(item_factors), dtype=item_factors.dtype),
+            global_mean=0.0,
+            rating_scale=(-np.inf, np.inf),
+        )
+
+    def with_items(self, source: np.ndarray) -> "FactorModel":
+        """The model over a changed catalog (see `Catalog.apply_changes`); added items start unknown."""
+        return FactorModel(
+            user_ids=self.user_ids,
+            user_factors=self.user_factors,
+            user_bias=self.user_bias,
+            item_factors=reindex(self.item_factors, source),
+            item_bias=reindex(self.item_bias, source),
+            global_mean=self.global_mean,
+            rating_scale=self.rating_scale,
+            user_order=self._user_order,
+            item_codes=self.item_codes.take(source) if self.item_codes is not None else None,
+            user_codes=self.user_codes,
+            rescore=self.rescore,
+        )
+
+    def with_precision(self, precision: str, rescore: int = 4) -> "FactorModel":
+        """The model scoring at `precision` (one of `PRECISIONS`).
+
+        float16 and int8 models scan codes and re-score with float32 factors,
+        so they hold less than a float64 model even with the codes added.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {', '.join(PRECISIONS)}")
+        user_factors, item_factors = self.user_factors, self.item_factors
+        quantized = precision in ("float16", "int8")
+        if precision == "float32" or quantized:
+            user_factors = user_factors.astype(np.float32)
+            item_factors = item_factors.astype(np.float32)
+        return FactorModel(
+            user_ids=self.user_ids,
+            user_factors=user_factors,
+            user_bias=self.user_bias,
+            item_factors=item_factors,
+            item_bias=self.item_bias,
+            global_mean=self.global_mean,
+            rating_scale=self.rating_scale,
+            user_order=self._user_order,
+            item_codes=Quantized.encode(item_factors, precision) if quantized else None,
+            user_codes=Quantized.encode(user_factors, precision) if quantized else None,
+            rescore=rescore,
+        )
+
+    @property
+    def precision(self) -> str:
+        if self.item_codes is not None:
+            return "int8" if self.item_codes.scales is not None else "float16"
+        return str(self.item_factors.dtype)
+
+    @property
+    def n_users(self) -> int:
+        return len(self.user_ids)
+
+    @property
+    def n_factors(self) -> int:
+        return self.item_factors.shape[1]
+
+    def user_index(self, user_id: str) -> Optional[int]:
+        if not len(self.user_ids):
+            return None
+        pos = int(np.searchsorted(self.user_ids, user_id, sorter=self._user_order))
+        if pos < len(self.user_ids):
+            row = int(self._user_order[pos])
+            if self.user_ids[row] == user_id:
+                return row
+        return None
+
+    def user_rows(self, user_ids: np.ndarray) -> np.ndarray:
+        """Model row per user id (`MISSING` for unknown users)."""
+        if not len(self.user_ids):
+            return np.full(len(user_ids), MISSING, dtype=np.int64)
+        pos = np.searchsorted(self.user_ids, user_ids, sorter=self._user_order)
+        rows = self._user_order[np.minimum(pos, len(self.user_ids) - 1)]
+        return np.where(self.user_ids[rows] == user_ids, rows, MISSING)
+
+    def has_user(self, user_id: str) -> bool:
+        return self.user_index(user_id) is not None
+
+    def predict(self, user_row: int, items: Optional[np.ndarray] = None) -> np.ndarray:
+        """Estimated ratings for `items` (all catalog items when None), clipped to the scale."""
+        if items is None:
+            factors, bias = self.item_factors, self.item_bias
+        else:
+            factors, bias = self.item_factors[items], self.item_bias[items]
+        est = factors @ self.user_factors[user_row]
+        est += bias
+        est += self.global_mean + self.user_bias[user_row]
+        return np.clip(est, *self.rating_scale)
+
+    def scores(self, user_row: int, items: Optional[np.ndarray] = None) -> np.ndarray:
+        """Like `predict`, from the reduced-precision factors when the model has them."""
+        if self.item_codes is None:
+            return self.predict(user_row, items)
+        est = self.item_codes.dot(self.user_vector(user_row), items)
+        est += self.item_bias if items is None else self.item_bias[items]
+        est += self.global_mean + self.user_bias[user_row]
+        return np.clip(est, *self.rating_scale)
+
+    def top(self, user_row: int, n: int, items: Optional[np.ndarray] = None) -> np.ndarray:
+        """Positions (into `items`, or catalog indices) of the `n` best predictions, best first.
+
+        A quantized model scans its codes, then re-scores the best `rescore * n`
+        with the full-precision factors.
+        """
+        if self.item_codes is None:
+            return top_n(self.predict(user_row, items), n)
+        candidates = top_n(self.scores(user_row, items), n * self.rescore)
+        exact = self.predict(user_row, candidates if items is None else items[candidates])
+        return candidates[top_n(exact, n)]
+
+    def user_vector(self, user_row: int) -> np.ndarray:
+        """The user's factors as float32, from the scanning precision."""
+        if self.user_codes is None:
+            return np.asarray(self.user_factors[user_row], dtype=np.float32)
+        return self.user_codes.rows(user_row)
+
+    def item_vectors(self, items) -> np.ndarray:
+        """Item factors as float32, from the scanning precision."""
+        if self.item_codes is None:
+            return np.asarray(self.item_factors[items], dtype=np.float32)
+        return self.item_codes.rows(items)
+
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in self.to_arrays().values())
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {
+            "user_ids": self.user_ids,
+            "user_order": self._user_order,
+            "user_factors": self.user_factors,
+            "user_bias": self.user_bias,
+            "item_factors": self.item_factors,
+            "item_bias": self.item_bias,
+            "global_mean": np.array([self.global_mean]),
+            "rating_scale": np.array(self.rating_scale),
+            "rescore": np.array([self.rescore]),
+        }
+        for name, quantized in (("item", self.item_codes), ("user", self.user_codes)):
+            if quantized is not None:
+                arrays[f"{name}_codes"] = quantized.codes
+                if quantized.scales is not None:
+                    arrays[f"{name}_scales"] = quantized.scales
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "FactorModel":
+        codes = {
+            name: Quantized(arrays[f"{name}_codes"], arrays.get(f"{name}_scales"))
+            for name in ("item", "user")
+            if f"{name}_codes" in arrays
+        }
+        return cls(
+            user_ids=arrays["user_ids"],
+            user_factors=arrays["user_factors"],
+            user_bias=arrays["user_bias"],
+            item_factors=arrays["item_factors"],
+            item_bias=arrays["item_bias"],
+            global_mean=float(arrays["global_mean"][0]),
+            rating_scale=tuple(arrays["rating_scale"].tolist()),
+            user_order=arrays["user_order"],
+            item_codes=codes.get("item"),
+            user_codes=codes.get("user"),
+            rescore=int(arrays["rescore"][0]) if "rescore" in arrays else 4,
+        )
+
+
+def top_n(scores: np.ndarray, n: int) -> np.ndarray:
+    """Positions of the `n` highest scores, best first."""
+    if n <= 0:
+        return np.array([], dtype=np.int64)
+    if n < len(scores):
+        candidates = np.argpartition(-scores, n - 1)[:n]
+        candidates.sort()
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
@@ -0,0 +1,123 @@
+"""Cursor pagination over ranked recommendation lists.
+
+The first page of a query ranks `lookahead` pages' worth of items and keeps
+the ranked indices; later pages are slices of that list. A page past its end
+ranks further (up to `max_results` in all) and extends the list, keeping
+the items already paged in their place. A `RankedPages` is
+tied to one serving state (catalog and model), like the fragment
+caches, so a new state starts with an empty one.
+
+Cursors are opaque to clients: the serving state's digest, the offset of
+the next page and a digest of the query. Clients send them back with the
+same query parameters. A page whose list was evicted, or that lands on
+another worker, is ranked again from those parameters. The state digest
+comes from the contents of the catalog, model and trending scores (see
+`state_digest`), not from a per-process counter. So a worker that serves
+the same state accepts the cursor, and one that serves a different state
+refuses it, since its offsets no longer match the ranking.
+"""
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Mapping, Optional, Tuple
+
+import numpy as np
+
+import tracing
+
+
+class CursorError(ValueError):
+    pass
+
+
+class StaleCursor(CursorError):
+    pass
+
+
+class RankedPages:
+    def __init__(self, max_results: int = 500, max_entries: int = 4096, lookahead: int = 4):
+        self.max_results = max_results
+        self.max_entries = max_entries
+        self.lookahead = lookahead
+        # query -> (ranked indices, whether ranking further would add nothing)
+        self._entries: "OrderedDict[Hashable, Tuple[np.ndarray, bool]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def page(
+        self,
+        query: Hashable,
+        offset: int,
+        size: int,
+        rank: Callable[[int], np.ndarray],
+    ) -> Tuple[np.ndarray, bool]:
+        """(indices of the page at `offset`, whether more follow); `rank(n)` gives the best n."""
+        end = offset + size
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry is not None:
+                self._entries.move_to_end(query)
+        hit = entry is not None and (entry[1] or end < len(entry[0]))
+        tracing.annotate(pageCacheHit=hit)
+        if not hit:
+            kept = entry[0] if entry is not None else np.zeros(0, dtype=np.int32)
+            n = min(self.max_results, max(self.lookahead * end, 2 * len(kept)))
+            fresh = np.asarray(rank(n), dtype=np.int32)
+            complete = len(fresh) < n or n >= self.max_results
+            with self._lock:
+                current = self._entries.get(query)
+                if current is not None:
+                    kept = current[0]
+                # A larger ranking may reorder its head; already paged items keep their place.
+                ranked = np.concatenate([kept, fresh[~np.isin(fresh, kept)]])[:self.max_results]
+                entry = (ranked, complete)
+                self._entries[query] = entry
+                self._entries.move_to_end(query)
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        ranked, complete = entry
+        return ranked[offset:end], end < len(ranked) or (not complete and end < self.max_results)
+
+
+def state_digest(exact: Mapping[str, np.ndarray], sampled: Mapping[str, np.ndarray], sample_rows: int = 4096) -> str:
+    """A digest of array contents: every row of `exact`, and `sample_rows` evenly spaced rows of each of `sampled`.
+
+    Models trained apart differ in nearly every row, so a sample of their
+    factors tells them apart; catalog edits can touch a single row, so the
+    catalog goes in `exact`.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    for section, take_all in ((exact, True), (sampled, False)):
+        for name in sorted(section):
+            array = np.asarray(section[name])
+            if not take_all and len(array.shape) and len(array) > sample_rows:
+                array = array[np.linspace(0, len(array) - 1, sample_rows).astype(np.int64)]
+            h.update(f"{name}:{array.dtype.str}:{array.shape}".encode())
+            h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
+def encode_cursor(state: str, query: Hashable, offset: int) -> str:
+    raw = f"{state}.{offset}.{_digest(query)}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], state: str, query: Hashable) -> int:
+    """The offset a cursor points at (0 without one); raises CursorError/StaleCursor."""
+    if not cursor:
+        return 0
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        cursor_state, offset, digest = raw.split(".")
+        offset = int(offset)
+    except ValueError:
+        raise CursorError("cursor is malformed")
+    if offset < 0 or digest != _digest(query):
+        raise CursorError("cursor does not belong to this query")
+    if cursor_state != state:
+        raise StaleCursor("cursor has expired; recommendations were refreshed")
+    return offset
+
+
+def _digest(query: Hashable) -> str:
+    return hashlib.blake2b(repr(query).encode(), digest_size=8).hexdigest()
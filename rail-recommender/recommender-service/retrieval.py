@@ -0,0 +1,267 @@
+"""Two-stage ranking: cheap candidate generators, then exact re-ranking.
+
+Scoring every catalog item for every request grows with the catalog. Here
+a few cheap generators each propose a slice of candidates:
+
+- ann: the best-scoring items in the inverted lists whose centroids best
+  match the user vector (an IVF index over the item factors, with the bias
+  as one more dimension so that centroid . [p_u, 1] tracks the predicted
+  rating);
+- neighbors: the items closest in factor space to the user's recent
+  history, searched in each history item's own list;
+- routes: the most trending items on the routes of the user's history;
+- trending: the globally trending items.
+
+The union is scored exactly with the model, passed through filters (each
+returns a keep mask over the candidates) and cut to the top n. Catalogs no
+larger than the candidate budget are scored in full.
+
+A `Retrieval` is built with the model and aligned to the same catalog
+indices and user rows; `with_items` follows catalog changes like
+`FactorModel.with_items`.
+"""
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from catalog import MISSING, Catalog
+from ingest import Interactions
+from model import FactorModel, top_n
+from trending import Trending
+
+# Keep mask over candidate catalog indices.
+Filter = Callable[[np.ndarray], np.ndarray]
+
+# Lists are probed until they hold this many times the ann quota.
+ANN_OVERFETCH = 16
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLE = 100_000
+CHUNK = 65536
+
+
+class Retrieval:
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        list_items: np.ndarray,
+        history_offsets: np.ndarray,
+        history_items: np.ndarray,
+    ):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_items = list_items
+        # Per model user row, most recent first.
+        self.history_offsets = history_offsets
+        self.history_items = history_items
+
+    @classmethod
+    def build(
+        cls,
+        catalog: Catalog,
+        model: FactorModel,
+        interactions: Interactions,
+        history_size: int = 20,
+        index_min_items: int = 0,
+        seed: int = 0,
+    ) -> "Retrieval":
+        """History from `interactions`; the IVF index only when the catalog exceeds `index_min_items`."""
+        history_offsets, history_items = _history(catalog, model, interactions, history_size)
+        vectors = _item_vectors(model)
+        known = np.flatnonzero(np.any(vectors != 0, axis=1))
+        if len(catalog) <= index_min_items or not len(known):
+            centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            return cls(centroids, np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), history_offsets, history_items)
+
+        n_lists = int(np.clip(np.sqrt(len(known)), 1, 4096))
+        centroids = _kmeans(vectors[known], n_lists, np.random.default_rng(seed))
+        assignment = _nearest(vectors[known], centroids)
+        order = np.argsort(assignment, kind="stable")
+        list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=n_lists))))
+        return cls(centroids, list_offsets, known[order].astype(np.int32), history_offsets, history_items)
+
+    def history(self, user_row: int) -> np.ndarray:
+        return self.history_items[self.history_offsets[user_row]:self.history_offsets[user_row + 1]]
+
+    def with_items(self, source: np.ndarray) -> "Retrieval":
+        """Follow a catalog change; deleted items drop out, added items are only found by trending."""
+        return Retrieval(
+            self.centroids,
+            *_remap_groups(self.list_offsets, self.list_items, source),
+            *_remap_groups(self.history_offsets, self.history_items, source),
+        )
+
+    def candidates(
+        self,
+        user_row: int,
+        model: FactorModel,
+        catalog: Catalog,
+        trending: Trending,
+        budget: int,
+        seeds: int = 10,
+    ) -> np.ndarray:
+        """Sorted, distinct catalog indices proposed by the generators for `user_row`."""
+        history = self.history(user_row)[:seeds]
+        found = [
+            self._ann(model, user_row, budget // 2),
+            self._neighbors(model, history, budget // 4),
+            _routes(catalog, trending, history, budget // 8),
+            trending.top(budget // 8),
+        ]
+        return np.unique(np.concatenate([np.asarray(items, dtype=np.int64) for items in found]))
+
+    def rank(
+        self,
+        user_row: int,
+        n: int,
+        model: FactorModel,
+        catalog: Catalog,
+        trending: Trending,
+        budget: int,
+        filters: Sequence[Filter] = (),
+    ) -> np.ndarray:
+        """The top `n` catalog indices for `user_row`, best first."""
+        if len(catalog) <= max(budget, n):
+            items = np.arange(len(catalog))
+        else:
+            items = self.candidates(user_row, model, catalog, trending, max(budget, 2 * n))
+        for keep in filters:
+            items = items[keep(items)]
+        return items[model.top(user_row, n, items)]
+
+    def seen_filter(self, user_row: int) -> Filter:
+        """Drop the items in the user's kept history."""
+        seen = self.history(user_row)
+        return lambda items: ~np.isin(items, seen)
+
+    def _ann(self, model: FactorModel, user_row: int, quota: int) -> np.ndarray:
+        if not len(self.centroids) or quota <= 0:
+            return np.zeros(0, dtype=np.int64)
+        query = np.append(model.user_vector(user_row), 1.0).astype(self.centroids.dtype)
+        sizes = np.diff(self.list_offsets)
+        probed, total = [], 0
+        for list_id in np.argsort(-(self.centroids @ query), kind="stable"):
+            if total >= quota * ANN_OVERFETCH:
+                break
+            if sizes[list_id]:
+                probed.append(self.list_items[self.list_offsets[list_id]:self.list_offsets[list_id + 1]])
+                total += int(sizes[list_id])
+        if not probed:
+            return np.zeros(0, dtype=np.int64)
+        probed = np.concatenate(probed)
+        return probed[top_n(model.scores(user_row, probed), quota)]
+
+    def _neighbors(self, model: FactorModel, history: np.ndarray, quota: int) -> np.ndarray:
+        if not len(self.centroids) or not len(history) or quota <= 0:
+            return np.zeros(0, dtype=np.int64)
+        per_seed = max(1, quota // len(history))
+        seed_lists = _nearest(_item_vectors(model, history), self.centroids)
+        found = []
+        for item, list_id in zip(history.tolist(), seed_lists.tolist()):
+            members = self.list_items[self.list_offsets[list_id]:self.list_offsets[list_id + 1]]
+            similarity = model.item_vectors(members) @ model.item_vectors(item)
+            found.append(members[top_n(similarity, per_seed)])
+        return np.concatenate(found)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "centroids": self.centroids,
+            "list_offsets": self.list_offsets,
+            "list_items": self.list_items,
+            "history_offsets": self.history_offsets,
+            "history_items": self.history_items,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "Retrieval":
+        return cls(
+            arrays["centroids"],
+            arrays["list_offsets"],
+            arrays["list_items"],
+            arrays["history_offsets"],
+            arrays["history_items"],
+        )
+
+
+def _routes(catalog: Catalog, trending: Trending, history: np.ndarray, quota: int) -> np.ndarray:
+    routes = dict.fromkeys(
+        (catalog.value("source", item), catalog.value("destination", item)) for item in history.tolist()
+    )
+    routes = [route for route in routes if route[0] and route[1]]
+    if not routes or quota <= 0:
+        return np.zeros(0, dtype=np.int64)
+    per_route = max(1, quota // len(routes))
+    return np.concatenate([trending.route(source, destination, per_route) for source, destination in routes])
+
+
+def _history(
+    catalog: Catalog,
+    model: FactorModel,
+    interactions: Interactions,
+    size: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """CSR of each model user's latest `size` distinct catalog items."""
+    items = interactions.item_index(catalog)
+    rows = model.user_rows(interactions.user_ids)
+    rows = np.append(rows, MISSING)[interactions.users]
+    valid = (items != MISSING) & (rows != MISSING)
+    rows, items = rows[valid], items[valid]
+    timestamps = np.nan_to_num(interactions.timestamps[valid], nan=-np.inf)
+
+    # Latest first within each user; then the first row per (user, item).
+    order = np.lexsort((-timestamps, rows))
+    rows, items = rows[order], items[order]
+    pairs = rows.astype(np.int64) * len(catalog) + items
+    _, first = np.unique(pairs, return_index=True)
+    first.sort()
+    rows, items = rows[first], items[first]
+
+    starts = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=model.n_users))))
+    rank = np.arange(len(rows)) - starts[rows]
+    keep = rank < size
+    counts = np.bincount(rows[keep], minlength=model.n_users)
+    return np.concatenate(([0], np.cumsum(counts))), items[keep].astype(np.int32)
+
+
+def _item_vectors(model: FactorModel, items: Optional[np.ndarray] = None) -> np.ndarray:
+    """Item factors with the bias appended, so that vector . [p_u, 1] is the rating minus user terms."""
+    factors = model.item_factors if items is None else model.item_factors[items]
+    bias = model.item_bias if items is None else model.item_bias[items]
+    return np.hstack([factors, bias[:, None]]).astype(np.float32)
+
+
+def _kmeans(vectors: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), KMEANS_SAMPLE), replace=False)]
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = _nearest(sample, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        filled = counts > 0
+        # Empty clusters keep their previous centroid.
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the nearest centroid (Euclidean) per vector, computed in chunks."""
+    half_norms = 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    out = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), CHUNK):
+        block = vectors[start:start + CHUNK]
+        out[start:start + CHUNK] = np.argmax(block @ centroids.T - half_norms, axis=1)
+    return out
+
+
+def _remap_groups(offsets: np.ndarray, items: np.ndarray, source: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Re-point CSR groups of old catalog indices at the new catalog; deleted items drop out."""
+    size = max(int(source.max(initial=MISSING)), int(items.max(initial=MISSING))) + 1
+    new_index = np.full(size, MISSING, dtype=np.int64)
+    kept = np.flatnonzero(source != MISSING)
+    new_index[source[kept]] = kept
+    mapped = new_index[items]
+    keep = mapped != MISSING
+    groups = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    counts = np.bincount(groups[keep], minlength=len(offsets) - 1)
+    return np.concatenate(([0], np.cumsum(counts))), mapped[keep].astype(np.int32)
@@ -0,0 +1,24 @@
+"""Vectorized parsing of the ISO-8601 timestamps the data-services emit."""
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+
+def epoch_seconds(values: Iterable[Optional[str]]) -> np.ndarray:
+    """Seconds since the epoch as float64; NaN where a value is missing or unparseable.
+
+    Naive timestamps are taken as UTC.
+    """
+    parsed = pd.to_datetime(pd.Series(list(values), dtype=object), utc=True, errors="coerce", format="ISO8601")
+    seconds = parsed.to_numpy(dtype="datetime64[ns]").astype(np.int64) / 1e9
+    seconds[parsed.isna().to_numpy()] = np.nan
+    return seconds
+
+
+def parse_time(value: str) -> float:
+    """Epoch seconds for a single timestamp; ValueError if it does not parse."""
+    seconds = float(epoch_seconds([value])[0])
+    if np.isnan(seconds):
+        raise ValueError(f"not an ISO-8601 timestamp: {value!r}")
+    return seconds
@@ -1,5 +1,8 @@
+import json
 import os
+import secrets
 import sys
+import time
 import requests
 
 
@@ -7,15 +10,19 @@ RECOMMENDER_BASE_URL = os.getenv("RECOMMENDER_BASE_URL", "http://localhost:8001"
 HEALTH_GATEWAY_BASE_URL = os.getenv("HEALTH_GATEWAY_BASE_URL", "http://localhost:8050").rstrip("/")
 
 # Optional: if you expose the data-service to localhost, set this (e.g. http://localhost:8000).
+# The catalog change checks upsert one train through /trains/bulk and then restore it.
 DATA_SERVICE_BASE_URL = os.getenv("DATA_SERVICE_BASE_URL", "").rstrip("/")
 
+# Optional: the gateway-server (e.g. http://localhost:9000), for /suggest and cross-service traces.
+GATEWAY_BASE_URL = os.getenv("GATEWAY_BASE_URL", "").rstrip("/")
+
 ROUTE_SOURCE = (os.getenv("ROUTE_SOURCE") or "").strip()
 ROUTE_DESTINATION = (os.getenv("ROUTE_DESTINATION") or "").strip()
 
 
-def _get_json(url: str, params: dict | None = None, timeout: float = 8.0):
+def _get_json(url: str, params: dict | None = None, timeout: float = 8.0, headers: dict | None = None):
     try:
-        res = requests.get(url, params=params, timeout=timeout)
+        res = requests.get(url, params=params, timeout=timeout, headers=headers)
     except requests.exceptions.RequestException as e:
         raise AssertionError(f"Request failed: GET {url} params={params} error={e}")
 
@@ -26,6 +33,47 @@ def _get_json(url: str, params: dict | None = None, timeout: float = 8.0):
     return res.status_code, body
 
 
+def _post_json(url: str, payload, timeout: float = 8.0):
+    try:
+        res = requests.post(url, json=payload, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        raise AssertionError(f"Request failed: POST {url} error={e}")
+
+    try:
+        body = res.json()
+    except Exception:
+        body = res.text
+    return res.status_code, body
+
+
+def _traceparent() -> tuple[str, str]:
+    trace_id = secrets.token_hex(16)
+    return trace_id, f"00-{trace_id}-{secrets.token_hex(8)}-01"
+
+
+def _read_change(feed, key: str, value: str, timeout: float = 10.0) -> dict | None:
+    # The first `changes` event on the SSE stream that upserts the row with key == value.
+    deadline = time.monotonic() + timeout
+    name, data = None, []
+    try:
+        for line in feed.iter_lines(decode_unicode=True):
+            if time.monotonic() > deadline:
+                return None
+            if line.startswith("event:"):
+                name = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                data.append(line[len("data:"):].strip())
+            elif not line:
+                if name == "changes":
+                    payload = json.loads("\n".join(data))
+                    if any(str(row.get(key)) == value for row in payload.get("upserts", [])):
+                        return payload
+                name, data = None, []
+    except requests.exceptions.RequestException:
+        return None
+    return None
+
+
 def _assert(condition: bool, message: str):
     if not condition:
         raise AssertionError(message)
@@ -116,6 +164,40 @@ def test_recommender_service():
     if body["recommendations"]:
         _assert_route_item_schema(body["recommendations"][0], expected_mode="rail")
 
+    # Cursor pagination: the next page continues the first without repeating it.
+    status, first = _get_json(f"{RECOMMENDER_BASE_URL}/recommend/{test_user_id}", params={"top_n": 3})
+    _assert(status == 200 and first.get("nextCursor"), f"/recommend?top_n=3 returned no nextCursor: {first}")
+    status, second = _get_json(
+        f"{RECOMMENDER_BASE_URL}/recommend/{test_user_id}",
+        params={"top_n": 3, "cursor": first["nextCursor"]},
+    )
+    print(f"- GET /recommend/{{user_id}}?cursor=... -> {status}")
+    _assert(status == 200, f"/recommend with cursor failed: {second}")
+    seen = {item["id"] for item in first["recommendations"]}
+    repeated = seen & {item["id"] for item in second["recommendations"]}
+    _assert(not repeated, f"Second page repeats {sorted(repeated)}")
+
+    status, body = _get_json(
+        f"{RECOMMENDER_BASE_URL}/recommend/{test_user_id}", params={"top_n": 3, "cursor": "not-a-cursor"}
+    )
+    print(f"- GET /recommend/{{user_id}}?cursor=<malformed> -> {status}")
+    _assert(status == 400, f"Expected 400 for a malformed cursor, got {status}: {body}")
+
+    status, body = _get_json(f"{RECOMMENDER_BASE_URL}/recommend/{test_user_id}", params={"top_n": 0})
+    print(f"- GET /recommend/{{user_id}}?top_n=0 -> {status}")
+    _assert(status == 422, f"Expected 422 for top_n=0, got {status}: {body}")
+
+    # Tracing: a request with a traceparent is recorded under that trace id.
+    trace_id, traceparent = _traceparent()
+    _get_json(f"{RECOMMENDER_BASE_URL}/recommend/{test_user_id}", headers={"traceparent": traceparent})
+    status, body = _get_json(f"{RECOMMENDER_BASE_URL}/traces/{trace_id}")
+    print(f"- GET /traces/{{trace_id}} -> {status}")
+    _assert(status == 200 and body.get("spans"), f"No spans recorded for trace {trace_id}: {body}")
+
+    status, body = _get_json(f"{RECOMMENDER_BASE_URL}/traces", params={"min_ms": 0, "limit": 5})
+    print(f"- GET /traces -> {status}")
+    _assert(status == 200 and isinstance(body.get("traces"), list), f"/traces failed: {body}")
+
     route = _find_working_route()
     _assert(route is not None, "Could not find a working route for /recommend-route; set ROUTE_SOURCE/ROUTE_DESTINATION or expose data-service and set DATA_SERVICE_BASE_URL")
     src, dst = route
@@ -130,6 +212,107 @@ def test_recommender_service():
     _assert(isinstance(body.get("recommendations"), list), "Missing recommendations list")
     if body["recommendations"]:
         _assert_route_item_schema(body["recommendations"][0], expected_mode="rail")
+    return src, dst
+
+
+def test_data_service():
+    print("\nTesting data-service (rail)")
+    if not DATA_SERVICE_BASE_URL:
+        print("- skipped: set DATA_SERVICE_BASE_URL")
+        return
+
+    status, body = _get_json(f"{DATA_SERVICE_BASE_URL}/users", params={"limit": 5, "days": 30})
+    print(f"- GET /users?days=30 -> {status}")
+    _assert(status == 200 and isinstance(body, list), f"/users failed: {body}")
+
+    status, body = _get_json(f"{DATA_SERVICE_BASE_URL}/users/export", params={"days": 1e9})
+    print(f"- GET /users/export?days=1e9 -> {status}")
+    _assert(status == 422, f"Expected 422 for an out-of-range days window, got {status}: {body}")
+
+    res = requests.get(f"{DATA_SERVICE_BASE_URL}/trains/export", timeout=30)
+    print(f"- GET /trains/export -> {res.status_code}")
+    _assert(res.status_code == 200, f"/trains/export failed: {res.text[:200]}")
+    header = res.text.splitlines()[0] if res.text else ""
+    _assert(header.startswith("train_number,train_name"), f"Unexpected /trains/export header: {header}")
+
+    res = requests.get(f"{DATA_SERVICE_BASE_URL}/users/export", params={"format": "npz", "days": 30}, timeout=30)
+    print(f"- GET /users/export?format=npz -> {res.status_code}")
+    _assert(res.status_code == 200 and res.content[:2] == b"PK", "/users/export?format=npz is not an .npz archive")
+
+
+def test_catalog_changes():
+    print("\nTesting catalog changes (rail)")
+    if not DATA_SERVICE_BASE_URL:
+        print("- skipped: set DATA_SERVICE_BASE_URL")
+        return
+
+    status, trains = _get_json(f"{DATA_SERVICE_BASE_URL}/trains", params={"limit": 1})
+    _assert(status == 200 and isinstance(trains, list) and trains, f"/trains failed: {trains}")
+    train = trains[0]
+    changed = {**train, "train_name": f"{train['train_name']} (test)"}
+
+    test_user_id = os.getenv("TEST_USER_ID", "test-user")
+    status, page = _get_json(f"{RECOMMENDER_BASE_URL}/recommend/{test_user_id}", params={"top_n": 3})
+    _assert(status == 200 and page.get("nextCursor"), f"/recommend?top_n=3 returned no nextCursor: {page}")
+
+    status, head = _get_json(f"{DATA_SERVICE_BASE_URL}/changes/head")
+    _assert(status == 200 and isinstance(head.get("id"), int), f"/changes/head failed: {head}")
+
+    try:
+        with requests.get(
+            f"{DATA_SERVICE_BASE_URL}/changes", params={"since": head["id"]}, stream=True, timeout=10
+        ) as feed:
+            print(f"- GET /changes?since={head['id']} -> {feed.status_code}")
+            _assert(feed.status_code == 200, "Could not open the catalog change feed")
+
+            status, result = _post_json(f"{DATA_SERVICE_BASE_URL}/trains/bulk", [changed])
+            print(f"- POST /trains/bulk -> {status}")
+            _assert(status == 200 and result.get("updated") == 1, f"/trains/bulk failed: {result}")
+
+            event = _read_change(feed, "train_number", str(train["train_number"]))
+            _assert(event is not None, f"No change event for train {train['train_number']}")
+
+        # The recommender follows the same feed; once it applies the change, old cursors are stale.
+        status, body = None, None
+        deadline = time.monotonic() + 15
+        while time.monotonic() < deadline:
+            status, body = _get_json(
+                f"{RECOMMENDER_BASE_URL}/recommend/{test_user_id}",
+                params={"top_n": 3, "cursor": page["nextCursor"]},
+            )
+            if status != 200:
+                break
+            time.sleep(0.5)
+        print(f"- GET /recommend/{{user_id}}?cursor=<stale> -> {status}")
+        _assert(status == 410, f"Expected 410 for a cursor from before the catalog change, got {status}: {body}")
+    finally:
+        _post_json(f"{DATA_SERVICE_BASE_URL}/trains/bulk", [train])
+
+
+def test_gateway(route: tuple[str, str]):
+    print("\nTesting gateway-server (rail)")
+    if not GATEWAY_BASE_URL:
+        print("- skipped: set GATEWAY_BASE_URL")
+        return
+
+    src, _ = route
+    status, body = _get_json(f"{GATEWAY_BASE_URL}/suggest", params={"prefix": src, "mode": "rail"})
+    print(f"- GET /suggest?prefix={src}&mode=rail -> {status}")
+    _assert(status == 200 and isinstance(body.get("codes"), list), f"/suggest failed: {body}")
+    codes = [entry["code"].lower() for entry in body["codes"]]
+    _assert(src.lower() in codes, f"/suggest?prefix={src} does not list {src}: {body}")
+
+    # A traced gateway call gathers spans from the gateway and the recommender behind it.
+    trace_id, traceparent = _traceparent()
+    test_user_id = os.getenv("TEST_USER_ID", "test-user")
+    status, body = _get_json(
+        f"{GATEWAY_BASE_URL}/recommend/{test_user_id}", params={"mode": "rail"}, headers={"traceparent": traceparent}
+    )
+    _assert(status == 200, f"Gateway /recommend failed: {body}")
+    status, body = _get_json(f"{GATEWAY_BASE_URL}/traces/{trace_id}")
+    print(f"- GET /traces/{{trace_id}} (gateway) -> {status}")
+    services = {span.get("service") for span in body.get("spans", [])} if isinstance(body, dict) else set()
+    _assert(status == 200 and len(services) >= 2, f"Expected spans from the gateway and a recommender: {body}")
 
 
 def test_health_gateway():
@@ -141,7 +324,10 @@ def test_health_gateway():
 
 def main():
     try:
-        test_recommender_service()
+        route = test_recommender_service()
+        test_data_service()
+        test_catalog_changes()
+        test_gateway(route)
         test_health_gateway()
     except AssertionError as e:
         print(f"\nTEST FAILED: {e}")
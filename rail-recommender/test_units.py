@@ -0,0 +1,162 @@
+"""Checks for recommender-service modules that need no running services or database.
+
+Run with the recommender-service requirements installed: python test_units.py
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "recommender-service"))
+
+from catalog import MISSING  # noqa: E402
+from model import SCAN_CHUNK, FactorModel, Quantized  # noqa: E402
+from pages import CursorError, RankedPages, StaleCursor, decode_cursor, encode_cursor, state_digest  # noqa: E402
+
+
+def _assert(condition: bool, message: str):
+    if not condition:
+        raise AssertionError(message)
+
+
+def _paged(pages: RankedPages, query, size: int, rank) -> list:
+    # Every page of `query`, following `more` to the end.
+    items, offset = [], 0
+    while True:
+        page, more = pages.page(query, offset, size, rank)
+        items.extend(page.tolist())
+        offset += size
+        if not more:
+            return items
+
+
+def test_pages():
+    print("\nTesting pages")
+
+    calls = []
+
+    def rank(n: int) -> np.ndarray:
+        calls.append(n)
+        return np.arange(min(n, 50))
+
+    pages = RankedPages(max_results=500, lookahead=4)
+    items = _paged(pages, ("q",), 10, rank)
+    print(f"- 50 ranked items in pages of 10 -> {len(items)} items, rank sizes {calls}")
+    _assert(items == list(range(50)), f"Pages skip or repeat items: {items}")
+    # The first ranking covers four pages; the second finds the list complete.
+    _assert(len(calls) == 2, f"Expected two rankings for five pages, got {calls}")
+
+    # A larger ranking may reorder its head; items already paged keep their place.
+    def reordering(n: int) -> np.ndarray:
+        return np.arange(n)[::-1] if n > 8 else np.arange(n)
+
+    pages = RankedPages(max_results=20, lookahead=2)
+    items = _paged(pages, ("q",), 4, reordering)
+    print(f"- reordered ranking, max_results=20 -> {len(items)} items")
+    _assert(items[:8] == list(range(8)), f"Already paged items moved: {items}")
+    _assert(sorted(items) == list(range(20)), f"Pages skip or repeat items: {items}")
+
+    pages = RankedPages(max_results=500, max_entries=1)
+    pages.page(("a",), 0, 5, rank)
+    pages.page(("b",), 0, 5, rank)
+    calls.clear()
+    pages.page(("a",), 5, 5, rank)
+    _assert(calls, "Expected an evicted query to be ranked again")
+
+
+def test_cursors():
+    print("\nTesting cursors")
+    cursor = encode_cursor("state-1", ("recommend", "u1"), 20)
+    _assert(decode_cursor(cursor, "state-1", ("recommend", "u1")) == 20, "Cursor does not round-trip")
+    _assert(decode_cursor(None, "state-1", ("recommend", "u1")) == 0, "No cursor should start at 0")
+
+    for name, args, error in [
+        ("other state", (cursor, "state-2", ("recommend", "u1")), StaleCursor),
+        ("other query", (cursor, "state-1", ("recommend", "u2")), CursorError),
+        ("malformed", ("not-a-cursor", "state-1", ("recommend", "u1")), CursorError),
+    ]:
+        try:
+            decode_cursor(*args)
+        except error as e:
+            print(f"- {name} -> {type(e).__name__}")
+            _assert(name == "other state" or not isinstance(e, StaleCursor), f"{name} should not be stale")
+        else:
+            raise AssertionError(f"Expected {error.__name__} for a cursor from {name}")
+
+    catalog = {"ids": np.array(["F1", "F2", "F3"]), "trending": np.array([3.0, 2.0, 1.0])}
+    factors = {"model.items": np.random.default_rng(0).normal(size=(10000, 8))}
+    digest = state_digest(catalog, factors)
+    _assert(digest == state_digest({k: v.copy() for k, v in catalog.items()}, factors), "Equal states differ")
+    edited = {**catalog, "trending": np.array([3.0, 2.0, 1.5])}
+    _assert(digest != state_digest(edited, factors), "A one-row catalog edit does not change the digest")
+    retrained = {"model.items": factors["model.items"] + 1e-3}
+    _assert(digest != state_digest(catalog, retrained), "A retrained model does not change the digest")
+
+
+def test_quantized():
+    print("\nTesting quantized factors")
+    rng = np.random.default_rng(0)
+    factors = rng.normal(size=(SCAN_CHUNK + 100, 16))
+    factors[3] = 0.0
+    vector = rng.normal(size=16).astype(np.float32)
+
+    for precision, tolerance in (("float16", 1e-2), ("int8", 0.5 / 127)):
+        quantized = Quantized.encode(factors, precision)
+        error = np.abs(quantized.rows() - factors).max(axis=1) / np.maximum(np.abs(factors).max(axis=1), 1e-12)
+        print(f"- {precision}: max relative row error {error.max():.4f}")
+        _assert(error.max() <= tolerance, f"{precision} codes are too far from the factors")
+        _assert(not quantized.rows(3).any(), f"{precision}: a zero row should decode to zeros")
+
+        items = np.array([0, 3, SCAN_CHUNK + 50])
+        exact = quantized.rows() @ vector
+        _assert(np.allclose(quantized.dot(vector), exact, atol=1e-3), f"{precision}: dot is wrong")
+        subset = quantized.dot(vector, items)
+        _assert(np.allclose(subset, exact[items], atol=1e-3), f"{precision}: dot over items is wrong")
+
+        taken = quantized.take(np.array([2, MISSING]))
+        _assert(np.array_equal(taken.rows(0), quantized.rows(2)), f"{precision}: take moved the wrong row")
+        _assert(not taken.rows(1).any(), f"{precision}: an added item should decode to zeros")
+
+    n_users, n_items = 50, 3000
+    model = FactorModel.from_factors(
+        np.array([f"u{i}" for i in range(n_users)]), rng.normal(size=(n_users, 16)), rng.normal(size=(n_items, 16))
+    )
+    for precision in ("float32", "float16", "int8"):
+        variant = model.with_precision(precision)
+        recall = np.mean(
+            [len(np.intersect1d(model.top(u, 10), variant.top(u, 10))) / 10 for u in range(n_users)]
+        )
+        print(
+            f"- {precision}: {variant.nbytes() / 1e3:.0f} kB "
+            f"(float64 {model.nbytes() / 1e3:.0f} kB), recall@10 {recall:.3f}"
+        )
+        _assert(variant.precision == precision, f"Expected precision {precision}, got {variant.precision}")
+        _assert(variant.item_factors.dtype == np.float32, f"{precision}: full-precision factors should be float32")
+        _assert(variant.nbytes() < model.nbytes(), f"{precision} model is not smaller than the float64 one")
+        _assert(recall >= 0.95, f"{precision} top-10 recall {recall:.3f} is too low")
+        restored = FactorModel.from_arrays(variant.to_arrays())
+        _assert(restored.precision == precision, f"{precision} does not survive to_arrays/from_arrays")
+        same = np.array_equal(restored.top(0, 10), variant.top(0, 10))
+        _assert(same, f"{precision}: restored model ranks differently")
+
+    try:
+        model.with_precision("bfloat16")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError for an unknown precision")
+
+
+def main():
+    try:
+        test_pages()
+        test_cursors()
+        test_quantized()
+    except AssertionError as e:
+        print(f"\nTEST FAILED: {e}")
+        sys.exit(1)
+    print("\nAll tests passed.")
+
+
+if __name__ == "__main__":
+    main()